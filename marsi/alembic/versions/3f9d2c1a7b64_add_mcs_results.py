@@ -0,0 +1,36 @@
+"""add mcs results
+
+Revision ID: 3f9d2c1a7b64
+Revises: ef39a4ae2c8c
+Create Date: 2026-10-16 10:00:00.000000
+
+"""
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = '3f9d2c1a7b64'
+down_revision = 'ef39a4ae2c8c'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        'mcs_results',
+        sa.Column('id', sa.Integer, primary_key=True),
+        sa.Column('first_inchi_key', sa.String(27), nullable=False),
+        sa.Column('second_inchi_key', sa.String(27), nullable=False),
+        sa.Column('match_rings', sa.Boolean, nullable=False),
+        sa.Column('atom_compare', sa.String(20), nullable=False),
+        sa.Column('bond_compare', sa.String(20), nullable=False),
+        sa.Column('num_atoms', sa.Integer, nullable=False),
+        sa.Column('num_bonds', sa.Integer, nullable=False),
+        sa.Column('smarts', sa.Text, nullable=True),
+        sa.UniqueConstraint('first_inchi_key', 'second_inchi_key', 'match_rings', 'atom_compare', 'bond_compare',
+                            name='_mcs_pair_uc')
+    )
+
+
+def downgrade():
+    op.drop_table('mcs_results')
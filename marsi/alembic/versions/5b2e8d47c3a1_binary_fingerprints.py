@@ -0,0 +1,57 @@
+"""binary fingerprints
+
+Revision ID: 5b2e8d47c3a1
+Revises: 9c4e7b2d5a18
+Create Date: 2026-10-16 18:00:00.000000
+
+"""
+import sqlalchemy as sa
+from alembic import op
+
+from marsi.chemistry.fingerprint import PackedFingerprint
+
+# revision identifiers, used by Alembic.
+revision = '5b2e8d47c3a1'
+down_revision = '9c4e7b2d5a18'
+branch_labels = None
+depends_on = None
+
+# Number of fingerprints converted per query.
+BATCH_SIZE = 10000
+
+
+def _convert(source_type, target_type, convert):
+    # Copies `fingerprint` into a new column of `target_type`, BATCH_SIZE rows at a time (by id), then replaces it.
+    op.add_column('metabolite_fingerprints', sa.Column('converted_fingerprint', target_type, nullable=True))
+
+    fingerprints = sa.table('metabolite_fingerprints',
+                            sa.column('id', sa.Integer),
+                            sa.column('fingerprint', source_type),
+                            sa.column('converted_fingerprint', target_type))
+    update = fingerprints.update().where(fingerprints.c.id == sa.bindparam('row_id')).values(
+        converted_fingerprint=sa.bindparam('value'))
+
+    connection = op.get_bind()
+    last_id = None
+    while True:
+        query = fingerprints.select().order_by(fingerprints.c.id).limit(BATCH_SIZE)
+        if last_id is not None:
+            query = query.where(fingerprints.c.id > last_id)
+        rows = connection.execute(query).fetchall()
+        if len(rows) == 0:
+            break
+        connection.execute(update, [{'row_id': row.id, 'value': convert(row.fingerprint)} for row in rows])
+        last_id = rows[-1].id
+
+    with op.batch_alter_table('metabolite_fingerprints') as batch_op:
+        batch_op.drop_column('fingerprint')
+        batch_op.alter_column('converted_fingerprint', new_column_name='fingerprint', existing_type=target_type,
+                              nullable=False)
+
+
+def upgrade():
+    _convert(sa.String(2048), sa.LargeBinary, lambda value: PackedFingerprint.from01(value).to_bytes())
+
+
+def downgrade():
+    _convert(sa.LargeBinary, sa.String(2048), lambda value: PackedFingerprint.from_bytes(value).to01())
@@ -0,0 +1,23 @@
+"""add conformer
+
+Revision ID: 9c4e7b2d5a18
+Revises: 3f9d2c1a7b64
+Create Date: 2026-10-16 14:00:00.000000
+
+"""
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = '9c4e7b2d5a18'
+down_revision = '3f9d2c1a7b64'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('metabolites', sa.Column('conformer', sa.Text, nullable=True))
+
+
+def downgrade():
+    op.drop_column('metabolites', 'conformer')
@@ -0,0 +1,29 @@
+"""add fingerprint failures
+
+Revision ID: d7a3f1c9e2b6
+Revises: 5b2e8d47c3a1
+Create Date: 2026-10-16 23:30:00.000000
+
+"""
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = 'd7a3f1c9e2b6'
+down_revision = '5b2e8d47c3a1'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        'fingerprint_failures',
+        sa.Column('id', sa.Integer, primary_key=True),
+        sa.Column('metabolite_id', sa.Integer, sa.ForeignKey('metabolites.id'), nullable=False),
+        sa.Column('fingerprint_type', sa.String(10), nullable=False),
+        sa.UniqueConstraint('metabolite_id', 'fingerprint_type', name='_fp_failure_uc')
+    )
+
+
+def downgrade():
+    op.drop_table('fingerprint_failures')
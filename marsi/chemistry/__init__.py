@@ -13,7 +13,10 @@
 # limitations under the License.
 
 from marsi.chemistry.common import INCHI_KEY_REGEX, SOLUBILITY
-from marsi.chemistry.common import convex_hull_volume, monte_carlo_volume, tanimoto_coefficient, tanimoto_distance
+from marsi.chemistry.common import convex_hull_volume, molecular_volume, monte_carlo_volume, monte_carlo_volumes, \
+    quasi_monte_carlo_volume, tanimoto_coefficient, tanimoto_distance
+from marsi.chemistry.fingerprint import PackedFingerprint
 
-__all__ = ["INCHI_KEY_REGEX", "SOLUBILITY", "convex_hull_volume", "monte_carlo_volume", "tanimoto_distance",
+__all__ = ["INCHI_KEY_REGEX", "SOLUBILITY", "PackedFingerprint", "convex_hull_volume", "molecular_volume",
+           "monte_carlo_volume", "monte_carlo_volumes", "quasi_monte_carlo_volume", "tanimoto_distance",
            "tanimoto_coefficient"]
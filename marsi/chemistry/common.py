@@ -13,15 +13,17 @@
 # limitations under the License.
 
 import re
+from concurrent.futures import ThreadPoolExecutor
 
 import numpy as np
 from cachetools import LRUCache
-from marsi.chemistry.common_ext import tanimoto_coefficient, tanimoto_distance, rmsd, monte_carlo_volume
+from marsi.chemistry.common_ext import tanimoto_coefficient, tanimoto_distance, rmsd, monte_carlo_volume, \
+    quasi_monte_carlo_volume
 from scipy.spatial import ConvexHull
 from scipy.spatial.qhull import QhullError
 
-__all__ = ["rmsd", "tanimoto_coefficient", "tanimoto_distance", "monte_carlo_volume",
-           "INCHI_KEY_REGEX", 'SOLUBILITY']
+__all__ = ["rmsd", "tanimoto_coefficient", "tanimoto_distance", "monte_carlo_volume", "quasi_monte_carlo_volume",
+           "molecular_volume", "monte_carlo_volumes", "VOLUME_METHODS", "INCHI_KEY_REGEX", 'SOLUBILITY']
 
 
 inchi_key_lru_cache = LRUCache(maxsize=512)
@@ -35,6 +37,9 @@ SOLUBILITY = {
 }
 
 
+VOLUME_METHODS = ("monte_carlo", "quasi_monte_carlo")
+
+
 INCHI_KEY_REGEX = re.compile("[0-9A-Z]{14}\-[0-9A-Z]{8,10}\-[0-9A-Z]")
 
 
@@ -47,3 +52,93 @@ def convex_hull_volume(xyz):
 
 def dynamic_fingerprint_cut(n_atoms):
     return min(0.017974 * n_atoms + 0.008239, 0.75)
+
+
+def molecular_volume(coordinates, vdw_radii, method="monte_carlo", tolerance=1, max_iterations=10000, step_size=1000,
+                     seed=0, verbose=False):
+    """
+    Estimates the VdW volume of a molecule.
+
+    Parameters
+    ----------
+    coordinates : ndarray
+        The x, y, z coordinates of the atoms.
+    vdw_radii : ndarray
+        The VdW radius of each atom.
+    method : str
+        'monte_carlo' (random points until the volume changes less than `tolerance`) or 'quasi_monte_carlo' (shifted
+        Halton points until the standard error is below `tolerance`, with at most `max_iterations * step_size` points).
+    tolerance : float
+        The tolerance for convergence.
+    max_iterations : int
+        The maximum number of steps.
+    step_size : int
+        The number of points added each step.
+    seed : int
+        The seed of the random points (None for a random seed).
+    verbose : bool
+        Print debug information if True (only 'monte_carlo').
+
+    Returns
+    -------
+    float
+        The volume.
+    """
+    coordinates = np.asarray(coordinates, dtype=np.float32)
+    vdw_radii = np.asarray(vdw_radii, dtype=np.float32)
+    if method == "monte_carlo":
+        return monte_carlo_volume(coordinates, vdw_radii, tolerance, max_iterations, step_size, seed, int(verbose))
+    elif method == "quasi_monte_carlo":
+        volume, error = quasi_monte_carlo_volume(coordinates, vdw_radii, tolerance, max(max_iterations * step_size, 1),
+                                                 seed=seed)
+        if verbose:
+            print("Volume %.5f +/- %.5f" % (volume, error))
+        return volume
+    else:
+        raise ValueError("Unknown volume method %s, use one of %s" % (method, ", ".join(VOLUME_METHODS)))
+
+
+def monte_carlo_volumes(coordinates, vdw_radii, tolerance=1, max_iterations=10000, step_size=1000, seed=0,
+                        threads=None, method="monte_carlo"):
+    """
+    Estimates the volume of many molecules (or conformers) with `molecular_volume`. The point tests run without the
+    GIL, so the molecules are computed in parallel threads.
+
+    Parameters
+    ----------
+    coordinates : list
+        The x, y, z coordinates of the atoms of each molecule, or a (conformers, atoms, 3) array.
+    vdw_radii : list
+        The VdW radii of the atoms of each molecule, or one array shared by all conformers.
+    tolerance : float
+        The tolerance for convergence.
+    max_iterations : int
+        The maximum number of steps.
+    step_size : int
+        The number of points added each step.
+    seed : int
+        The seed of the random points of each molecule.
+    threads : int
+        The number of threads (defaults to the number of CPUs).
+    method : str
+        'monte_carlo' or 'quasi_monte_carlo' (see `molecular_volume`).
+
+    Returns
+    -------
+    ndarray
+        The volume of each molecule.
+    """
+    if isinstance(vdw_radii, np.ndarray) and vdw_radii.ndim == 1:
+        vdw_radii = [vdw_radii] * len(coordinates)
+    if len(coordinates) != len(vdw_radii):
+        raise ValueError("There must be one array of VdW radii per molecule")
+    if method not in VOLUME_METHODS:
+        raise ValueError("Unknown volume method %s, use one of %s" % (method, ", ".join(VOLUME_METHODS)))
+
+    def volume(args):
+        coords, radii = args
+        return molecular_volume(coords, radii, method=method, tolerance=tolerance, max_iterations=max_iterations,
+                                step_size=step_size, seed=seed)
+
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        return np.array(list(executor.map(volume, zip(coordinates, vdw_radii))), dtype=np.float64)
@@ -165,111 +165,251 @@ def rmsd(np.ndarray[FLOAT32_t, ndim=3] v, np.ndarray[FLOAT32_t, ndim=3] w):
 
     return sqrt(1/n * sum)
 
-@cython.nonecheck(False)
-@cython.cdivision(True)
-cdef limits(np.ndarray[FLOAT32_t, ndim=2] coords, np.ndarray[FLOAT32_t, ndim=1] vdw_radii, int index):
-    cdef unsigned int i = 0
-    cdef unsigned int n = len(coords)
-    cdef np.ndarray[FLOAT32_t, ndim=1] _coord = np.zeros(n, dtype=np.float32)
-
-    for i in range(len(coords)):
-        _coord[i] = coords[i][index] + vdw_radii[i]
-    return min(_coord), max(_coord)
-
-@cython.nonecheck(False)
-@cython.cdivision(True)
-cdef unsigned int point_in_molecule(np.ndarray[FLOAT32_t, ndim=2] coords, np.ndarray[FLOAT32_t, ndim=1] vdw_radii, np.ndarray[FLOAT32_t, ndim=1] point):
-
-    cdef float r, x, y, z
-    cdef unsigned int n = len(coords)
-    cdef np.ndarray[FLOAT32_t, ndim=1] _coord
-    for i in range(n):
-        _coord = coords[i]
-        r = vdw_radii[i]
-
-        x = point[0] - _coord[0]
-        y = point[1] - _coord[1]
-        z = point[2] - _coord[2]
-
-        if x*x + y*y + z*z <= r**2:
-            return 1
-    return 0
-
-@cython.nonecheck(False)
+@cython.boundscheck(False)
+@cython.wraparound(False)
 @cython.cdivision(True)
-cdef _monte_carlo_volume(np.ndarray[FLOAT32_t, ndim=2] coords, np.ndarray[FLOAT32_t, ndim=1] vdw_radii, float tolerance,
-                         unsigned int max_iterations, unsigned int step_size, int seed, unsigned int verbose):
+cdef Py_ssize_t _count_points_in_molecule(FLOAT32_t[:, ::1] points, FLOAT32_t[:, ::1] coords,
+                                          FLOAT32_t[::1] squared_radii, np.intp_t[::1] cell_start,
+                                          np.intp_t[::1] cell_atoms, int[3] shape, float[3] origin,
+                                          float cell_size) nogil:
+    """
+    Counts the points within the VdW radius of at least one atom. The atoms are binned in cells of `cell_size` (at
+    least the largest radius), so each point is only tested against the atoms of its cell and the 26 cells around it.
+    """
+    cdef Py_ssize_t count = 0
+    cdef Py_ssize_t i, k, atom
+    cdef int cell[3]
+    cdef int ix, iy, iz, axis, c
+    cdef float x, y, z, dx, dy, dz
+    cdef bint inside
+
+    for i in range(points.shape[0]):
+        x = points[i, 0]
+        y = points[i, 1]
+        z = points[i, 2]
+        for axis in range(3):
+            cell[axis] = <int> ((points[i, axis] - origin[axis]) / cell_size)
+            if cell[axis] >= shape[axis]:
+                cell[axis] = shape[axis] - 1
+
+        inside = False
+        for ix in range(max(cell[0] - 1, 0), min(cell[0] + 2, shape[0])):
+            for iy in range(max(cell[1] - 1, 0), min(cell[1] + 2, shape[1])):
+                for iz in range(max(cell[2] - 1, 0), min(cell[2] + 2, shape[2])):
+                    c = (ix * shape[1] + iy) * shape[2] + iz
+                    for k in range(cell_start[c], cell_start[c + 1]):
+                        atom = cell_atoms[k]
+                        dx = x - coords[atom, 0]
+                        dy = y - coords[atom, 1]
+                        dz = z - coords[atom, 2]
+                        if dx * dx + dy * dy + dz * dz <= squared_radii[atom]:
+                            inside = True
+                            break
+                    if inside:
+                        break
+                if inside:
+                    break
+            if inside:
+                break
+
+        if inside:
+            count += 1
+
+    return count
+
+
+cdef class _CellList:
+    """
+    The atoms of a molecule binned in a uniform grid that covers the bounding box of their VdW spheres.
+    """
+    cdef FLOAT32_t[:, ::1] coords
+    cdef FLOAT32_t[::1] squared_radii
+    cdef np.intp_t[::1] cell_start
+    cdef np.intp_t[::1] cell_atoms
+    cdef int shape[3]
+    cdef float origin[3]
+    cdef float cell_size
+    cdef readonly object lower
+    cdef readonly object upper
+
+    def __init__(self, np.ndarray coords, np.ndarray vdw_radii):
+        coords = np.ascontiguousarray(coords, dtype=np.float32)
+        vdw_radii = np.ascontiguousarray(vdw_radii, dtype=np.float32)
+
+        self.lower = (coords - vdw_radii[:, None]).min(axis=0)
+        self.upper = (coords + vdw_radii[:, None]).max(axis=0)
+        self.cell_size = max(float(vdw_radii.max()), 1e-3)
+
+        shape = np.maximum(np.ceil((self.upper - self.lower) / self.cell_size), 1).astype(np.intp)
+        atom_cells = np.minimum(((coords - self.lower) / self.cell_size).astype(np.intp), shape - 1)
+        linear_cells = (atom_cells[:, 0] * shape[1] + atom_cells[:, 1]) * shape[2] + atom_cells[:, 2]
+
+        self.coords = coords
+        self.squared_radii = vdw_radii * vdw_radii
+        self.cell_atoms = np.argsort(linear_cells, kind='mergesort').astype(np.intp)
+        self.cell_start = np.concatenate([[0], np.cumsum(np.bincount(linear_cells, minlength=int(np.prod(shape))))])\
+            .astype(np.intp)
+        for axis in range(3):
+            self.shape[axis] = shape[axis]
+            self.origin[axis] = self.lower[axis]
+
+    @property
+    def box_volume(self):
+        return float(np.prod(self.upper - self.lower))
+
+    def count(self, np.ndarray points):
+        cdef FLOAT32_t[:, ::1] _points = np.ascontiguousarray(points, dtype=np.float32)
+        cdef Py_ssize_t count
+        with nogil:
+            count = _count_points_in_molecule(_points, self.coords, self.squared_radii, self.cell_start,
+                                              self.cell_atoms, self.shape, self.origin, self.cell_size)
+        return count
+
+
+def monte_carlo_volume(np.ndarray coords, np.ndarray vdw_radii, float tolerance, int max_iterations, int step_size,
+                       seed=0, int verbose=0, int initial_points=100000):
+    """
+    Adapted from:
 
-    np.random.seed(seed)
+    Simple Monte Carlo estimation of VdW molecular volume (in A^3)
+    by Geoffrey Hutchison <geoffh@pitt.edu>
 
-    # determine the bounding box
-    cdef float[2] mol_x = limits(coords, vdw_radii, 0)
-    cdef float[2] mol_y = limits(coords, vdw_radii, 2)
-    cdef float[2] mol_z = limits(coords, vdw_radii, 2)
+    https://github.com/ghutchis/hutchison-cluster
 
-    cdef float mol_x_len = mol_x[1] - mol_x[0]
-    cdef float mol_y_len = mol_y[1] - mol_y[0]
-    cdef float mol_z_len = mol_y[1] - mol_y[0]
+    Random points are drawn in the bounding box of the VdW spheres, `initial_points` first and then `step_size` at a
+    time until the volume changes less than `tolerance` (or after `max_iterations` steps). The atoms are indexed in a
+    cell list and each block of points is tested without the GIL.
 
-    cdef float mol_x_mid = (mol_x[0] + mol_x[1]) / 2.0
-    cdef float mol_y_mid = (mol_y[0] + mol_y[1]) / 2.0
-    cdef float mol_z_mid = (mol_z[0] + mol_z[1]) / 2.0
+    Parameters
+    ----------
+    coords : ndarray
+        The x, y, z coordinates of the atoms.
+    vdw_radii : ndarray
+        The VdW radius of each atom.
+    tolerance : float
+        The tolerance for convergence abs(new_volume - volume) < tolerance.
+    max_iterations : int
+        The maximum number of steps.
+    step_size : int
+        The number of points added each step.
+    seed : int
+        The seed of the random points (None for a random seed).
+    verbose : bool
+        Print debug information if True.
+    initial_points : int
+        The number of points of the first estimate.
 
-    cdef float box_x_min = mol_x_mid - 2.0 * mol_x_len
-    cdef float box_x_max = mol_x_mid + 2.0 * mol_x_len
-    cdef float box_y_min = mol_y_mid - 2.0 * mol_y_len
-    cdef float box_y_max = mol_y_mid + 2.0 * mol_y_len
-    cdef float box_z_min = mol_z_mid - 2.0 * mol_z_len
-    cdef float box_z_max = mol_z_mid + 2.0 * mol_z_len
+    Returns
+    -------
+    float
+        The volume.
+    """
+    if len(coords) == 0:
+        return 0.0
 
-    cdef float box_x_len = box_x_max - box_x_min
-    cdef float box_y_len = box_y_max - box_y_min
-    cdef float box_z_len = box_z_max - box_z_min
-    cdef float box_volume = box_x_len * box_y_len * box_z_len
+    cdef _CellList cells = _CellList(coords, vdw_radii)
+    random = np.random.RandomState(seed)
+    lower = cells.lower
+    extent = cells.upper - cells.lower
+    box_volume = cells.box_volume
 
     if verbose:
         print("Box volume %.5f" % box_volume)
 
-    # calculate the ratio of points inside and outside the VdW shell of the molecule
-
-    # one hundred thousand points to start
-    cdef unsigned int total_points = 100000
-    cdef unsigned int points_in_molecule = 0
-
-    cdef np.ndarray[FLOAT32_t, ndim=2] points = np.random.uniform(box_x_min, box_x_max, (total_points, 3)).astype(np.float32)
-    cdef np.ndarray[FLOAT32_t, ndim=1] point
-    cdef int i =0
-    for i in range(total_points):
-        point = points[i]
-        points_in_molecule += point_in_molecule(coords, vdw_radii, point)
-
-    # Adding more points until reach some convergence
-    cdef float volume = box_volume * float(points_in_molecule) / float(total_points)
-    cdef float new_volume = 0.0
-    cdef j = 0
-    while abs(volume - new_volume) > tolerance and j <= max_iterations:
-        points = np.random.uniform(box_x_min, box_x_max, (step_size, 3)).astype(np.float32)
-        for i in range(step_size):
-            point = points[i]
-            points_in_molecule += point_in_molecule(coords, vdw_radii, point)
+    total_points = max(initial_points, 1)
+    points_in_molecule = cells.count(lower + random.random_sample((total_points, 3)).astype(np.float32) * extent)
+    volume = box_volume * points_in_molecule / total_points
+
+    for i in range(max_iterations):
+        points_in_molecule += cells.count(lower + random.random_sample((step_size, 3)).astype(np.float32) * extent)
         total_points += step_size
-        volume = new_volume
-        new_volume =  box_volume * float(points_in_molecule) / float(total_points)
+        new_volume = box_volume * points_in_molecule / total_points
         if verbose:
-            print("Iteration %i, volume: %.5f, new volume: %.5f" % (j, volume, new_volume))
-        j += 1
+            print("Iteration %i, volume: %.5f, new volume: %.5f" % (i, volume, new_volume))
+        converged = abs(new_volume - volume) < tolerance
+        volume = new_volume
+        if converged:
+            break
 
     return volume
 
-def monte_carlo_volume(np.ndarray[FLOAT32_t, ndim=2] coords, np.ndarray[FLOAT32_t, ndim=1] vdw_radii, float tolerance,
-                         int max_iterations, int step_size, int seed, int verbose):
-    """
-    Adapted from:
 
-    Simple Monte Carlo estimation of VdW molecular volume (in A^3)
-    by Geoffrey Hutchison <geoffh@pitt.edu>
+HALTON_BASES = (2, 3, 5)
 
-    https://github.com/ghutchis/hutchison-cluster
+
+def halton_points(Py_ssize_t start, Py_ssize_t stop):
+    """
+    The points `start` to `stop` of the 3D Halton sequence (bases 2, 3 and 5) in the unit cube.
     """
+    index = np.arange(start, stop, dtype=np.int64)
+    points = np.zeros((len(index), 3), dtype=np.float64)
+    for axis, base in enumerate(HALTON_BASES):
+        remainder = index.copy()
+        fraction = 1.0
+        while remainder.any():
+            fraction /= base
+            points[:, axis] += fraction * (remainder % base)
+            remainder //= base
+    return points
+
+
+def quasi_monte_carlo_volume(np.ndarray coords, np.ndarray vdw_radii, float tolerance, int max_points=2 ** 22,
+                             int shifts=8, seed=0, int initial_points=4096):
+    """
+    Estimates the VdW molecular volume (in A^3) with randomized quasi-Monte Carlo.
+
+    The same Halton points are shifted by `shifts` random offsets (modulo the bounding box), which gives independent
+    estimates of the volume. The number of points doubles until the standard error of their mean is below `tolerance`
+    (or `max_points` points are used). Low-discrepancy points cover the box evenly, so the error drops close to 1/n
+    instead of 1/sqrt(n) with random points.
 
-    return _monte_carlo_volume(coords, vdw_radii, tolerance, max_iterations, step_size, seed, verbose)
+    Parameters
+    ----------
+    coords : ndarray
+        The x, y, z coordinates of the atoms.
+    vdw_radii : ndarray
+        The VdW radius of each atom.
+    tolerance : float
+        The target standard error of the volume.
+    max_points : int
+        The maximum number of points (for all shifts).
+    shifts : int
+        The number of random shifts (at least 2).
+    seed : int
+        The seed of the shifts (None for a random seed).
+    initial_points : int
+        The number of points per shift of the first estimate.
+
+    Returns
+    -------
+    tuple
+        The volume and its standard error.
+    """
+    if shifts < 2:
+        raise ValueError("At least 2 shifts are needed to estimate the error")
+    if len(coords) == 0:
+        return 0.0, 0.0
+
+    cdef _CellList cells = _CellList(coords, vdw_radii)
+    offsets = np.random.RandomState(seed).random_sample((shifts, 3))
+    lower = cells.lower
+    extent = cells.upper - cells.lower
+    box_volume = cells.box_volume
+
+    counts = np.zeros(shifts, dtype=np.int64)
+    total_points = 0
+    stop = max(initial_points, 1)
+    while True:
+        sequence = halton_points(total_points + 1, stop + 1)
+        for shift in range(shifts):
+            points = lower + ((sequence + offsets[shift]) % 1.0) * extent
+            counts[shift] += cells.count(points.astype(np.float32))
+        total_points = stop
+
+        volumes = box_volume * counts / total_points
+        error = volumes.std(ddof=1) / np.sqrt(shifts)
+        if error < tolerance or 2 * total_points * shifts > max_points:
+            break
+        stop = 2 * total_points
+
+    return float(volumes.mean()), float(error)
@@ -0,0 +1,176 @@
+# Copyright 2017 Chr. Hansen A/S and The Novo Nordisk Foundation Center for Biosustainability, DTU.
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+# http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import numpy as np
+from bitarray import bitarray
+
+__all__ = ['PackedFingerprint']
+
+# Binary format (see `PackedFingerprint.to_bytes`): a little-endian 64-bit header with the length in the low 32 bits and
+# the number of bits set in the high 32 bits, followed by the little-endian words.
+_LENGTH_MASK = 0xFFFFFFFF
+
+
+def _n_words(length):
+    return (length + 63) // 64
+
+
+def _words_from_bytes(packed_bytes, length):
+    # Pads little-endian packed bits to whole 64-bit words.
+    words = np.zeros(8 * _n_words(length), dtype=np.uint8)
+    words[:len(packed_bytes)] = packed_bytes[:len(words)]
+    return words.view('<u8').astype(np.uint64, copy=False)
+
+
+class PackedFingerprint(object):
+    """
+    A binary fingerprint packed in 64-bit words.
+
+    Bit *i* is stored in word *i // 64* at position *i % 64*, the layout of the nearest neighbors models (see
+    `marsi.nearest_neighbors.model_ext.pack_fingerprints`), so the words are used by the models as they are. The number
+    of bits set is computed once.
+
+    It can still be used as a sequence of bits (`len`, iteration, indexing, `numpy.asarray`) and `to01` gives the string
+    of '0' and '1' of a `bitarray`.
+
+    Parameters
+    ----------
+    words : ndarray
+        The packed bits (at least `length` bits, bits after `length` are ignored).
+    length : int
+        The number of bits.
+    """
+
+    __slots__ = ('words', 'length', '_popcount')
+
+    def __init__(self, words, length):
+        length = int(length)
+        words = np.ascontiguousarray(words, dtype=np.uint64)
+        n_words = _n_words(length)
+        if words.shape[0] < n_words:
+            raise ValueError("%i bits do not fit in %i words" % (length, words.shape[0]))
+        words = words[:n_words]
+
+        tail = length % 64
+        if tail and words[-1] >> np.uint64(tail):
+            words = words.copy()
+            words[-1] &= np.uint64((1 << tail) - 1)
+
+        self.words = words
+        self.length = length
+        self._popcount = None
+
+    @classmethod
+    def from_bits(cls, bits):
+        """
+        Packs a sequence of bits (a bitarray, or any sequence or array where non-zero values are set bits).
+        """
+        if isinstance(bits, bitarray):
+            bits = np.frombuffer(bits.unpack(), dtype=np.uint8)
+        else:
+            bits = np.asarray(bits) != 0
+        return cls(_words_from_bytes(np.packbits(bits, bitorder='little'), len(bits)), len(bits))
+
+    @classmethod
+    def from_words32(cls, words, length):
+        """
+        Packs a fingerprint given as 32-bit words with bit *i* in word *i // 32* at position *i % 32* (e.g. the `fp`
+        vector of a `pybel.Fingerprint`).
+        """
+        words = np.asarray(words, dtype='<u4')
+        return cls(_words_from_bytes(words.view(np.uint8), length), length)
+
+    @classmethod
+    def from01(cls, bit_string):
+        """
+        Packs a string of '0' and '1' (see `to01`).
+        """
+        return cls.from_bits(np.frombuffer(bit_string.encode('ascii'), dtype=np.uint8) == ord('1'))
+
+    @classmethod
+    def from_bytes(cls, data):
+        """
+        Reads a fingerprint written by `to_bytes`. The words are a view of `data`, they are not copied.
+        """
+        words = np.frombuffer(data, dtype='<u8')
+        if words.shape[0] == 0:
+            raise ValueError("Not a packed fingerprint")
+        header = int(words[0])
+        fingerprint = cls(words[1:], header & _LENGTH_MASK)
+        fingerprint._popcount = header >> 32
+        return fingerprint
+
+    @property
+    def popcount(self):
+        if self._popcount is None:
+            self._popcount = int(np.unpackbits(self.words.view(np.uint8)).sum())
+        return self._popcount
+
+    def to_bits(self):
+        """
+        The bits as an int32 array of 0's and 1's.
+        """
+        return np.unpackbits(self.words.view(np.uint8), bitorder='little')[:self.length].astype(np.int32)
+
+    def to01(self):
+        bits = np.unpackbits(self.words.view(np.uint8), bitorder='little')[:self.length]
+        return (bits + ord('0')).tobytes().decode('ascii')
+
+    def to_bytes(self):
+        """
+        The fingerprint as bytes: a 64-bit header with the length and the number of bits set, followed by the words.
+        """
+        header = np.array([self.length | (self.popcount << 32)], dtype='<u8')
+        return header.tobytes() + self.words.astype('<u8', copy=False).tobytes()
+
+    def __array__(self, dtype=None, copy=None):
+        bits = self.to_bits()
+        return bits if dtype is None else bits.astype(dtype, copy=False)
+
+    def __len__(self):
+        return self.length
+
+    def __iter__(self):
+        return iter(self.to_bits().tolist())
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return self.to_bits()[index]
+        if index < 0:
+            index += self.length
+        if not 0 <= index < self.length:
+            raise IndexError("fingerprint index out of range")
+        return int((self.words[index >> 6] >> np.uint64(index & 63)) & np.uint64(1))
+
+    def __eq__(self, other):
+        if isinstance(other, PackedFingerprint):
+            return self.length == other.length and np.array_equal(self.words, other.words)
+        if isinstance(other, bitarray):
+            return self == PackedFingerprint.from_bits(other)
+        return NotImplemented
+
+    def __ne__(self, other):
+        equal = self.__eq__(other)
+        return equal if equal is NotImplemented else not equal
+
+    def __hash__(self):
+        return hash((self.length, self.words.tobytes()))
+
+    def __getstate__(self):
+        return self.words, self.length, self._popcount
+
+    def __setstate__(self, state):
+        self.words, self.length, self._popcount = state
+
+    def __repr__(self):
+        return "PackedFingerprint(%i bits, %i set)" % (self.length, self.popcount)
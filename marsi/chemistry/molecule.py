@@ -20,12 +20,56 @@ from marsi.chemistry import rdkit
 VALID_FP_FORMATS = openbabel.fps + rdkit.fps
 
 
+def _ob_from_sdf(sdf):
+    ob_mol = openbabel.sdf_to_molecule(sdf, from_file=False)
+    ob_mol.title = ""
+    return ob_mol
+
+
+# Parsers of each backend by input format. They all take the molecule description as a string.
+_OB_PARSERS = {
+    'sdf': _ob_from_sdf,
+    'mol': lambda mol: openbabel.mol_to_molecule(mol, from_file=False),
+    'inchi': openbabel.inchi_to_molecule,
+    'smiles': openbabel.smiles_to_molecule,
+}
+
+_RD_PARSERS = {
+    'sdf': lambda sdf: rdkit.sdf_to_molecule(sdf, from_file=False),
+    'mol': lambda mol: rdkit.mol_to_molecule(mol, from_file=False),
+    'inchi': rdkit.inchi_to_molecule,
+    'smiles': rdkit.smiles_to_molecule,
+}
+
+
+def _read_description(path_or_str):
+    if os.path.isfile(path_or_str):
+        with open(path_or_str) as description_file:
+            return description_file.read()
+    return path_or_str
+
+
 class Molecule(object):
     """
     Object representing a molecule.
 
+    The Open Babel and RDKit molecules are built from the original description the first time they are used (so an
+    invalid description fails on first use). The identifiers, counts and fingerprints are computed once and kept in the
+    instance.
+
+    Parameters
+    ----------
+    ob_mol : pybel.Molecule
+        An Open Babel molecule (built from `description` if None).
+    rd_mol : rdkit.Chem.rdchem.Mol
+        A RDKit molecule (built from `description` if None).
+    description : tuple
+        The input format ('sdf', 'mol', 'inchi' or 'smiles') and the molecule description.
     """
 
+    __slots__ = ('_description', '_ob', '_rd', '_inchi', '_inchi_key', '_num_atoms', '_num_bonds', '_num_rings',
+                 '_fingerprints')
+
     @classmethod
     def from_sdf(cls, path_or_str):
         """
@@ -41,11 +85,7 @@ class Molecule(object):
         marsi.chemistry.molecule.Molecule
 
         """
-        from_file = os.path.isfile(path_or_str)
-        ob_mol = openbabel.sdf_to_molecule(path_or_str, from_file)
-        ob_mol.title = ""
-        rd_mol = rdkit.sdf_to_molecule(path_or_str, from_file)
-        return cls(ob_mol, rd_mol)
+        return cls(description=('sdf', _read_description(path_or_str)))
 
     @classmethod
     def from_inchi(cls, inchi):
@@ -62,9 +102,7 @@ class Molecule(object):
         marsi.chemistry.molecule.Molecule
 
         """
-        ob_mol = openbabel.inchi_to_molecule(inchi)
-        rd_mol = rdkit.inchi_to_molecule(inchi)
-        return cls(ob_mol, rd_mol)
+        return cls(description=('inchi', inchi))
 
     @classmethod
     def from_mol(cls, path_or_str):
@@ -81,52 +119,172 @@ class Molecule(object):
         marsi.chemistry.molecule.Molecule
 
         """
-        from_file = os.path.isfile(path_or_str)
-        ob_mol = openbabel.mol_to_molecule(path_or_str, from_file)
-        rd_mol = rdkit.mol_to_molecule(path_or_str, from_file)
-        return cls(ob_mol, rd_mol)
+        return cls(description=('mol', _read_description(path_or_str)))
 
-    def __init__(self, ob_mol, rd_mol):
-        self._ob_mol = ob_mol
-        self._rd_mol = rd_mol
+    @classmethod
+    def from_smiles(cls, smiles):
+        """
+        Builds a molecule from a SMILES string.
+
+        Parameters
+        ----------
+        smiles : str
+            A valid SMILES string.
+
+        Returns
+        -------
+        marsi.chemistry.molecule.Molecule
+
+        """
+        return cls(description=('smiles', smiles))
+
+    def __init__(self, ob_mol=None, rd_mol=None, description=None):
+        if description is None and (ob_mol is None or rd_mol is None):
+            raise ValueError("A description is needed to build the missing molecule")
+        self._description = description
+        self._ob = ob_mol
+        self._rd = rd_mol
+        self._inchi = None
+        self._inchi_key = None
+        self._num_atoms = None
+        self._num_bonds = None
+        self._num_rings = None
+        self._fingerprints = None
+
+    @property
+    def _ob_mol(self):
+        if self._ob is None:
+            file_format, description = self._description
+            self._ob = _OB_PARSERS[file_format](description)
+        return self._ob
+
+    @property
+    def _rd_mol(self):
+        if self._rd is None:
+            file_format, description = self._description
+            self._rd = _RD_PARSERS[file_format](description)
+        return self._rd
 
     @property
     def inchi(self):
-        return openbabel.mol_to_inchi(self._ob_mol)
+        if self._inchi is None:
+            self._inchi = openbabel.mol_to_inchi(self._ob_mol)
+        return self._inchi
 
     @property
     def inchi_key(self):
-        return openbabel.mol_to_inchi_key(self._ob_mol)
+        if self._inchi_key is None:
+            self._inchi_key = openbabel.mol_to_inchi_key(self._ob_mol)
+        return self._inchi_key
 
     @property
     def num_atoms(self):
-        return self._ob_mol.OBMol.NumAtoms()
+        if self._num_atoms is None:
+            self._num_atoms = self._ob_mol.OBMol.NumAtoms()
+        return self._num_atoms
 
     @property
     def num_bonds(self):
-        return self._ob_mol.OBMol.NumBonds()
+        if self._num_bonds is None:
+            self._num_bonds = self._ob_mol.OBMol.NumBonds()
+        return self._num_bonds
 
     @property
     def num_rings(self):
-        return len(self._ob_mol.OBMol.GetLSSR())
+        if self._num_rings is None:
+            self._num_rings = len(self._ob_mol.OBMol.GetLSSR())
+        return self._num_rings
 
     def fingerprint(self, fpformat='maccs', bits=None):
         if fpformat not in VALID_FP_FORMATS:
             raise ValueError("Fingerprint '%s' is not valid. Use of of %s" % (fpformat, ", ".join(VALID_FP_FORMATS)))
 
-        if fpformat in openbabel.fps:
-            fp = openbabel.fingerprint(self._ob_mol, fpformat)
-            bits = openbabel.fp_bits.get(fpformat, max(fp.bits))
-            return openbabel.fingerprint_to_bits(fp, bits=bits)
-        else:
-            fp = rdkit.fingerprint(self._rd_mol, fpformat)
-            if bits is None:
-                bits = fp.GetNumBits()
+        if self._fingerprints is None:
+            self._fingerprints = {}
+        key = (fpformat, bits)
+        if key not in self._fingerprints:
+            if fpformat in openbabel.fps:
+                fp = openbabel.fingerprint(self._ob_mol, fpformat)
+                if bits is None:
+                    bits = openbabel.fp_bits.get(fpformat, 2048)
+                self._fingerprints[key] = openbabel.fingerprint_to_bits(fp, bits=bits)
+            else:
+                fp = rdkit.fingerprint(self._rd_mol, fpformat)
+                if bits is None:
+                    bits = fp.GetNumBits()
+                self._fingerprints[key] = rdkit.fingerprint_to_bits(fp, bits=bits)
 
-            return rdkit.fingerprint_to_bits(fp, bits=bits)
+        return self._fingerprints[key]
 
     def _repr_html_(self):
-        self._ob_mol.removeh()
-        representation = self._ob_mol._repr_html_() or openbabel.mol_to_svg(self._ob_mol)
-        self._ob_mol.addh()
+        ob_mol = self._ob_mol
+        ob_mol.removeh()
+        representation = ob_mol._repr_html_() or openbabel.mol_to_svg(ob_mol)
+        ob_mol.addh()
         return representation
+
+
+MOLECULE_FILE_FORMATS = ('sdf', 'smiles', 'inchi')
+
+
+def _sdf_records(path):
+    record = []
+    with open(path) as sdf_file:
+        for line in sdf_file:
+            record.append(line)
+            if line.startswith("$$$$"):
+                yield "".join(record)
+                record = []
+    if len(record) > 0 and "".join(record).strip():
+        yield "".join(record)
+
+
+def _line_records(path):
+    # One molecule per line, optionally followed by a name (e.g. SMILES files).
+    with open(path) as text_file:
+        for number, line in enumerate(text_file, 1):
+            fields = line.split()
+            if len(fields) == 0 or fields[0].startswith("#"):
+                continue
+            yield fields[0], " ".join(fields[1:]) or str(number)
+
+
+def read_molecules(path, file_format='sdf'):
+    """
+    Reads the molecules of a file with many records. Records that cannot be parsed are reported and skipped.
+
+    Parameters
+    ----------
+    path : str
+        The input file name.
+    file_format : str
+        'sdf' (multi-record SDF), 'smiles' or 'inchi' (one molecule per line, optionally followed by a name).
+
+    Returns
+    -------
+    generator
+        Yields the name and the Molecule of each record.
+    """
+    if file_format == 'sdf':
+        for number, record in enumerate(_sdf_records(path), 1):
+            name = record.split("\n", 1)[0].strip() or str(number)
+            try:
+                molecule = Molecule.from_sdf(record)
+                molecule.inchi_key
+            except Exception as e:
+                print("Cannot read molecule %s: %s" % (name, e))
+            else:
+                yield name, molecule
+    elif file_format in ('smiles', 'inchi'):
+        parse = Molecule.from_smiles if file_format == 'smiles' else Molecule.from_inchi
+        for description, name in _line_records(path):
+            try:
+                molecule = parse(description)
+                molecule.inchi_key
+            except Exception as e:
+                print("Cannot read molecule %s: %s" % (name, e))
+            else:
+                yield name, molecule
+    else:
+        raise ValueError("Invalid file format: %s, please choose one of %s" %
+                         (file_format, ", ".join(MOLECULE_FILE_FORMATS)))
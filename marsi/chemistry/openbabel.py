@@ -11,16 +11,15 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
-import time
 
 import numpy as np
 import pybel
-from bitarray import bitarray
 
 from marsi.chemistry.common import inchi_key_lru_cache
+from marsi.chemistry.fingerprint import PackedFingerprint
 
 from cachetools import cached, LRUCache
-from marsi.chemistry.common import convex_hull_volume, monte_carlo_volume as mc_vol
+from marsi.chemistry.common import convex_hull_volume, molecular_volume, monte_carlo_volumes as mc_vols
 
 
 lru_cache = LRUCache(maxsize=256)
@@ -28,7 +27,8 @@ lru_cache = LRUCache(maxsize=256)
 
 __all__ = ['has_radical', 'mol_to_inchi', 'mol_to_inchi_key', 'mol_to_svg', 'mol_chebi_id', 'mol_drugbank_id',
            'mol_pubchem_id', 'mol_str_to_inchi', 'align_molecules', 'inchi_to_molecule', 'smiles_to_molecule',
-           'fingerprint', 'fingerprint_to_bits', 'get_spectrophore_data', 'inchi_to_inchi_key', 'solubility']
+           'fingerprint', 'fingerprint_to_bits', 'get_spectrophore_data', 'inchi_to_inchi_key', 'solubility',
+           'monte_carlo_volume', 'monte_carlo_volumes', 'copy_molecule']
 
 fps = pybel.fps
 
@@ -255,6 +255,23 @@ def sdf_to_molecule(from_file_or_molecule_desc, from_file=True):
     return mol
 
 
+def copy_molecule(molecule):
+    """
+    Makes an independent copy of a pybel.Molecule.
+
+    Parameters
+    ----------
+    molecule : pybel.Molecule
+        A molecule.
+
+    Returns
+    -------
+    pybel.Molecule
+        A copy of the molecule.
+    """
+    return pybel.Molecule(pybel.ob.OBMol(molecule.OBMol))
+
+
 def molecule_to_sdf(molecule):
     """
     Makes an SDF from a pybel.Molecule.
@@ -335,7 +352,7 @@ def smiles_to_molecule(smiles):
 
 def fingerprint_to_bits(fp, bits=1024):
     """
-    Converts a pybel.Fingerprint into a binary array
+    Converts a pybel.Fingerprint into a packed binary fingerprint, directly from its 32-bit words.
 
     Parameters
     ----------
@@ -346,16 +363,10 @@ def fingerprint_to_bits(fp, bits=1024):
         Number of bits (default is 1024)
     Returns
     -------
-    bitarray
-        An array of 0's and 1's.
+    PackedFingerprint
+        The fingerprint bits.
     """
-    bits_list = bitarray(bits)
-    bits_list.setall(0)
-    for i in fp.bits:
-        if i <= bits:
-            bits_list[i - 1] = 1
-
-    return bits_list
+    return PackedFingerprint.from_words32(fp.fp, bits)
 
 
 def align_molecules(reference, molecule, include_h=True, symmetry=True):
@@ -461,8 +472,20 @@ def molecule_convex_hull_volume(molecule, forcefield='mmff94', steps=100):
     return convex_hull_volume(xyz)
 
 
+def _volume_inputs(molecule, coordinates, forcefield, steps):
+    assert isinstance(molecule, pybel.Molecule)
+    if coordinates is None:
+        if molecule.dim < 3:
+            molecule.make3D(forcefield=forcefield, steps=steps)
+        coordinates = np.array([a.coords for a in molecule.atoms], dtype=np.float32)
+    else:
+        coordinates = np.array(coordinates, dtype=np.float32)
+    vdw_radii = np.array([pybel.ob.etab.GetVdwRad(a.atomicnum) for a in molecule.atoms], dtype=np.float32)
+    return coordinates, vdw_radii
+
+
 def monte_carlo_volume(molecule, coordinates=None, tolerance=1, max_iterations=10000, step_size=1000,
-                       seed=time.time(), verbose=False, forcefield='mmff94', steps=100):
+                       seed=0, verbose=False, forcefield='mmff94', steps=100, method='monte_carlo'):
     """
     Adapted from:
 
@@ -483,14 +506,16 @@ def monte_carlo_volume(molecule, coordinates=None, tolerance=1, max_iterations=1
         Number of iterations before the algorithm starts
     step_size : int
         Number of points to add each step.
-    seed : object
-        A valid seed for random.
+    seed : int
+        The seed of the random points (None for a random seed).
     verbose : bool
         Print debug information if True.
     forcefield : str
         The force field to get a 3D molecule. (only if it is not 3D already)
     steps : int
         The number of steps used for the force field to get a 3D molecule. (only if it is not 3D already)
+    method : str
+        'monte_carlo' or 'quasi_monte_carlo' (low-discrepancy points, see `marsi.chemistry.common.molecular_volume`).
 
     Returns
     -------
@@ -498,12 +523,43 @@ def monte_carlo_volume(molecule, coordinates=None, tolerance=1, max_iterations=1
         Molecule volume.
     """
 
-    assert isinstance(molecule, pybel.Molecule)
-    if coordinates is None:
-        if molecule.dim < 3:
-            molecule.make3D(forcefield=forcefield, steps=steps)
-        coordinates = np.array([a.coords for a in molecule.atoms], dtype=np.float32)
-    else:
-        coordinates = np.array(coordinates, dtype=np.float32)
-    vdw_radii = np.array([pybel.ob.etab.GetVdwRad(a.atomicnum) for a in molecule.atoms], dtype=np.float32)
-    return mc_vol(coordinates, vdw_radii, tolerance, max_iterations, step_size, seed, int(verbose))
+    coordinates, vdw_radii = _volume_inputs(molecule, coordinates, forcefield, steps)
+    return molecular_volume(coordinates, vdw_radii, method=method, tolerance=tolerance, max_iterations=max_iterations,
+                            step_size=step_size, seed=seed, verbose=verbose)
+
+
+def monte_carlo_volumes(molecules, tolerance=1, max_iterations=10000, step_size=1000, seed=0, threads=None,
+                        forcefield='mmff94', steps=100, method='monte_carlo'):
+    """
+    Estimates the volume of many molecules with `monte_carlo_volume`, in parallel threads.
+
+    Parameters
+    ----------
+    molecules : list
+        Molecules from pybel.
+    tolerance : float
+        The tolerance for convergence of the monte carlo abs(new_volume - volume) < tolerance
+    max_iterations : int
+        Number of iterations before the algorithm starts
+    step_size : int
+        Number of points to add each step.
+    seed : int
+        The seed of the random points of each molecule.
+    threads : int
+        The number of threads (defaults to the number of CPUs).
+    method : str
+        'monte_carlo' or 'quasi_monte_carlo'.
+    forcefield : str
+        The force field to get a 3D molecule. (only if it is not 3D already)
+    steps : int
+        The number of steps used for the force field to get a 3D molecule. (only if it is not 3D already)
+
+    Returns
+    -------
+    ndarray
+        The volume of each molecule.
+    """
+    inputs = [_volume_inputs(molecule, None, forcefield, steps) for molecule in molecules]
+    return mc_vols([coordinates for coordinates, _ in inputs], [vdw_radii for _, vdw_radii in inputs],
+                   tolerance=tolerance, max_iterations=max_iterations, step_size=step_size, seed=seed, threads=threads,
+                   method=method)
@@ -15,17 +15,22 @@
 from __future__ import absolute_import
 
 import math
-import time
+from collections import namedtuple
 
 import numpy as np
 import rdkit
-from bitarray import bitarray
 from cachetools import cached, LRUCache
-from rdkit import Chem
-from rdkit.Chem import AllChem, MACCSkeys, MCS
+from rdkit import Chem, DataStructs
+from rdkit.Chem import AllChem, MACCSkeys, rdFMCS
 from rdkit.Chem.SaltRemover import SaltRemover
 
-from marsi.chemistry.common import monte_carlo_volume as mc_vol, inchi_key_lru_cache
+try:
+    from rdkit.Chem import MCS
+except ImportError:  # pragma: no cover
+    MCS = None
+
+from marsi.chemistry.common import molecular_volume, monte_carlo_volumes as mc_vols, inchi_key_lru_cache
+from marsi.chemistry.fingerprint import PackedFingerprint
 
 
 lru_cache = LRUCache(maxsize=256)
@@ -35,6 +40,18 @@ salt_remove = SaltRemover(defnData="[Li,K,Rb,Cs,Fr,Be,Mg,Ca,Sr,Ba,Ra,F,Cl,Br]")
 
 fps = ["maccs", "morgan2", "morgan3", "morgan4", "morgan5"]
 
+# Maximum Common Substructure engines: 'fmcs' (C++) or 'legacy' (rdkit.Chem.MCS, pure python).
+MCS_BACKENDS = ("fmcs", "legacy")
+
+# Atoms and bonds of any type match in the MCS.
+MCS_ATOM_COMPARE = "any"
+MCS_BOND_COMPARE = "any"
+
+MCSResult = namedtuple("MCSResult", ["numAtoms", "numBonds", "smarts", "completed"])
+
+# MCS results by `mcs_cache_key` (only complete results are kept).
+mcs_cache = LRUCache(maxsize=100000)
+
 
 @cached(lru_cache)
 def inchi_to_molecule(inchi):
@@ -59,6 +76,30 @@ def inchi_to_molecule(inchi):
     return mol
 
 
+def smiles_to_molecule(smiles):
+    """
+    Returns a molecule from a SMILES string.
+
+    Parameters
+    ----------
+    smiles : str
+        A valid SMILES string.
+
+    Returns
+    -------
+    rdkit.Chem.rdchem.Mol
+        A molecule.
+    """
+    mol = Chem.MolFromSmiles(smiles)
+    if mol is None:
+        raise ValueError("Invalid SMILES: %s" % smiles)
+    mol = salt_remove.StripMol(mol, dontRemoveEverything=True)
+    Chem.Kekulize(mol)
+    mol = Chem.AddHs(mol)
+
+    return mol
+
+
 def mol_to_molecule(file_or_molecule_desc, from_file=True):
     """
     Returns a molecule from a MOL file.
@@ -85,6 +126,23 @@ def mol_to_molecule(file_or_molecule_desc, from_file=True):
     return mol
 
 
+def copy_molecule(molecule):
+    """
+    Makes an independent copy of a molecule (with its conformers).
+
+    Parameters
+    ----------
+    molecule : rdkit.Chem.rdchem.Mol
+        A molecule.
+
+    Returns
+    -------
+    rdkit.Chem.rdchem.Mol
+        A copy of the molecule.
+    """
+    return Chem.Mol(molecule)
+
+
 def sdf_to_molecule(file_or_molecule_desc, from_file=True):
     """
     Returns a molecule from a SDF file.
@@ -205,7 +263,7 @@ def fingerprint(molecule, fpformat='maccs'):
 
 def fingerprint_to_bits(fp, bits=1024):
     """
-    Converts a pybel.Fingerprint into a binary array
+    Converts a RDKit fingerprint into a packed binary fingerprint.
 
     Parameters
     ----------
@@ -215,19 +273,59 @@ def fingerprint_to_bits(fp, bits=1024):
         Number of bits (default is 1024)
     Returns
     -------
-    bitarray
+    PackedFingerprint
+        The fingerprint bits.
     """
-    bits_list = bitarray(bits)
-    bits_list.setall(0)
+    fp_bits = np.zeros(0, dtype=np.int8)
+    DataStructs.ConvertToNumpyArray(fp, fp_bits)
+    fp_bits = fp_bits[:bits]
+    if len(fp_bits) < bits:
+        fp_bits = np.concatenate([fp_bits, np.zeros(bits - len(fp_bits), dtype=np.int8)])
+    return PackedFingerprint.from_bits(fp_bits)
 
-    for i in range(fp.GenNumBits()):
-        if fp.GetBit(i):
-            bits_list[i - 1] = 1
 
-    return bits_list
+def mcs_cache_key(reference_key, molecule_key, match_rings=True):
+    """
+    Returns the key of the MCS between two molecules in `mcs_cache` (the MCS does not depend on the molecules order).
+
+    Parameters
+    ----------
+    reference_key : str
+        The InChI Key of a molecule.
+    molecule_key : str
+        The InChI Key of another molecule.
+    match_rings : bool
+        Force ring structure to match.
+
+    Returns
+    -------
+    tuple
+    """
+    first, second = sorted((reference_key, molecule_key))
+    return first, second, bool(match_rings), MCS_ATOM_COMPARE, MCS_BOND_COMPARE
+
+
+def _find_mcs(reference, molecule, match_rings, timeout, backend):
+    if backend == "fmcs":
+        result = rdFMCS.FindMCS([reference, molecule], ringMatchesRingOnly=match_rings,
+                                atomCompare=rdFMCS.AtomCompare.CompareAny,
+                                bondCompare=rdFMCS.BondCompare.CompareAny,
+                                timeout=int(math.ceil(timeout)) if timeout is not None else 3600)
+        return MCSResult(result.numAtoms, result.numBonds, result.smartsString or None, not result.canceled)
+    elif backend == "legacy":
+        if MCS is None:
+            raise ValueError("The legacy MCS backend (rdkit.Chem.MCS) is not available in this RDKit version")
+        result = MCS.FindMCS([reference, molecule], ringMatchesRingOnly=match_rings, timeout=timeout,
+                             atomCompare=MCS_ATOM_COMPARE, bondCompare=MCS_BOND_COMPARE)
+        if result.smarts is None:
+            return MCSResult(0, 0, None, result.completed)
+        return MCSResult(result.numAtoms, result.numBonds, result.smarts, result.completed)
+    else:
+        raise ValueError("Invalid MCS backend: %s, please choose one of %s" % (backend, ", ".join(MCS_BACKENDS)))
 
 
-def maximum_common_substructure(reference, molecule, match_rings=True, match_fraction=0.6, timeout=None):
+def maximum_common_substructure(reference, molecule, match_rings=True, match_fraction=0.6, timeout=None,
+                                backend="fmcs", cache=None, cache_key=None):
     """
     Returns the Maximum Common Substructure (MCS) between two molecules.
 
@@ -243,19 +341,38 @@ def maximum_common_substructure(reference, molecule, match_rings=True, match_fra
         Match is fraction of the reference atoms (default: 0.6)
     timeout: int
         Time out in seconds.
+    backend : str
+        The MCS engine, 'fmcs' (default) or 'legacy'.
+    cache : dict
+        Complete MCS results by `mcs_cache_key` (e.g. `mcs_cache`), used and updated when given.
+    cache_key : tuple
+        The InChI Keys of reference and molecule (computed when not given).
+
     Returns
     -------
-    rdkit.Chem.MCS.MCSResult
-        Maximum Common Substructure result.
+    MCSResult
+        Maximum Common Substructure result (no atoms or bonds if it has less than `match_fraction` of the reference
+        atoms).
     """
 
     assert isinstance(reference, rdkit.Chem.rdchem.Mol)
 
-    min_num_atoms = math.ceil(reference.GetNumAtoms()) * match_fraction
+    result = None
+    if cache is not None:
+        if cache_key is None:
+            cache_key = Chem.MolToInchiKey(reference), Chem.MolToInchiKey(molecule)
+        cache_key = mcs_cache_key(cache_key[0], cache_key[1], match_rings)
+        result = cache.get(cache_key)
 
-    return MCS.FindMCS([reference, molecule], ringMatchesRingOnly=match_rings,
-                        minNumAtoms=min_num_atoms, timeout=timeout,
-                        atomCompare="any", bondCompare="any")
+    if result is None:
+        result = _find_mcs(reference, molecule, match_rings, timeout, backend)
+        if cache is not None and result.completed:
+            cache[cache_key] = result
+
+    min_num_atoms = math.ceil(reference.GetNumAtoms()) * match_fraction
+    if result.numAtoms < min_num_atoms:
+        return MCSResult(0, 0, None, result.completed)
+    return result
 
 
 def mcs_similarity(mcs_result, molecule, atoms_weight=0.5, bonds_weight=0.5):
@@ -267,7 +384,7 @@ def mcs_similarity(mcs_result, molecule, atoms_weight=0.5, bonds_weight=0.5):
 
     Parameters
     ----------
-    mcs_result : rdkit.Chem.MCS.MCSResult
+    mcs_result : MCSResult
         The result of a Maximum Common Substructure run.
     molecule : rdkit.Chem.Mol
         A molecule.
@@ -281,7 +398,7 @@ def mcs_similarity(mcs_result, molecule, atoms_weight=0.5, bonds_weight=0.5):
         Similarity value
     """
 
-    assert isinstance(mcs_result, MCS.MCSResult)
+    assert isinstance(mcs_result, MCSResult)
     assert isinstance(molecule, Chem.rdchem.Mol)
 
     atoms_score = atoms_weight * (float(mcs_result.numAtoms) / float(molecule.GetNumAtoms()))
@@ -292,8 +409,52 @@ def mcs_similarity(mcs_result, molecule, atoms_weight=0.5, bonds_weight=0.5):
     return atoms_score + bonds_score
 
 
-def structural_similarity(reference, molecule, atoms_weight=0.5, bonds_weight=0.5,
-                          match_rings=True, match_fraction=0.6, timeout=None):
+def _mcs_similarity_from_counts(num_atoms, num_bonds, mcs_atoms, mcs_bonds, atoms_weight, bonds_weight):
+    atoms_score = atoms_weight * (float(mcs_atoms) / float(num_atoms)) if num_atoms > 0 else .0
+    bonds_score = bonds_weight * (float(mcs_bonds) / float(num_bonds)) if num_bonds > 0 else .0
+    return atoms_score + bonds_score
+
+
+def structural_similarity_bound(reference, molecule, atoms_weight=0.5, bonds_weight=0.5):
+    """
+    Returns an upper bound of `structural_similarity` computed from the number of atoms and bonds (no MCS).
+
+    The MCS cannot have more atoms or bonds than the smallest molecule and, because it is connected, it has at most one
+    atom more than bonds. Atoms and bonds of any type match (see `maximum_common_substructure`), so element counts do
+    not make the bound tighter.
+
+    Parameters
+    ----------
+    reference : rdkit.Chem.Mol
+        A molecule.
+    molecule : rdkit.Chem.Mol
+        Another molecule.
+    atoms_weight : float
+        How much similar atoms matter.
+    bonds_weight : float
+        How much similar bonds matter.
+
+    Returns
+    -------
+    float
+        A value greater than or equal to the structural similarity between reference and molecule.
+    """
+    reference = Chem.RemoveHs(reference, implicitOnly=True, updateExplicitCount=True)
+    molecule = Chem.RemoveHs(molecule, implicitOnly=True, updateExplicitCount=True)
+
+    ref_atoms, ref_bonds = reference.GetNumAtoms(), reference.GetNumBonds()
+    mol_atoms, mol_bonds = molecule.GetNumAtoms(), molecule.GetNumBonds()
+
+    mcs_bonds = min(ref_bonds, mol_bonds)
+    mcs_atoms = min(ref_atoms, mol_atoms, mcs_bonds + 1)
+
+    ref_similarity = _mcs_similarity_from_counts(ref_atoms, ref_bonds, mcs_atoms, mcs_bonds, atoms_weight, bonds_weight)
+    mol_similarity = _mcs_similarity_from_counts(mol_atoms, mol_bonds, mcs_atoms, mcs_bonds, atoms_weight, bonds_weight)
+    return ref_similarity * mol_similarity
+
+
+def structural_similarity(reference, molecule, atoms_weight=0.5, bonds_weight=0.5, match_rings=True,
+                          match_fraction=0.6, timeout=None, backend="fmcs", cache=None, cache_key=None):
     """
     Returns a structural similarity based on the Maximum Common Substructure (MCS) between two molecules.
 
@@ -315,6 +476,12 @@ def structural_similarity(reference, molecule, atoms_weight=0.5, bonds_weight=0.
         Match is fraction of the reference atoms (default: 0.6).
     timeout : int
         Time out in seconds.
+    backend : str
+        The MCS engine, 'fmcs' (default) or 'legacy'.
+    cache : dict
+        MCS results cache (see `maximum_common_substructure`).
+    cache_key : tuple
+        The InChI Keys of reference and molecule.
 
     Returns
     -------
@@ -326,15 +493,40 @@ def structural_similarity(reference, molecule, atoms_weight=0.5, bonds_weight=0.
     molecule = Chem.RemoveHs(molecule, implicitOnly=True, updateExplicitCount=True)
 
     mcs_res = maximum_common_substructure(reference, molecule, match_rings=match_rings,
-                                          match_fraction=match_fraction, timeout=timeout)
+                                          match_fraction=match_fraction, timeout=timeout, backend=backend,
+                                          cache=cache, cache_key=cache_key)
 
     ref_similarity = mcs_similarity(mcs_res, reference, atoms_weight=atoms_weight, bonds_weight=bonds_weight)
     mol_similarity = mcs_similarity(mcs_res, molecule, atoms_weight=atoms_weight, bonds_weight=bonds_weight)
     return ref_similarity * mol_similarity
 
 
+def _volume_inputs(molecule, coordinates):
+    assert isinstance(molecule, rdkit.Chem.rdchem.Mol)
+    if coordinates is None:
+        if len(molecule.GetConformers()) == 0:
+            AllChem.EmbedMolecule(molecule)
+            AllChem.UFFOptimizeMolecule(molecule)
+
+        conformer = molecule.GetConformer(0)
+        coordinates = []
+
+        for index, atom in enumerate(molecule.GetAtoms()):
+            pos = tuple(conformer.GetAtomPosition(index))
+            coordinates.append(pos)
+
+    vdw_radii = []
+    for index, atom in enumerate(molecule.GetAtoms()):
+        radius = periodic_table.GetRvdw(atom.GetAtomicNum())
+        vdw_radii.append(radius)
+
+    coordinates = np.array(coordinates, dtype=np.float32)
+    vdw_radii = np.array(vdw_radii, dtype=np.float32)
+    return coordinates, vdw_radii
+
+
 def monte_carlo_volume(molecule, coordinates=None, tolerance=1, max_iterations=10000, step_size=1000,
-                       seed=time.time(), verbose=False, forcefield='mmff94', steps=100):
+                       seed=0, verbose=False, forcefield='mmff94', steps=100, method='monte_carlo'):
     """
     Adapted from:
 
@@ -355,14 +547,16 @@ def monte_carlo_volume(molecule, coordinates=None, tolerance=1, max_iterations=1
         Number of iterations before the algorithm starts.
     step_size : int
         Number of points to add each step.
-    seed : object
-        A valid seed for random.
+    seed : int
+        The seed of the random points (None for a random seed).
     verbose : bool
         Print debug information if True.
     forcefield : str
         The force field to get a 3D molecule. (only if it is not 3D already)
     steps : int
         The number of steps used for the force field to get a 3D molecule. (only if it is not 3D already)
+    method : str
+        'monte_carlo' or 'quasi_monte_carlo' (low-discrepancy points, see `marsi.chemistry.common.molecular_volume`).
 
     Returns
     -------
@@ -370,24 +564,73 @@ def monte_carlo_volume(molecule, coordinates=None, tolerance=1, max_iterations=1
         Molecule volume
     """
 
-    assert isinstance(molecule, rdkit.Chem.rdchem.Mol)
-    if coordinates is None:
-        if len(molecule.GetConformers()) == 0:
-            AllChem.EmbedMolecule(molecule)
-            AllChem.UFFOptimizeMolecule(molecule)
+    coordinates, vdw_radii = _volume_inputs(molecule, coordinates)
+    return molecular_volume(coordinates, vdw_radii, method=method, tolerance=tolerance, max_iterations=max_iterations,
+                            step_size=step_size, seed=seed, verbose=verbose)
 
-        conformer = molecule.GetConformer(0)
-        coordinates = []
 
-        for index, atom in enumerate(molecule.GetAtoms()):
-            pos = tuple(conformer.GetAtomPosition(index))
-            coordinates.append(pos)
+def monte_carlo_volumes(molecules, tolerance=1, max_iterations=10000, step_size=1000, seed=0, threads=None,
+                        method='monte_carlo'):
+    """
+    Estimates the volume of many molecules with `monte_carlo_volume`, in parallel threads.
 
-    vdw_radii = []
-    for index, atom in enumerate(molecule.GetAtoms()):
-        radius = periodic_table.GetRvdw(atom.GetAtomicNum())
-        vdw_radii.append(radius)
+    Parameters
+    ----------
+    molecules : list
+        Molecules from rdkit.
+    tolerance : float
+        The tolerance for convergence of the monte carlo abs(new_volume - volume) < tolerance
+    max_iterations : int
+        Number of iterations before the algorithm starts.
+    step_size : int
+        Number of points to add each step.
+    seed : int
+        The seed of the random points of each molecule.
+    threads : int
+        The number of threads (defaults to the number of CPUs).
+    method : str
+        'monte_carlo' or 'quasi_monte_carlo'.
 
-    coordinates = np.array(coordinates, dtype=np.float32)
-    vdw_radii = np.array(vdw_radii, dtype=np.float32)
-    return mc_vol(coordinates, vdw_radii, tolerance, max_iterations, step_size, seed, int(verbose))
+    Returns
+    -------
+    ndarray
+        The volume of each molecule.
+    """
+    inputs = [_volume_inputs(molecule, None) for molecule in molecules]
+    return mc_vols([coordinates for coordinates, _ in inputs], [vdw_radii for _, vdw_radii in inputs],
+                   tolerance=tolerance, max_iterations=max_iterations, step_size=step_size, seed=seed, threads=threads,
+                   method=method)
+
+
+def conformer_volumes(molecule, tolerance=1, max_iterations=10000, step_size=1000, seed=0, threads=None,
+                      method='monte_carlo'):
+    """
+    Estimates the volume of each conformer of a molecule.
+
+    Parameters
+    ----------
+    molecule : rdkit.Chem.rdchem.Mol
+        A molecule from rdkit with conformers (e.g. from AllChem.EmbedMultipleConfs).
+    tolerance : float
+        The tolerance for convergence.
+    max_iterations : int
+        Number of iterations before the algorithm starts.
+    step_size : int
+        Number of points to add each step.
+    seed : int
+        The seed of the random points of each conformer.
+    threads : int
+        The number of threads (defaults to the number of CPUs).
+    method : str
+        'monte_carlo' or 'quasi_monte_carlo'.
+
+    Returns
+    -------
+    ndarray
+        The volume of each conformer.
+    """
+    assert isinstance(molecule, rdkit.Chem.rdchem.Mol)
+    coordinates = np.array([conformer.GetPositions() for conformer in molecule.GetConformers()], dtype=np.float32)
+    _, vdw_radii = _volume_inputs(molecule, np.zeros((molecule.GetNumAtoms(), 3)))
+    return mc_vols(coordinates, vdw_radii, tolerance=tolerance, max_iterations=max_iterations, step_size=step_size,
+                   seed=seed, threads=threads, method=method)
@@ -17,6 +17,7 @@ from marsi.cli.controllers import MarsiBaseController
 from marsi.cli.controllers.chemistry import ChemistryController
 from marsi.cli.controllers.database import DatabaseController
 from marsi.cli.controllers.modeling import OptimizationController
+from marsi.cli.controllers.server import ServerController
 
 
 class MarsiApp(CementApp):
@@ -27,7 +28,8 @@ class MarsiApp(CementApp):
             MarsiBaseController,
             DatabaseController,
             OptimizationController,
-            ChemistryController
+            ChemistryController,
+            ServerController
         ]
 
 
@@ -11,17 +11,23 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+import itertools
+from collections import OrderedDict
+
+from cameo.io import load_model
 from cement.core.controller import CementBaseController, expose
+from pandas import DataFrame, concat
 
 from marsi.chemistry.common import dynamic_fingerprint_cut
-from marsi.chemistry.molecule import Molecule
+from marsi.chemistry.molecule import Molecule, read_molecules, MOLECULE_FILE_FORMATS
 from marsi.io import write_excel_file
-from marsi.nearest_neighbors import search_closest_compounds
+from marsi.nearest_neighbors import search_closest_compounds, iter_closest_compounds_batch, COLUMNS
+from marsi.nearest_neighbors.server import connect
 
 OUTPUT_WRITERS = {
     'csv': lambda df, path, *args: df.to_csv(path),
-    'excel': lambda df, path, *args: write_excel_file(df, path)
-
+    'excel': lambda df, path, *args: write_excel_file(df, path),
+    'parquet': lambda df, path, *args: df.to_parquet(path)
 }
 
 
@@ -40,18 +46,25 @@ class ChemistryController(CementBaseController):
             (['--inchi'], dict(help="The metabolite InChI to search")),
             (['--sdf'], dict(help="The metabolite SDF to search")),
             (['--mol'], dict(help="The metabolite MOL to search")),
+            (['--queries'], dict(help="A file with the metabolites to search (find_analogs_batch)")),
+            (['--queries-format'], dict(help="The format of --queries (default: sdf)", default='sdf',
+                                        choices=list(MOLECULE_FILE_FORMATS) + ['model'])),
             (['--fingerprint-format', '-fp'], dict(help="The fingerprint format", default='maccs', action='store')),
+            (['--search-mode', '-sm'], dict(help="Fingerprint search mode: native (exact) or lsh (approximate)",
+                                            default='native', choices=['native', 'lsh'], action='store')),
             (['--fingerprint-cutoff', '-fpcut'], dict(help="Fingerprint cutoff", default='dynamic', action='store')),
             (['--similarity-cutoff', '-scut'], dict(help="Similarity cutoff", default=None, action='store')),
-            (['--neighbors', '-k'], dict(help="Filter the first K hits")),
+            (['--neighbors', '-k'], dict(help="Keep the K hits with the highest similarity")),
             (['--radius', '-r'], dict(help="Filter hits within R distance radius")),
+            (['--deadline', '-dl'], dict(help="Time budget in seconds (of each query in find_analogs_batch), the hits "
+                                              "scored so far are returned")),
             (['--atoms-weight', '-aw'], dict(help="The weight of the atoms for structural similarity")),
             (['--bonds-weight', '-bw'], dict(help="The weight of the bonds for structural similarity")),
             (['--atoms-diff', '-ad'], dict(help="The maximum number of the atoms difference for database query")),
             (['--bonds-diff', '-bd'], dict(help="The maximum number of the bonds difference for database query")),
             (['--rings-diff', '-rd'], dict(help="The maximum number of the rings difference for database query")),
             (['--output-file', '-o'], dict(help="Output file")),
-            (['--output-format', '-f'], dict(help='Output format (default: csv)', default='csv'))
+            (['--output-format', '-f'], dict(help='Output format: csv, excel or parquet (default: csv)', default='csv'))
         ]
 
     @expose(hide=True)
@@ -59,28 +72,22 @@ class ChemistryController(CementBaseController):
         print("Welcome to MARSI chemistry package")
         print("Here you can find the tools to find and sort analogs for metabolites")
 
-    @expose(help="Find analogs for a metabolite")
-    def find_analogs(self):
-        """
-        1. Make a fingerprint from the --inchi, --sdf or --mol.
-        2. Query the database
-
-        Returns
-        -------
-
-        """
-        output_file = None
-
-        if self.app.pargs.output_file is not None:
-            output_file = self.app.pargs.output_file
-        else:
+    def _output_file(self):
+        if self.app.pargs.output_file is None:
             print("--output-file argument is required")
             exit(1)
 
-        output_file += ".%s" % self.app.pargs.output_format
+        if self.app.pargs.output_format not in OUTPUT_WRITERS:
+            print("Invalid output format '%s'. It must be one of %s" % (self.app.pargs.output_format,
+                                                                        ", ".join(OUTPUT_WRITERS)))
+            exit(1)
 
-        molecule = None
+        return self.app.pargs.output_file + ".%s" % self.app.pargs.output_format
 
+    def _search_options(self):
+        """
+        The search_closest_compounds arguments from the command line (fp_cut can be 'dynamic').
+        """
         bonds_weight = 0.5
         atoms_weight = 0.5
         bonds_diff = 3
@@ -104,21 +111,7 @@ class ChemistryController(CementBaseController):
         if self.app.pargs.rings_diff is not None:
             rings_diff = float(self.app.pargs.rings_diff)
 
-        if self.app.pargs.inchi is not None:
-            molecule = Molecule.from_inchi(self.app.pargs.inchi)
-        elif self.app.pargs.sdf is not None:
-            molecule = Molecule.from_sdf(self.app.pargs.sdf)
-        elif self.app.pargs.mol is not None:
-            molecule = Molecule.from_mol(self.app.pargs.mol)
-        else:
-            print("Please provide one of the following inputs --inchi, --sdf or --mol")
-            exit(1)
-
-        print("Molecule processed!\nInChI key %s" % molecule.inchi_key)
-
-        if fp_cut == 'dynamic':
-            fp_cut = dynamic_fingerprint_cut(molecule.num_atoms)
-        else:
+        if fp_cut != 'dynamic':
             try:
                 fp_cut = float(fp_cut)
                 if fp_cut == 0 or fp_cut > 1:
@@ -128,15 +121,6 @@ class ChemistryController(CementBaseController):
                 print("Invalid fingerprint cutoff '%s'. It must be 'dynamic' or a number" % fp_cut)
                 exit(1)
 
-        fpformat = self.app.pargs.fingerprint_format
-
-        results = search_closest_compounds(molecule=molecule, fp_cut=fp_cut, fpformat=fpformat,
-                                           bonds_weight=bonds_weight, bonds_diff=bonds_diff,
-                                           atoms_weight=atoms_weight, atoms_diff=atoms_diff,
-                                           rings_diff=rings_diff)
-
-        results.dropna(inplace=True)
-
         similarity_cut = self.app.pargs.similarity_cutoff
         if similarity_cut is not None:
             try:
@@ -144,9 +128,230 @@ class ChemistryController(CementBaseController):
                 if similarity_cut == 0 or similarity_cut > 1:
                     print("Similarity cutoff %s must be grater than 0 and less then or equal to 1" % similarity_cut)
                     exit(1)
-                results = results[results.structural_score >= similarity_cut]
             except (ValueError, TypeError):
                 print("Invalid similarity cutoff '%s'. It must be a number" % similarity_cut)
+                exit(1)
+
+        max_hits = self.app.pargs.neighbors
+        if max_hits is not None:
+            try:
+                max_hits = int(max_hits)
+            except (ValueError, TypeError):
+                print("Invalid number of hits '%s'. It must be an integer" % max_hits)
+                exit(1)
+
+        deadline = self.app.pargs.deadline
+        if deadline is not None:
+            try:
+                deadline = float(deadline)
+            except (ValueError, TypeError):
+                print("Invalid deadline '%s'. It must be a number of seconds" % deadline)
+                exit(1)
+
+        return dict(fp_cut=fp_cut, fpformat=self.app.pargs.fingerprint_format, bonds_weight=bonds_weight,
+                    bonds_diff=bonds_diff, atoms_weight=atoms_weight, atoms_diff=atoms_diff, rings_diff=rings_diff,
+                    similarity_cut=similarity_cut, max_hits=max_hits, mode=self.app.pargs.search_mode,
+                    deadline=deadline)
+
+    @expose(help="Find analogs for a metabolite")
+    def find_analogs(self):
+        """
+        1. Make a fingerprint from the --inchi, --sdf or --mol.
+        2. Query the database
+
+        Returns
+        -------
+
+        """
+        output_file = self._output_file()
+        search_kwargs = self._search_options()
+
+        molecule = None
+
+        if self.app.pargs.inchi is not None:
+            molecule = Molecule.from_inchi(self.app.pargs.inchi)
+        elif self.app.pargs.sdf is not None:
+            molecule = Molecule.from_sdf(self.app.pargs.sdf)
+        elif self.app.pargs.mol is not None:
+            molecule = Molecule.from_mol(self.app.pargs.mol)
+        else:
+            print("Please provide one of the following inputs --inchi, --sdf or --mol")
+            exit(1)
+
+        print("Molecule processed!\nInChI key %s" % molecule.inchi_key)
+
+        if search_kwargs['fp_cut'] == 'dynamic':
+            search_kwargs['fp_cut'] = dynamic_fingerprint_cut(molecule.num_atoms)
+
+        # Use the models of 'marsi serve' if it is running.
+        client = connect()
+        if client is not None:
+            with client:
+                results = client.search_closest_compounds(molecule, **search_kwargs)
+        else:
+            results = search_closest_compounds(molecule=molecule, **search_kwargs)
+
+        # Keep the hits that were not scored before the deadline (complete is False).
+        results = results[results['structural_score'].notnull() | ~results['complete'].astype(bool)]
 
         results.sort_values('structural_score', ascending=False, inplace=True)
         OUTPUT_WRITERS[self.app.pargs.output_format](results, output_file, None)
+
+    @expose(help="Find analogs for all molecules in a file (--queries)")
+    def find_analogs_batch(self):
+        """
+        1. Read the molecules from --queries (SDF, SMILES, InChI or a model with InChI annotations).
+        2. Search the analogs of each distinct molecule (by InChI Key) with the model loaded once, or with
+           'marsi serve' if it is running.
+        3. Write the hits of all molecules to one file, with the query InChI Key and names.
+
+        Returns
+        -------
+
+        """
+        output_file = self._output_file()
+        search_kwargs = self._search_options()
+
+        if self.app.pargs.queries is None:
+            print("--queries argument is required")
+            exit(1)
+
+        queries_format = self.app.pargs.queries_format
+        if queries_format == 'model':
+            records = _read_model_molecules(self.app.pargs.queries)
+        else:
+            records = read_molecules(self.app.pargs.queries, queries_format)
+
+        molecules = OrderedDict()
+        names = {}
+        for name, molecule in records:
+            inchi_key = molecule.inchi_key
+            molecules.setdefault(inchi_key, molecule)
+            names.setdefault(inchi_key, []).append(name)
+
+        print("%i molecules (%i distinct)" % (sum(len(n) for n in names.values()), len(molecules)))
+
+        found = set()
+        with OUTPUT_STREAM_WRITERS[self.app.pargs.output_format](output_file) as writer:
+            for query_key, results in _iter_query_results(molecules, search_kwargs):
+                if len(results) == 0:
+                    continue
+                found.add(query_key)
+                results.index.name = "inchi_key"
+                results.sort_values('structural_score', ascending=False, na_position='last', inplace=True)
+                if search_kwargs['max_hits'] is not None:
+                    results = results.head(search_kwargs['max_hits']).copy()
+                results.insert(0, "query_names", ";".join(names[query_key]))
+                results.insert(0, "query", query_key)
+                writer.write(results)
+
+        for query_key in molecules:
+            if query_key not in found:
+                print("No analogs found for %s (%s)" % (query_key, ";".join(names[query_key])))
+
+
+def _iter_query_results(molecules, search_kwargs):
+    """
+    Yields the InChI Key and the hits (a DataFrame with the COLUMNS) of each molecule. The molecules without hits may
+    be skipped.
+    """
+    client = connect()
+    if client is not None:
+        with client:
+            for query_key, molecule in molecules.items():
+                kwargs = dict(search_kwargs)
+                if kwargs['fp_cut'] == 'dynamic':
+                    kwargs['fp_cut'] = dynamic_fingerprint_cut(molecule.num_atoms)
+                yield query_key, client.search_closest_compounds(molecule, **kwargs)
+    else:
+        hits = iter_closest_compounds_batch(molecules.values(), **search_kwargs)
+        for molecule, query_hits in itertools.groupby(hits, key=lambda hit: hit[0]):
+            query_hits = [(inchi_key, properties) for _, inchi_key, properties in query_hits]
+            yield molecule.inchi_key, DataFrame([[properties[column] for column in COLUMNS]
+                                                 for _, properties in query_hits],
+                                                index=[inchi_key for inchi_key, _ in query_hits], columns=COLUMNS)
+
+
+def _read_model_molecules(path):
+    """
+    Reads the molecules of the metabolites of a model with an 'inchi' annotation (e.g. after
+    `marsi.cobra.utils.annotate_model`).
+    """
+    model = load_model(path)
+    for metabolite in model.metabolites:
+        inchi = metabolite.annotation.get('inchi')
+        if isinstance(inchi, (list, tuple)):
+            inchi = inchi[0] if len(inchi) > 0 else None
+        if inchi is None:
+            continue
+        try:
+            molecule = Molecule.from_inchi(inchi)
+            molecule.inchi_key
+        except Exception as e:
+            print("Cannot read molecule %s: %s" % (metabolite.id, e))
+        else:
+            yield metabolite.id, molecule
+
+
+class _CSVStreamWriter(object):
+    def __init__(self, path):
+        self._file = open(path, 'w')
+        self._header = True
+
+    def write(self, results):
+        results.to_csv(self._file, header=self._header)
+        self._header = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self._file.close()
+
+
+class _ParquetStreamWriter(object):
+    def __init__(self, path):
+        import pyarrow
+        import pyarrow.parquet
+        self._pyarrow = pyarrow
+        self._path = path
+        self._writer = None
+
+    def write(self, results):
+        if self._writer is None:
+            table = self._pyarrow.Table.from_pandas(results)
+            self._writer = self._pyarrow.parquet.ParquetWriter(self._path, table.schema)
+        else:
+            table = self._pyarrow.Table.from_pandas(results, schema=self._writer.schema)
+        self._writer.write_table(table)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if self._writer is not None:
+            self._writer.close()
+
+
+class _ExcelStreamWriter(object):
+    # Excel files are written at once.
+    def __init__(self, path):
+        self._path = path
+        self._results = []
+
+    def write(self, results):
+        self._results.append(results)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None and len(self._results) > 0:
+            write_excel_file(concat(self._results), self._path)
+
+
+OUTPUT_STREAM_WRITERS = {
+    'csv': _CSVStreamWriter,
+    'excel': _ExcelStreamWriter,
+    'parquet': _ParquetStreamWriter
+}
@@ -27,7 +27,7 @@ from pandas import read_excel
 
 from marsi.chemistry import openbabel
 from marsi.config import db_url
-from marsi.io.build_database import build_database
+from marsi.io.build_database import build_database, build_fingerprints
 from marsi.io.db import Reference, Synonym, Metabolite
 from marsi.io.enrichment import find_best_chebi_structure
 from marsi.io.parsers import parse_chebi_data, parse_pubchem, parse_kegg_brite
@@ -51,7 +51,12 @@ class DatabaseController(CementBaseController):
         description = "Initialise MARSI (download data and build initial database)"
         arguments = [
             (['--drugbank-version'], dict(help="DrugBank version (5.0.3)")),
-            (['--with-zinc'], dict(help="Include Zinc", action="store_true"))
+            (['--with-zinc'], dict(help="Include Zinc", action="store_true")),
+            (['--format'], dict(help="The fingerprint format to compute (fingerprints, default: maccs)",
+                                default='maccs')),
+            (['--jobs', '-j'], dict(help="The number of worker processes (fingerprints, default: the number of CPUs)")),
+            (['--retry-failed'], dict(help="Compute again the fingerprints that could not be computed before "
+                                           "(fingerprints)", action="store_true"))
         ]
 
     @expose(hide=True)
@@ -206,6 +211,29 @@ class DatabaseController(CementBaseController):
         from marsi.io import data
         build_database(data, data_dir, self.app.pargs.with_zinc)
 
+    @expose(help="Compute a fingerprint format (--format) for all metabolites that do not have it")
+    def fingerprints(self):
+        fingerprint_format = self.app.pargs.format
+        jobs = int(self.app.pargs.jobs) if self.app.pargs.jobs is not None else None
+        pbar = ProgressBar(widgets=["Computing %s fingerprints" % fingerprint_format, Bar(), ETA()])
+
+        def progress(done, total):
+            if pbar.maxval is None:
+                pbar.maxval = total
+                pbar.start()
+            pbar.update(done)
+
+        try:
+            added, failed = build_fingerprints(fingerprint_format, processes=jobs, callback=progress,
+                                               retry_failed=self.app.pargs.retry_failed)
+        except ValueError as e:
+            print(e)
+            exit(1)
+        if pbar.maxval is not None:
+            pbar.finish()
+        print("Added %i %s fingerprints (%i metabolites could not be read, use --retry-failed to try them again)" %
+              (added, fingerprint_format, failed))
+
     @expose(help="Add known analogs")
     def add_known_analogs(self):
         chebi_client = ChEBI()
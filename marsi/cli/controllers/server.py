@@ -0,0 +1,44 @@
+# Copyright 2017 Chr. Hansen A/S and The Novo Nordisk Foundation Center for Biosustainability, DTU.
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+# http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from cement.core.controller import CementBaseController, expose
+
+from marsi.nearest_neighbors.server import SearchServer, SOCKET_FILE
+
+
+class ServerController(CementBaseController):
+    """
+    Runs the analog search server. While it runs, 'marsi chem find_analogs' uses its models instead of loading them.
+
+    """
+
+    class Meta:
+        label = 'serve'
+        stacked_on = 'base'
+        stacked_type = 'nested'
+        description = "Keep the search models in memory and answer analog searches"
+        arguments = [
+            (['--fingerprint-format', '-fp'], dict(help="The fingerprint formats to load (default: maccs)",
+                                                   action='append')),
+            (['--socket'], dict(help="The server socket (default: %s)" % SOCKET_FILE, default=SOCKET_FILE))
+        ]
+
+    @expose(hide=True)
+    def default(self):
+        fpformats = self.app.pargs.fingerprint_format or ['maccs']
+        server = SearchServer(fpformats=fpformats, address=self.app.pargs.socket)
+        print("Serving %s on %s" % (", ".join(fpformats), self.app.pargs.socket))
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            server.shutdown()
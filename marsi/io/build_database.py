@@ -11,15 +11,24 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+import multiprocessing
 import os
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+
 import pybel
 from pybel import readfile
 
 from numpy import nan
+from sqlalchemy import exists
+from sqlalchemy.sql.elements import and_
 
 from marsi.config import default_session
-from marsi.io.db import Metabolite, Reference, Synonym
+from marsi.io.db import Metabolite, MetaboliteFingerprint, FingerprintFailure, Reference, Synonym
 from marsi.chemistry import openbabel
+from marsi.chemistry.molecule import Molecule, VALID_FP_FORMATS
+
+# Metabolites read, computed by a worker and inserted at a time by `build_fingerprints`.
+FINGERPRINTS_BATCH_SIZE = 500
 
 
 def build_database(data, data_dir, with_zinc=True, session=default_session):
@@ -194,3 +203,112 @@ def upload_zinc_entries(zinc_data_file, i=0, session=default_session, keys=None)
                 session.commit()
 
     return i
+
+
+def _compute_fingerprints(fingerprint_format, rows):
+    # Runs in the worker processes. Returns (metabolite id, fingerprint) pairs, the fingerprint is None when the InChI
+    # cannot be read.
+    fingerprints = []
+    for metabolite_id, inchi in rows:
+        try:
+            fingerprint = Molecule.from_inchi(inchi).fingerprint(fingerprint_format)
+        except Exception:
+            fingerprint = None
+        fingerprints.append((metabolite_id, fingerprint))
+    return fingerprints
+
+
+def build_fingerprints(fingerprint_format, processes=None, batch_size=FINGERPRINTS_BATCH_SIZE, callback=None,
+                       retry_failed=False, session=default_session):
+    """
+    Computes the fingerprints of one format for all the metabolites that do not have it.
+
+    The metabolites missing the fingerprint are read in pages of `batch_size` ordered by id (each page starts after
+    the last id of the previous one), the fingerprints of each page are computed by a pool of processes and inserted
+    with one multi-row insert. Every page is committed, so an interrupted run continues where it stopped when it is
+    run again. The metabolites that cannot be read are recorded (see `FingerprintFailure`) and skipped by the next
+    runs, unless `retry_failed` is True.
+
+    Parameters
+    ----------
+    fingerprint_format : str
+        The format of the fingerprint (see marsi.chemistry.molecule.VALID_FP_FORMATS).
+    processes : int
+        The number of worker processes (defaults to the number of CPUs).
+    batch_size : int
+        The number of metabolites in a page.
+    callback : callable
+        Called after each page with the number of metabolites done and the number of metabolites missing the
+        fingerprint when it started.
+    retry_failed : bool
+        Compute again the fingerprints that failed in previous runs.
+    session : Session
+        SQLAlchemy session.
+
+    Returns
+    -------
+    tuple
+        The number of fingerprints added and the number of metabolites that could not be read.
+    """
+    if fingerprint_format not in VALID_FP_FORMATS:
+        raise ValueError("Fingerprint '%s' is not valid. Use one of %s" %
+                         (fingerprint_format, ", ".join(VALID_FP_FORMATS)))
+
+    if retry_failed:
+        session.query(FingerprintFailure).filter(FingerprintFailure.fingerprint_type == fingerprint_format).delete()
+        session.commit()
+
+    missing = and_(~exists().where(and_(MetaboliteFingerprint.metabolite_id == Metabolite.id,
+                                        MetaboliteFingerprint.fingerprint_type == fingerprint_format)),
+                   ~exists().where(and_(FingerprintFailure.metabolite_id == Metabolite.id,
+                                        FingerprintFailure.fingerprint_type == fingerprint_format)))
+    total = session.query(Metabolite.id).filter(missing).count()
+    processes = processes or multiprocessing.cpu_count()
+
+    pages = _missing_pages(missing, batch_size, session)
+    added = failed = 0
+    with ProcessPoolExecutor(processes) as executor:
+        pending = set()
+        rows = next(pages, None)
+        while rows is not None or len(pending) > 0:
+            if rows is not None:
+                pending.add(executor.submit(_compute_fingerprints, fingerprint_format, rows))
+                rows = next(pages, None)
+            # Keeps the workers busy while the results are written, without reading ahead the whole table.
+            if rows is None or len(pending) >= 2 * processes:
+                finished, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    page_added, page_failed = _insert_fingerprints(fingerprint_format, future.result(), session)
+                    added += page_added
+                    failed += page_failed
+                    if callback is not None:
+                        callback(added + failed, total)
+
+    return added, failed
+
+
+def _missing_pages(missing, batch_size, session):
+    # Pages of (id, InChI) of the metabolites matching `missing`, by id.
+    last_id = None
+    while True:
+        query = session.query(Metabolite.id, Metabolite.inchi).filter(missing)
+        if last_id is not None:
+            query = query.filter(Metabolite.id > last_id)
+        rows = query.order_by(Metabolite.id).limit(batch_size).all()
+        if len(rows) == 0:
+            return
+        last_id = rows[-1][0]
+        yield [tuple(row) for row in rows]
+
+
+def _insert_fingerprints(fingerprint_format, fingerprints, session):
+    values = [dict(metabolite_id=metabolite_id, fingerprint_type=fingerprint_format, fingerprint=fingerprint)
+              for metabolite_id, fingerprint in fingerprints if fingerprint is not None]
+    failures = [dict(metabolite_id=metabolite_id, fingerprint_type=fingerprint_format)
+                for metabolite_id, fingerprint in fingerprints if fingerprint is None]
+    if len(values) > 0:
+        session.execute(MetaboliteFingerprint.__table__.insert().values(values))
+    if len(failures) > 0:
+        session.execute(FingerprintFailure.__table__.insert().values(failures))
+    session.commit()
+    return len(values), len(failures)
@@ -11,32 +11,73 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+import threading
+
 import six
-from bitarray import bitarray
+from cachetools import LRUCache
 from sqlalchemy import inspect
 
 from marsi.chemistry import rdkit
 
 from marsi.chemistry import openbabel
 
-from sqlalchemy import Boolean, Integer, String, Table, Text
+from sqlalchemy import Boolean, Integer, LargeBinary, String, Table, Text
 from sqlalchemy import Column, ForeignKey, Index, UniqueConstraint
 from sqlalchemy import TypeDecorator
 from sqlalchemy.ext.associationproxy import association_proxy
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import validates, relationship, backref
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import validates, relationship, backref, object_session
 from sqlalchemy.orm.collections import attribute_mapped_collection
 from sqlalchemy.orm.exc import NoResultFound
-from sqlalchemy.sql.elements import and_
+from sqlalchemy.sql.elements import and_, or_
 
 from marsi.chemistry.common import INCHI_KEY_REGEX
+from marsi.chemistry.fingerprint import PackedFingerprint
 from marsi.config import default_session
 
-__all__ = ['Database', 'Metabolite', 'Reference']
+__all__ = ['Database', 'Metabolite', 'Reference', 'MetaboliteMCS']
 
 
 Base = declarative_base()
 
+# Parsed molecules by (InChI Key, library, get3d), bounded by their total number of atoms.
+MOLECULE_CACHE_ATOMS = 1000000
+
+molecule_cache = LRUCache(maxsize=MOLECULE_CACHE_ATOMS, getsizeof=lambda entry: entry[0])
+_molecule_cache_lock = threading.Lock()
+
+_MOLECULE_LIBRARIES = {
+    'openbabel': (openbabel.copy_molecule, lambda molecule: molecule.OBMol.NumAtoms()),
+    'rdkit': (rdkit.copy_molecule, lambda molecule: molecule.GetNumAtoms()),
+}
+
+
+def _cached_molecule(key, library, build):
+    """
+    Returns a copy of the molecule cached under `key`, calling `build` to make it if it is not in `molecule_cache`.
+    """
+    copy, num_atoms = _MOLECULE_LIBRARIES[library]
+    with _molecule_cache_lock:
+        entry = molecule_cache.get(key)
+    if entry is None:
+        molecule = build()
+        entry = (max(num_atoms(molecule), 1), molecule)
+        with _molecule_cache_lock:
+            try:
+                molecule_cache[key] = entry
+            except ValueError:  # larger than the cache
+                pass
+    return copy(entry[1])
+
+
+# NOTE: Hack to get SDF files correct
+def _fix_sdf(sdf):
+    if sdf.startswith("OpenBabel"):
+        return "QuickFix1234\n" + sdf
+    else:
+        return sdf
+
 
 class ColumnVector(object):
     def __init__(self, collection, session, column):
@@ -86,16 +127,19 @@ class CollectionWrapper(object):
 
 
 class Fingerprint(TypeDecorator):
-    impl = String
+    """
+    Stores a PackedFingerprint as bytes (see `PackedFingerprint.to_bytes`).
+    """
+    impl = LargeBinary
 
     def process_bind_param(self, value, dialect):
-        return value.to01()
+        return value.to_bytes()
 
     def process_result_value(self, value, dialect):
-        return bitarray(value)
+        return PackedFingerprint.from_bytes(value)
 
     def copy(self, **kw):
-        return Fingerprint(self.impl.length)
+        return Fingerprint()
 
 
 references_table = Table('metabolite_references', Base.metadata,
@@ -176,7 +220,7 @@ class MetaboliteFingerprint(Base):
     id = Column(Integer, primary_key=True)
     metabolite_id = Column(Integer, ForeignKey('metabolites.id'))
     fingerprint_type = Column(String(10), nullable=False)
-    fingerprint = Column(Fingerprint(2048), nullable=False)
+    fingerprint = Column(Fingerprint, nullable=False)
 
     metabolite = relationship("Metabolite", backref=backref(
         "_fingerprints",
@@ -191,6 +235,131 @@ class MetaboliteFingerprint(Base):
         return {c.name: getattr(self, c.name) for c in self.__table__.columns}
 
 
+class FingerprintFailure(Base):
+    """
+    A metabolite whose fingerprint of a format could not be computed (see
+    `marsi.io.build_database.build_fingerprints`).
+    """
+    __tablename__ = 'fingerprint_failures'
+
+    id = Column(Integer, primary_key=True)
+    metabolite_id = Column(Integer, ForeignKey('metabolites.id'), nullable=False)
+    fingerprint_type = Column(String(10), nullable=False)
+
+    __table_args__ = (
+        UniqueConstraint('metabolite_id', 'fingerprint_type', name='_fp_failure_uc'),
+    )
+
+
+class MetaboliteMCS(Base):
+    """
+    Maximum Common Substructure between two metabolites (see `marsi.chemistry.rdkit.maximum_common_substructure`).
+    """
+    __tablename__ = "mcs_results"
+
+    id = Column(Integer, primary_key=True)
+    first_inchi_key = Column(String(27), nullable=False)
+    second_inchi_key = Column(String(27), nullable=False)
+    match_rings = Column(Boolean, nullable=False)
+    atom_compare = Column(String(20), nullable=False)
+    bond_compare = Column(String(20), nullable=False)
+    num_atoms = Column(Integer, nullable=False)
+    num_bonds = Column(Integer, nullable=False)
+    smarts = Column(Text, nullable=True)
+
+    __table_args__ = (
+        UniqueConstraint('first_inchi_key', 'second_inchi_key', 'match_rings', 'atom_compare', 'bond_compare',
+                         name='_mcs_pair_uc'),
+    )
+
+    @classmethod
+    def get_many(cls, inchi_key, inchi_keys, match_rings=True, session=default_session, chunk_size=500):
+        """
+        Retrieves the stored MCS between a metabolite and other metabolites.
+
+        Parameters
+        ----------
+        inchi_key : str
+            The InChI Key of the metabolite.
+        inchi_keys : list
+            The InChI Keys of the other metabolites.
+        match_rings : bool
+            Force ring structure to match.
+        session : sqlalchemy.orm.session.Session
+            A database session.
+        chunk_size : int
+            The number of InChI Keys per query.
+
+        Returns
+        -------
+        dict
+            `rdkit.MCSResult` by `rdkit.mcs_cache_key`.
+        """
+        inchi_keys = list(inchi_keys)
+        results = {}
+        for start in range(0, len(inchi_keys), chunk_size):
+            chunk = inchi_keys[start:start + chunk_size]
+            query = session.query(cls).filter(
+                cls.match_rings == bool(match_rings),
+                cls.atom_compare == rdkit.MCS_ATOM_COMPARE,
+                cls.bond_compare == rdkit.MCS_BOND_COMPARE,
+                or_(and_(cls.first_inchi_key == inchi_key, cls.second_inchi_key.in_(chunk)),
+                    and_(cls.second_inchi_key == inchi_key, cls.first_inchi_key.in_(chunk))))
+            for row in query:
+                key = (row.first_inchi_key, row.second_inchi_key, row.match_rings, row.atom_compare, row.bond_compare)
+                results[key] = rdkit.MCSResult(row.num_atoms, row.num_bonds, row.smarts, True)
+        return results
+
+    @classmethod
+    def add_many(cls, results, session=default_session):
+        """
+        Stores MCS results. They are inserted in their own transaction, so the pending changes of `session` are not
+        committed, and the pairs that are already stored (e.g. by a concurrent search) are skipped.
+
+        Parameters
+        ----------
+        results : dict
+            `rdkit.MCSResult` by `rdkit.mcs_cache_key`.
+        session : sqlalchemy.orm.session.Session
+            A database session (only its engine is used).
+
+        Returns
+        -------
+        int
+            The number of results inserted.
+        """
+        rows = []
+        for key, result in six.iteritems(results):
+            first_inchi_key, second_inchi_key, match_rings, atom_compare, bond_compare = key
+            rows.append(dict(first_inchi_key=first_inchi_key, second_inchi_key=second_inchi_key,
+                             match_rings=match_rings, atom_compare=atom_compare, bond_compare=bond_compare,
+                             num_atoms=result.numAtoms, num_bonds=result.numBonds, smarts=result.smarts))
+        if len(rows) == 0:
+            return 0
+
+        engine = session.get_bind()
+        try:
+            with engine.begin() as connection:
+                connection.execute(cls.__table__.insert(), rows)
+            return len(rows)
+        except IntegrityError:
+            pass
+
+        # Some pairs are stored already, the others are inserted one by one.
+        inserted = 0
+        for row in rows:
+            try:
+                with engine.begin() as connection:
+                    connection.execute(cls.__table__.insert(), row)
+                inserted += 1
+            except IntegrityError:
+                pass
+        return inserted
+
+    def to_dict(self):
+        return {c.name: getattr(self, c.name) for c in self.__table__.columns}
+
+
 class Metabolite(Base):
     __tablename__ = "metabolites"
 
@@ -203,6 +372,8 @@ class Metabolite(Base):
     num_bonds = Column(Integer, nullable=False)
     num_rings = Column(Integer, nullable=False)
     sdf = Column(Text, nullable=True)
+    # SDF of the 3D conformer generated by `molecule_3d`.
+    conformer = Column(Text, nullable=True)
 
     # solubility = Column(Float)
 
@@ -297,15 +468,11 @@ class Metabolite(Base):
 
         return metabolite
 
-    # NOTE: Hack to get SDF files correct
     @property
     def _sdf(self):
         if self.sdf is None:
             raise ValueError("SDF is not available")
-        if self.sdf.startswith("OpenBabel"):
-            return "QuickFix1234\n" + self.sdf
-        else:
-            return self.sdf
+        return _fix_sdf(self.sdf)
 
     def calc_solubility(self):
         molecule = self.molecule(library='openbabel')
@@ -314,9 +481,30 @@ class Metabolite(Base):
     @property
     def volume(self):
         mol = self.molecule(library='openbabel')
-        return openbabel.monte_carlo_volume(mol, self.atom_coordinates, tolerance=1, max_iterations=100)
+        return openbabel.monte_carlo_volume(mol, tolerance=1, max_iterations=100)
 
     def molecule(self, library='openbabel', get3d=True):
+        """
+        Builds the molecule from the stored SDF (if `get3d`) or InChI. Parsed molecules are kept in `molecule_cache`,
+        so each call returns a copy that can be modified.
+
+        Parameters
+        ----------
+        library : str
+            'openbabel' or 'rdkit'.
+        get3d : bool
+            Use the SDF coordinates if available.
+
+        Returns
+        -------
+        pybel.Molecule or rdkit.Chem.rdchem.Mol
+        """
+        if library not in _MOLECULE_LIBRARIES:
+            raise ValueError("Invalid library: %s, please choose between `openbabel` or `rdkit`" % library)
+        return _cached_molecule((self.inchi_key, library, bool(get3d and self.sdf is not None)), library,
+                                lambda: self._parse_molecule(library, get3d))
+
+    def _parse_molecule(self, library, get3d):
         if library == 'openbabel':
             if get3d and self.sdf is not None:
                 molecule = openbabel.sdf_to_molecule(self._sdf, from_file=False)
@@ -324,7 +512,7 @@ class Metabolite(Base):
                 return molecule
             else:
                 return openbabel.inchi_to_molecule(str(self))
-        elif library == 'rdkit':
+        else:
             try:
                 if get3d and self.sdf is not None:
                     return rdkit.sdf_to_molecule(self._sdf, from_file=False)
@@ -333,8 +521,42 @@ class Metabolite(Base):
             except Exception as e:
                 print(self.inchi_key)
                 raise e
-        else:
-            raise ValueError("Invalid library: %s, please choose between `openbabel` or `rdkit`")
+
+    def molecule_3d(self, forcefield='mmff94', steps=50, session=None):
+        """
+        The Open Babel molecule with 3D coordinates. If the stored structure is not 3D, a conformer is generated with
+        `forcefield` and set in `conformer`, so it is only generated once per compound. The session is flushed but
+        not committed, the conformer is stored when the caller commits it.
+
+        Parameters
+        ----------
+        forcefield : str
+            The force field used to generate the conformer.
+        steps : int
+            The number of force field steps.
+        session : sqlalchemy.orm.session.Session
+            The session to add the conformer to (defaults to the session of the metabolite, if any).
+
+        Returns
+        -------
+        pybel.Molecule
+        """
+        if self.conformer is None:
+            molecule = self.molecule(library='openbabel', get3d=True)
+            if molecule.dim < 3:
+                molecule.make3D(forcefield=forcefield, steps=steps)
+            self.conformer = openbabel.molecule_to_sdf(molecule)
+            session = session or object_session(self)
+            if session is not None:
+                session.add(self)
+                session.flush()
+
+        def build():
+            molecule = openbabel.sdf_to_molecule(_fix_sdf(self.conformer), from_file=False)
+            molecule.title = ""
+            return molecule
+
+        return _cached_molecule((self.inchi_key, 'openbabel', 'conformer'), 'openbabel', build)
 
     def fingerprint(self, fingerprint_format='maccs'):
         if fingerprint_format not in self.fingerprints:
@@ -346,8 +568,7 @@ class Metabolite(Base):
         return self.fingerprints[fingerprint_format]
 
     def _repr_html_(self):
-        mol = self.molecule(library='openbabel')
-        mol.make3D(forcefield='mmff94')
+        mol = self.molecule_3d()
         mol.removeh()
         structure = mol._repr_html_() or openbabel.mol_to_svg(mol)
         references = "; ".join(str(r) for r in self.references)
@@ -394,7 +615,7 @@ class Metabolite(Base):
         metabolite.references = references
         metabolite.synonyms = synonyms
         for key, fingerprint in six.iteritems(dump['fingerprints']):
-            metabolite.fingerprints[key] = bitarray(fingerprint)
+            metabolite.fingerprints[key] = PackedFingerprint.from01(fingerprint)
         session.add(metabolite)
         session.commit()
 
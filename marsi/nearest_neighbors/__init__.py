@@ -11,33 +11,45 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+import atexit
+import heapq
+import itertools
 import math
 import multiprocessing
 import os
-from queue import Empty
+import time
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from concurrent.futures.process import BrokenProcessPool
 
 import numpy as np
 import six
 from IProgress import ProgressBar, Bar, ETA
 from cameo.parallel import SequentialView
 from pandas import DataFrame
-from sqlalchemy import and_
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy import and_, func, or_
+from sqlalchemy.exc import SQLAlchemyError
 
 from marsi import config
 from marsi.chemistry import SOLUBILITY
 from marsi.chemistry import rdkit
+from marsi.chemistry.common import dynamic_fingerprint_cut
 from marsi.chemistry.molecule import Molecule
-from marsi.config import default_session, engine
+from marsi.config import default_session
 from marsi.io.db import Database
-from marsi.io.db import Metabolite
-from marsi.nearest_neighbors.model import NearestNeighbors, DistributedNearestNeighbors, DBNearestNeighbors
-from marsi.utils import data_dir, INCHI_KEY_TYPE, unpickle_large, pickle_large
+from marsi.io.db import Metabolite, MetaboliteFingerprint, MetaboliteMCS
+from marsi.nearest_neighbors.index import SegmentedIndex, PROPERTIES
+from marsi.nearest_neighbors.model import NearestNeighbors, DistributedNearestNeighbors, PropertyFilter, \
+    load_fingerprints
+from marsi.utils import data_dir, INCHI_KEY_TYPE
 
 
-__all__ = ['build_nearest_neighbors_model', 'load_nearest_neighbors_model']
+__all__ = ['build_nearest_neighbors_model', 'load_nearest_neighbors_model', 'update_nearest_neighbors_model',
+           'search_closest_compounds', 'iter_closest_compounds', 'iter_closest_compounds_batch']
 
-MODEL_FILE = os.path.join(data_dir, "fingerprints_default_%s_sol_%s.pickle")
+MODEL_DIR = os.path.join(data_dir, "fingerprints_default_%s_sol_%s")
+
+# Properties of the search_closest_compounds hits.
+COLUMNS = ["formula", "atoms", "bonds", "tanimoto_similarity", "structural_score", "complete"]
 
 
 class FeatureReader(object):
@@ -65,21 +77,40 @@ class FeatureReader(object):
 
     def __call__(self, index):
         subset = Database.metabolites[index[0]:index[1]]
-        indices = []
-        fingerprints = []
-        fingerprint_lengths = []
-        for m in subset:
-            if SOLUBILITY[self.solubility](m.solubility):
-                fingerprint = m.fingerprint(fpformat=self.fpformat)
-                fingerprints.append(fingerprint)
-                indices.append(m.inchi_key)
-                fingerprint_lengths.append(len(fingerprint))
-
-        _indices = np.ndarray((len(indices), 1), dtype=INCHI_KEY_TYPE)
-        for i in range(_indices.shape[0]):
-            _indices[i] = indices[i]
-        del indices
-        return _indices, fingerprints, fingerprint_lengths
+        return _read_features(subset, self.fpformat, self.solubility)
+
+
+def _solubility(metabolite):
+    # NaN when it cannot be computed, it does not match any solubility filter.
+    try:
+        return metabolite.calc_solubility()
+    except Exception:
+        return np.nan
+
+
+def _read_features(metabolites, fpformat, solubility):
+    indices = []
+    fingerprints = []
+    fingerprint_lengths = []
+    properties = {name: [] for name in PROPERTIES.names}
+    for m in metabolites:
+        # Solubility is not stored in the database, it is computed from the structure.
+        m_solubility = _solubility(m)
+        if SOLUBILITY[solubility](m_solubility):
+            fingerprint = m.fingerprint(fpformat)
+            fingerprints.append(fingerprint)
+            indices.append(m.inchi_key)
+            fingerprint_lengths.append(len(fingerprint))
+            for name, value in zip(PROPERTIES.names, (m.num_atoms, m.num_bonds, m.num_rings, m_solubility,
+                                                      bool(m.analog))):
+                properties[name].append(value)
+
+    _indices = np.ndarray((len(indices), 1), dtype=INCHI_KEY_TYPE)
+    for i in range(_indices.shape[0]):
+        _indices[i] = indices[i]
+    del indices
+    properties = {name: np.array(values, dtype=PROPERTIES[name]) for name, values in properties.items()}
+    return _indices, fingerprints, fingerprint_lengths, properties
 
 
 def build_feature_table(database, fpformat='ecfp10', chunk_size=None, solubility='high',
@@ -92,11 +123,13 @@ def build_feature_table(database, fpformat='ecfp10', chunk_size=None, solubility
     indices = np.ndarray((0, 1), dtype=INCHI_KEY_TYPE)
     fingerprints = []
     fingerprint_lengths = []
+    properties = {name: np.zeros(0, dtype=PROPERTIES[name]) for name in PROPERTIES.names}
     for r in res:
         indices = np.concatenate([indices, r[0]])
         fingerprints += r[1]
         fingerprint_lengths += r[2]
-    return indices, fingerprints, fingerprint_lengths
+        properties = {name: np.concatenate([column, r[3][name]]) for name, column in properties.items()}
+    return indices, fingerprints, fingerprint_lengths, properties
 
 
 def _build_nearest_neighbors_model(indices, features, lengths, n_models):
@@ -133,8 +166,8 @@ def build_nearest_neighbors_model(database, fpformat='fp4', solubility='high', n
         The number of NearestNeighbors models.
     """
 
-    indices, features, lens = build_feature_table(database, fpformat=fpformat, chunk_size=chunk_size,
-                                                  solubility=solubility, view=view)
+    indices, features, lens, _ = build_feature_table(database, fpformat=fpformat, chunk_size=chunk_size,
+                                                     solubility=solubility, view=view)
     return _build_nearest_neighbors_model(indices, features, lens, n_models)
 
 
@@ -161,27 +194,27 @@ def load_nearest_neighbors_model(chunk_size=1e6, fpformat="fp4", solubility='all
     """
 
     if source == "file":
-        load_nearest_neighbors_model_from_file(chunk_size=chunk_size, fpformat=fpformat, solubility=solubility,
-                                               view=view, model_size=model_size)
+        return load_nearest_neighbors_model_from_file(chunk_size=chunk_size, fpformat=fpformat,
+                                                      solubility=solubility, view=view, model_size=model_size)
     else:
-        load_nearest_neighbors_model_from_db(fpformat=fpformat, solubility=solubility,
-                                             model_size=model_size, session=session, costum_query=costum_query)
+        return load_nearest_neighbors_model_from_db(fpformat=fpformat, solubility=solubility, model_size=model_size,
+                                                    session=session, custom_query=costum_query)
 
 
 def load_nearest_neighbors_model_from_db(fpformat="fp4", solubility='all', model_size=1000, session=default_session,
                                          custom_query=None):
     """
-    Loads a NN model.
+    Loads a NN model from the Database.
 
-    If a 'default_model.pickle' exists in data it will load the model. Otherwise it will build a model from the
-    Database. This can take several hours depending on the size of the database.
+    The fingerprints are fetched once per process for each format and filter (see
+    `marsi.nearest_neighbors.model.load_fingerprints`).
 
     Parameters
     ----------
     fpformat : str
         The format of the fingerprint (see pybel.fps)
     solubility : str
-        One of high, medium, low or all.
+        Only 'all': the solubility is not stored in the database (use `load_nearest_neighbors_model_from_file`).
     model_size : int
         The size of each NearestNeighbor in the ensemble.
     session : Session
@@ -190,21 +223,13 @@ def load_nearest_neighbors_model_from_db(fpformat="fp4", solubility='all', model
         A query to filter elements from the database.
 
     """
+    if solubility != 'all':
+        raise ValueError("The solubility is not stored in the database, models loaded from it cannot be filtered by "
+                         "solubility (use solubility='all')")
 
-    if custom_query is not None:
-        indices = np.array(session.query(Metabolite.inchi_key).filter(custom_query).all(), dtype=INCHI_KEY_TYPE)
-    else:
-        indices = np.array(session.query(Metabolite.inchi_key).all(), dtype=INCHI_KEY_TYPE)
-
-    n_models = math.ceil(len(indices) / model_size)
-    chunk_size = math.ceil(len(indices) / n_models)
-    chunks = [((i - 1) * chunk_size, i * chunk_size) for i in range(1, n_models + 1)]
-    models = []
-
-    for start, end in chunks:
-        models.append(DBNearestNeighbors(indices[start:end], session, fpformat))
-
-    return DistributedNearestNeighbors(models)
+    model = load_fingerprints(session, fpformat, custom_query=custom_query)
+    return DistributedNearestNeighbors(_split_model(model.index, model.features, model.features_lengths,
+                                                    model.popcounts, model_size, model.properties))
 
 
 def load_nearest_neighbors_model_from_file(chunk_size=1e6, fpformat="fp4", solubility='all',
@@ -212,8 +237,9 @@ def load_nearest_neighbors_model_from_file(chunk_size=1e6, fpformat="fp4", solub
     """
     Loads a NN model from file.
 
-    If a 'default_model.pickle' exists in data it will load the model. Otherwise it will build a model from the
-    Database. This can take several hours depending on the size of the database.
+    If an index (see `marsi.nearest_neighbors.index`) exists in data it will memory-map the model. Otherwise it
+    will build the index from the Database. This can take several hours depending on the size of the database. Use
+    `update_nearest_neighbors_model` to add the entries created since then.
 
     Parameters
     ----------
@@ -231,79 +257,495 @@ def load_nearest_neighbors_model_from_file(chunk_size=1e6, fpformat="fp4", solub
     if solubility not in SOLUBILITY:
         raise ValueError('%s not one of %s' % (solubility, ", ".join(SOLUBILITY.keys())))
 
-    model_file = MODEL_FILE % (fpformat, solubility)
-    if os.path.exists(model_file):
-        _indices, _features, _lengths = unpickle_large(model_file, progress=True)
-    else:
+    index = SegmentedIndex(MODEL_DIR % (fpformat, solubility))
+    if len(index) == 0:
         print("Building search model (fp: %s, solubility: %s)" % (fpformat, solubility))
-        _indices, _features, _lengths = build_feature_table(Database.metabolites,
-                                                            chunk_size=chunk_size,
-                                                            fpformat=fpformat,
-                                                            solubility=solubility,
-                                                            view=view)
-        pickle_large((_indices, _features, _lengths), model_file, progress=True)
-
-    n_models = math.ceil(len(_indices) / model_size)
-    nn_model = _build_nearest_neighbors_model(_indices, _features, _lengths, n_models)
-    return nn_model
-
-
-class DataBuilder(multiprocessing.Process):
-    def __init__(self, inchi, task_queue, results_queue, atoms_weight, bonds_weight, timeout,
-                 *args, **kwargs):
-        super(DataBuilder, self).__init__(*args, **kwargs)
-
-        self._inchi = inchi
-        self._session = None
-        self._tasks = task_queue
-        self._results = results_queue
-        self._atoms_weight = atoms_weight
-        self._bonds_weight = bonds_weight
-        self._timeout = timeout
-
-    @property
-    def session(self):
-        if self._session is None:
-            session_maker = sessionmaker(engine)
-            self._session = session_maker()
-        return self._session
-
-    @property
-    def molecule(self):
-        return rdkit.inchi_to_molecule(self._inchi)
-
-    def run(self):
-        while not self._tasks.empty():
-            try:
-                inchi_key, distance = self._tasks.get(block=False, timeout=10)
-            except Empty:
-                continue
-            else:
-                result = self.apply_similarity(inchi_key, distance)
-                self._results.put(result)
+        max_metabolite_id, max_fingerprint_id = _max_ids(default_session)
+        _indices, _features, _lengths, _properties = build_feature_table(Database.metabolites,
+                                                                         chunk_size=chunk_size,
+                                                                         fpformat=fpformat,
+                                                                         solubility=solubility,
+                                                                         view=view)
+        _append_segment(index, _indices, _features, _lengths, _properties)
+        index.checkpoint(max_metabolite_id, max_fingerprint_id)
+        del _indices, _features, _lengths, _properties
+
+    return _load_nearest_neighbors_model_from_index(index, model_size)
+
+
+def update_nearest_neighbors_model(fpformat="fp4", solubility='all', session=default_session, max_segments=8):
+    """
+    Updates a NN model file with the changes in the Database since it was built or last updated.
+
+    Metabolites added since then are appended as a new segment. Metabolites that were deleted, or that have a new
+    fingerprint, are marked as deleted in the older segments (and the new fingerprints appended). When there are more
+    than `max_segments` segments they are merged in a background thread.
+
+    Parameters
+    ----------
+    fpformat : str
+        The format of the fingerprint (see pybel.fps)
+    solubility : str
+        One of high, medium, low or all.
+    session : Session
+        SQLAlchemy session.
+    max_segments : int
+        The number of segments that triggers a compaction.
+
+    Returns
+    -------
+    tuple
+        The number of entries added and deleted.
+    """
+    if solubility not in SOLUBILITY:
+        raise ValueError('%s not one of %s' % (solubility, ", ".join(SOLUBILITY.keys())))
+
+    index = SegmentedIndex(MODEL_DIR % (fpformat, solubility))
+    max_metabolite_id, max_fingerprint_id = _max_ids(session)
+
+    changed_ids = session.query(MetaboliteFingerprint.metabolite_id).filter(
+        MetaboliteFingerprint.fingerprint_type == fpformat,
+        MetaboliteFingerprint.id > index.max_fingerprint_id,
+        MetaboliteFingerprint.id <= max_fingerprint_id,
+        MetaboliteFingerprint.metabolite_id <= index.max_metabolite_id)
+    changed = set(key for key, in session.query(Metabolite.inchi_key).filter(Metabolite.id.in_(changed_ids)))
+    current = set(key for key, in session.query(Metabolite.inchi_key).yield_per(10000))
+    indexed = set(key.decode('utf-8') for key in index.keys()[:, 0])
+    deleted = index.delete((indexed - current) | (indexed & changed))
+
+    metabolites = session.query(Metabolite).filter(
+        or_(and_(Metabolite.id > index.max_metabolite_id, Metabolite.id <= max_metabolite_id),
+            Metabolite.id.in_(changed_ids))).order_by(Metabolite.id)
+    _indices, _features, _lengths, _properties = _read_features(metabolites.yield_per(1000), fpformat, solubility)
+    _append_segment(index, _indices, _features, _lengths, _properties)
+    index.checkpoint(max_metabolite_id, max_fingerprint_id)
+
+    if len(index) > max_segments:
+        index.compact_in_background()
+
+    return len(_indices), deleted
+
+
+def _max_ids(session):
+    max_metabolite_id = session.query(func.max(Metabolite.id)).scalar() or 0
+    max_fingerprint_id = session.query(func.max(MetaboliteFingerprint.id)).scalar() or 0
+    return max_metabolite_id, max_fingerprint_id
+
+
+def _append_segment(index, indices, features, lengths, properties):
+    if len(indices) > 0:
+        model = NearestNeighbors(indices, features, lengths, properties=properties)
+        index.append(model.index, model.features, model.features_lengths, model.popcounts, model.properties)
+
 
-        if self._session is not None:
-            self.session.close()
-            self.session.bind.dispose()
+def _split_model(index, features, features_lengths, popcounts, model_size, properties=None):
+    # The columns are sorted by popcount, so each chunk of them is itself a sorted model.
+    n_entries = len(index)
+    n_models = max(math.ceil(n_entries / model_size), 1)
+    chunk_size = max(math.ceil(n_entries / n_models), 1)
+    models = []
+    for start in range(0, n_entries, chunk_size):
+        end = start + chunk_size
+        chunk_properties = None
+        if properties is not None:
+            chunk_properties = {name: column[start:end] for name, column in properties.items()}
+        models.append(NearestNeighbors.from_packed(index[start:end], features[start:end],
+                                                   features_lengths[start:end], popcounts[start:end],
+                                                   properties=chunk_properties))
+    return models
+
+
+def _load_nearest_neighbors_model_from_index(index, model_size):
+    models = []
+    for columns, properties in zip(index.read(), index.read_properties()):
+        models += _split_model(columns.index, columns.features, columns.features_lengths, columns.popcounts,
+                               model_size, properties)
+
+    return DistributedNearestNeighbors(models)
+
+
+# Process pool that computes structural similarities (created on first use, see `similarity_pool`).
+_similarity_pool = None
 
-    def apply_similarity(self, inchi_key, distance):
-        met = Metabolite.get(inchi_key=inchi_key, session=self.session)
+# Number of InChI Keys per metabolites query.
+QUERY_CHUNK_SIZE = 500
+
+
+def similarity_pool(processes=None):
+    """
+    Returns the process pool used to compute structural similarities. The pool is created on first use and reused by
+    all searches, shut it down with `shutdown_similarity_pool`.
+
+    Parameters
+    ----------
+    processes : int
+        The number of worker processes (defaults to the number of CPUs). Only used when the pool is created.
+
+    Returns
+    -------
+    concurrent.futures.ProcessPoolExecutor
+    """
+    global _similarity_pool
+    if _similarity_pool is None:
+        _similarity_pool = ProcessPoolExecutor(processes or multiprocessing.cpu_count())
+    return _similarity_pool
+
+
+def shutdown_similarity_pool():
+    """
+    Stops the workers of the structural similarity pool.
+    """
+    global _similarity_pool
+    if _similarity_pool is not None:
+        _similarity_pool.shutdown()
+        _similarity_pool = None
+
+
+atexit.register(shutdown_similarity_pool)
+
+
+def _structural_similarities(inchi, reference_key, candidates, atoms_weight, bonds_weight, timeout, mcs_results=None,
+                             min_similarity=0, end_time=None):
+    """
+    Computes the structural similarity between a molecule and a chunk of candidates (runs on the pool workers).
+
+    The MCS is skipped for the candidates whose similarity cannot reach `min_similarity` (see
+    `rdkit.structural_similarity_bound`).
+
+    Parameters
+    ----------
+    inchi : str
+        The InChI of the query molecule.
+    reference_key : str
+        The InChI Key of the query molecule.
+    candidates : list
+        (InChI Key, InChI) of each candidate.
+    mcs_results : dict
+        Known MCS results (see `rdkit.mcs_cache`).
+    min_similarity : float
+        The lowest similarity of interest.
+    end_time : float
+        The search deadline (as in `time.time`). Each MCS times out at the deadline and the candidates left when it
+        is reached are not scored.
+
+    Returns
+    -------
+    list
+        (InChI Key, similarity, complete) of each candidate, the similarity is None if it could not be computed or
+        cannot reach `min_similarity`, NaN if the deadline was reached, and complete is False if the MCS timed out.
+    dict
+        The MCS results of the candidates that were not in `mcs_results`.
+    """
+    mcs_results = mcs_results or {}
+    rdkit.mcs_cache.update(mcs_results)
 
+    reference = rdkit.inchi_to_molecule(inchi)
+    similarities = []
+    new_mcs_results = {}
+    for inchi_key, candidate_inchi in candidates:
         try:
-            molecule = met.molecule('rdkit', get3d=False)
-            structural_similarity = rdkit.structural_similarity(self.molecule, molecule,
-                                                                atoms_weight=self._atoms_weight,
-                                                                bonds_weight=self._bonds_weight,
-                                                                timeout=self._timeout)
-            return [inchi_key, met.formula, met.num_atoms, met.num_bonds, 1 - distance, structural_similarity]
+            molecule = rdkit.inchi_to_molecule(candidate_inchi)
+            bound = rdkit.structural_similarity_bound(reference, molecule, atoms_weight=atoms_weight,
+                                                      bonds_weight=bonds_weight)
+            if bound < min_similarity:
+                similarities.append((inchi_key, None, True))
+                continue
+            mcs_timeout = timeout
+            if end_time is not None:
+                remaining = end_time - time.time()
+                if remaining <= 0:
+                    similarities.append((inchi_key, np.nan, False))
+                    continue
+                mcs_timeout = remaining if timeout is None else min(timeout, remaining)
+            similarity = rdkit.structural_similarity(reference, molecule, atoms_weight=atoms_weight,
+                                                     bonds_weight=bonds_weight, timeout=mcs_timeout,
+                                                     cache=rdkit.mcs_cache, cache_key=(reference_key, inchi_key))
         except Exception as e:
-            print(e)
-            return None
+            print("%s: %s" % (inchi_key, e))
+            similarity = None
+
+        # Only complete MCS results are cached.
+        key = rdkit.mcs_cache_key(reference_key, inchi_key)
+        complete = similarity is not None and key in rdkit.mcs_cache
+        similarities.append((inchi_key, similarity, complete))
+        if complete and key not in mcs_results:
+            new_mcs_results[key] = rdkit.mcs_cache[key]
+    return similarities, new_mcs_results
+
+
+def _fetch_metabolites(inchi_keys, session):
+    """
+    Reads (InChI, formula, number of atoms, number of bonds) of each metabolite with one query per `QUERY_CHUNK_SIZE`
+    InChI Keys.
+
+    Returns
+    -------
+    dict
+        The metabolites data by InChI Key.
+    """
+    metabolites = {}
+    for start in range(0, len(inchi_keys), QUERY_CHUNK_SIZE):
+        chunk = inchi_keys[start:start + QUERY_CHUNK_SIZE]
+        query = session.query(Metabolite.inchi_key, Metabolite.inchi, Metabolite.formula,
+                              Metabolite.num_atoms, Metabolite.num_bonds).filter(Metabolite.inchi_key.in_(chunk))
+        for inchi_key, inchi, formula, num_atoms, num_bonds in query:
+            metabolites[inchi_key] = (inchi, formula, num_atoms, num_bonds)
+    return metabolites
+
+
+def iter_closest_compounds(molecule, nn_model=None, fp_cut=0.5, fpformat="maccs", atoms_diff=3,
+                           bonds_diff=3, rings_diff=2, session=default_session,
+                           atoms_weight=0.5, bonds_weight=0.5, timeout=120, mode="native", pool=None,
+                           similarity_cut=None, max_hits=None, deadline=None, prefilter=None):
+    """
+    Finds the closest compounds given a Molecule and yields each hit as soon as its structural similarity is known.
+
+    The neighbors are scored from the highest Tanimoto similarity down. When the `deadline` is reached, the neighbors
+    not scored yet are yielded last without structural similarity.
+
+    Parameters
+    ----------
+    deadline : float
+        Time budget in seconds (default: no limit).
+
+    See `search_closest_compounds` for the other parameters.
+
+    Returns
+    -------
+    generator
+        Yields the InChI Key and a dict with the properties (COLUMNS) of each hit. 'complete' is False if the MCS timed
+        out or the deadline was reached before it was computed.
+    """
+    assert isinstance(molecule, Molecule)
+
+    end_time = time.time() + deadline if deadline is not None else None
+
+    if prefilter is None:
+        prefilter = nn_model is None
+
+    if nn_model is None:
+        nn_model = load_nearest_neighbors_model_from_db(fpformat=fpformat, session=session)
+
+    assert isinstance(nn_model, DistributedNearestNeighbors)
+
+    property_filter = None
+    if prefilter:
+        property_filter = _property_filter(molecule, atoms_diff, bonds_diff, rings_diff)
+
+    neighbors = nn_model.radius_nearest_neighbors(molecule.fingerprint(fpformat), radius=1 - fp_cut, mode=mode,
+                                                  property_filter=property_filter)
+
+    if molecule.inchi_key in neighbors:
+        del neighbors[molecule.inchi_key]
+
+    return _iter_hits(molecule, neighbors, session, atoms_weight, bonds_weight, timeout, pool, similarity_cut,
+                      max_hits, end_time)
+
+
+def iter_closest_compounds_batch(molecules, nn_model=None, fp_cut=0.5, fpformat="maccs", atoms_diff=3,
+                                 bonds_diff=3, rings_diff=2, session=default_session,
+                                 atoms_weight=0.5, bonds_weight=0.5, timeout=120, mode="native", pool=None,
+                                 similarity_cut=None, max_hits=None, deadline=None, prefilter=None, batch_size=256):
+    """
+    Finds the closest compounds of many molecules. The fingerprint search runs for `batch_size` molecules at a time
+    (see `DistributedNearestNeighbors.radius_nearest_neighbors_batch`) and the hits of each molecule are scored as
+    in `iter_closest_compounds`. The 'lsh' mode has no batch search, each molecule is searched on its own.
+
+    Parameters
+    ----------
+    molecules : iterable
+        Molecules (marsi.chemistry.molecule.Molecule).
+    fp_cut : float, str
+        A cutoff value for fingerprint similarity, or 'dynamic' to use `dynamic_fingerprint_cut` of each molecule.
+    deadline : float
+        Time budget in seconds of each molecule (default: no limit).
+    batch_size : int
+        The number of molecules per fingerprint search.
+
+    See `search_closest_compounds` for the other parameters.
+
+    Returns
+    -------
+    generator
+        Yields the molecule, the InChI Key and a dict with the properties (COLUMNS) of each hit.
+    """
+    if prefilter is None:
+        prefilter = nn_model is None
+
+    if nn_model is None:
+        nn_model = load_nearest_neighbors_model_from_db(fpformat=fpformat, session=session)
+
+    assert isinstance(nn_model, DistributedNearestNeighbors)
+
+    if mode != "native":
+        for molecule in molecules:
+            cut = dynamic_fingerprint_cut(molecule.num_atoms) if fp_cut == 'dynamic' else fp_cut
+            for inchi_key, hit in iter_closest_compounds(molecule, nn_model=nn_model, fp_cut=cut, fpformat=fpformat,
+                                                         atoms_diff=atoms_diff, bonds_diff=bonds_diff,
+                                                         rings_diff=rings_diff, session=session,
+                                                         atoms_weight=atoms_weight, bonds_weight=bonds_weight,
+                                                         timeout=timeout, mode=mode, pool=pool,
+                                                         similarity_cut=similarity_cut, max_hits=max_hits,
+                                                         deadline=deadline, prefilter=prefilter):
+                yield molecule, inchi_key, hit
+        return
+
+    inchi_keys = nn_model.index[:, 0]
+    properties = nn_model.properties
+    if prefilter and properties is None:
+        raise ValueError("%r has no properties to filter" % nn_model)
+
+    molecules = iter(molecules)
+    while True:
+        batch = list(itertools.islice(molecules, batch_size))
+        if len(batch) == 0:
+            return
+
+        cuts = [dynamic_fingerprint_cut(m.num_atoms) if fp_cut == 'dynamic' else fp_cut for m in batch]
+        query_idx, db_idx, distances = nn_model.radius_nearest_neighbors_batch(
+            [m.fingerprint(fpformat) for m in batch], radius=1 - min(cuts))
+        starts = np.searchsorted(query_idx, np.arange(len(batch) + 1))
+
+        for i, molecule in enumerate(batch):
+            rows = db_idx[starts[i]:starts[i + 1]]
+            row_distances = distances[starts[i]:starts[i + 1]]
+            mask = row_distances <= 1 - cuts[i]
+            if prefilter:
+                property_filter = _property_filter(molecule, atoms_diff, bonds_diff, rings_diff)
+                mask &= property_filter({name: column[rows] for name, column in six.iteritems(properties)})
+
+            neighbors = {inchi_key.decode('utf-8'): distance
+                         for inchi_key, distance in zip(inchi_keys[rows[mask]], row_distances[mask])}
+            neighbors.pop(molecule.inchi_key, None)
+
+            end_time = time.time() + deadline if deadline is not None else None
+            for inchi_key, hit in _iter_hits(molecule, neighbors, session, atoms_weight, bonds_weight, timeout, pool,
+                                             similarity_cut, max_hits, end_time):
+                yield molecule, inchi_key, hit
+
+
+def _property_filter(molecule, atoms_diff, bonds_diff, rings_diff):
+    return PropertyFilter(num_atoms=(molecule.num_atoms - atoms_diff, molecule.num_atoms + atoms_diff),
+                          num_bonds=(molecule.num_bonds - bonds_diff, molecule.num_bonds + bonds_diff),
+                          num_rings=(molecule.num_rings - rings_diff, molecule.num_rings + rings_diff))
+
+
+def _iter_hits(molecule, neighbors, session, atoms_weight, bonds_weight, timeout, pool, similarity_cut, max_hits,
+               end_time):
+    """
+    Scores the neighbors of a molecule (see `iter_closest_compounds`).
+    """
+    if len(neighbors) == 0:
+        return
+
+    metabolites = _fetch_metabolites(list(neighbors), session)
+    candidates = [(inchi_key, metabolites[inchi_key][0]) for inchi_key in neighbors if inchi_key in metabolites]
+
+    def hit(inchi_key, similarity, complete):
+        inchi, formula, num_atoms, num_bonds = metabolites[inchi_key]
+        return inchi_key, dict(formula=formula, atoms=num_atoms, bonds=num_bonds,
+                               tanimoto_similarity=1 - neighbors[inchi_key], structural_score=similarity,
+                               complete=complete)
+
+    pool = pool or similarity_pool()
+    if end_time is None:
+        chunk_size = max(1, min(64, int(math.ceil(len(candidates) / (4.0 * multiprocessing.cpu_count())))))
+    else:
+        # Running chunks cannot be cancelled, one candidate per chunk returns the workers at the deadline.
+        chunk_size = 1
+    min_bound = similarity_cut or 0
+    candidates.sort(key=lambda candidate: neighbors[candidate[0]])
+
+    # MCS results of previous searches.
+    mcs_results = MetaboliteMCS.get_many(molecule.inchi_key, [inchi_key for inchi_key, _ in candidates],
+                                         session=session)
+    scored = set()
+    best_scores = []
+    out_of_time = False
+
+    def submit(chunk):
+        # The workers skip the MCS of the candidates that cannot reach the cutoff or, once `max_hits` are found, beat
+        # the worst of them.
+        min_similarity = min_bound
+        if max_hits is not None and len(best_scores) == max_hits:
+            min_similarity = max(min_similarity, best_scores[0])
+        chunk_mcs_results = {}
+        for inchi_key, _ in chunk:
+            key = rdkit.mcs_cache_key(molecule.inchi_key, inchi_key)
+            if key in mcs_results:
+                chunk_mcs_results[key] = mcs_results[key]
+        return pool.submit(_structural_similarities, molecule.inchi, molecule.inchi_key, chunk,
+                           atoms_weight, bonds_weight, timeout, chunk_mcs_results, min_similarity, end_time)
+
+    # Chunks are submitted as others finish (two per worker at a time), so they are bounded with the best scores so far.
+    chunks = (candidates[start:start + chunk_size] for start in range(0, len(candidates), chunk_size))
+    pending = set(submit(chunk) for chunk in itertools.islice(chunks, 2 * multiprocessing.cpu_count()))
+
+    progress = ProgressBar(maxval=len(candidates), widgets=["Processing Neighbors: ", Bar(), ETA()])
+    progress.start()
+    try:
+        while len(pending) > 0:
+            finished, pending = wait(pending, timeout=_remaining_time(end_time), return_when=FIRST_COMPLETED)
+            if len(finished) == 0:
+                out_of_time = True
+                break
+            for future in finished:
+                similarities, computed_mcs_results = future.result()
+                # Stored before the hits are yielded, so they are kept if the consumer stops early.
+                _store_mcs_results(computed_mcs_results, session)
+                for inchi_key, similarity, complete in similarities:
+                    if similarity is not None and np.isnan(similarity):
+                        # The worker reached the deadline.
+                        out_of_time = True
+                        continue
+                    scored.add(inchi_key)
+                    if similarity is not None and similarity >= min_bound:
+                        if max_hits is not None:
+                            heapq.heappush(best_scores, similarity)
+                            if len(best_scores) > max_hits:
+                                heapq.heappop(best_scores)
+                        yield hit(inchi_key, similarity, complete)
+                chunk = next(chunks, None)
+                if chunk is not None:
+                    pending.add(submit(chunk))
+            progress.update(len(scored))
+    except BrokenProcessPool:
+        # A worker died (e.g. the MCS crashed), the next search gets a new pool.
+        if pool is _similarity_pool:
+            shutdown_similarity_pool()
+        raise
+    finally:
+        for future in pending:
+            future.cancel()
+
+    progress.finish()
+
+    if out_of_time:
+        for inchi_key, _ in candidates:
+            if inchi_key not in scored:
+                yield hit(inchi_key, np.nan, False)
+
+
+def _store_mcs_results(mcs_results, session):
+    if len(mcs_results) == 0:
+        return
+    try:
+        MetaboliteMCS.add_many(mcs_results, session=session)
+    except SQLAlchemyError as e:
+        # The cache is written in its own transaction, the session is left as it is.
+        print("Could not store the MCS results: %s" % e)
+
+
+def _remaining_time(end_time):
+    if end_time is None:
+        return None
+    return max(0., end_time - time.time())
 
 
 def search_closest_compounds(molecule, nn_model=None, fp_cut=0.5, fpformat="maccs", atoms_diff=3,
                              bonds_diff=3, rings_diff=2, session=default_session,
-                             atoms_weight=0.5, bonds_weight=0.5, timeout=120):
+                             atoms_weight=0.5, bonds_weight=0.5, timeout=120, mode="native", pool=None,
+                             similarity_cut=None, max_hits=None, deadline=None, prefilter=None):
     """
     Finds the closest compounds given a Molecule.
 
@@ -319,77 +761,51 @@ def search_closest_compounds(molecule, nn_model=None, fp_cut=0.5, fpformat="macc
     fpformat : str
         A valid fingerprint format.
     atoms_diff : int
-        The max number of atoms that can be different (in number, not type).
+        The max number of atoms that can be different (in number, not type), see `prefilter`.
     bonds_diff : int
-        The max number of bonds that can be different (in number, not type).
+        The max number of bonds that can be different (in number, not type), see `prefilter`.
     rings_diff : int
-        The max number of rings that can be different (in number, not type).
+        The max number of rings that can be different (in number, not type), see `prefilter`.
     session : Session
         SQLAlchemy session.
     atoms_weight : float
         The weight of having matching atoms in the structural similarity
     bonds_weight : float
         The weight of having matching bonds in the structural similarity
+    timeout : int
+        The structural similarity (MCS) time out in seconds.
+    mode : str
+        The fingerprint search mode, 'native' or 'lsh' (approximate, see `NearestNeighbors.build_lsh`).
+    pool : concurrent.futures.Executor
+        Computes the structural similarities (default: the shared pool, see `similarity_pool`).
+    similarity_cut : float
+        Only return hits with a structural similarity greater than or equal to this value.
+    max_hits : int
+        Only return the hits with the highest structural similarity.
+    deadline : float
+        Time budget in seconds. The hits scored so far are returned when it is reached, the others have no
+        structural score (see `iter_closest_compounds`).
+    prefilter : bool
+        Filter the neighbors by `atoms_diff`, `bonds_diff` and `rings_diff` with the property columns of the model
+        (see `marsi.nearest_neighbors.index.PROPERTIES`). By default only the model loaded from the database
+        (`nn_model` is None) is filtered.
 
     Returns
     -------
     pandas.DataFrame
-        A data frame with the closest InChI Keys as index and the properties calculated for each hit.
+        A data frame with the closest InChI Keys as index and the properties calculated for each hit, ranked by
+        structural score.
     """
-    assert isinstance(molecule, Molecule)
-
-    if nn_model is None:
-        query = and_(Metabolite.num_atoms >= molecule.num_atoms - atoms_diff,
-                     Metabolite.num_atoms <= molecule.num_atoms + atoms_diff,
-                     Metabolite.num_bonds >= molecule.num_bonds - bonds_diff,
-                     Metabolite.num_bonds <= molecule.num_bonds + bonds_diff,
-                     Metabolite.num_rings >= molecule.num_rings - rings_diff,
-                     Metabolite.num_rings <= molecule.num_rings + rings_diff)
-
-        nn_model = load_nearest_neighbors_model_from_db(fpformat=fpformat, custom_query=query, session=session)
-
-    assert isinstance(nn_model, DistributedNearestNeighbors)
-
-    neighbors = nn_model.radius_nearest_neighbors(molecule.fingerprint(fpformat), radius=1 - fp_cut)
-
-    if molecule.inchi_key in neighbors:
-        del neighbors[molecule.inchi_key]
-
-    dataframe = DataFrame(columns=["formula", "atoms", "bonds", "tanimoto_similarity", "structural_score"])
-    if len(neighbors) == 0:
-        return dataframe
-
-    results = []
-    tasks_queue = multiprocessing.Queue()
-    results_queue = multiprocessing.Queue()
-
-    progress = ProgressBar(maxval=len(neighbors), widgets=["Processing Neighbors: ", Bar(), ETA()])
-
-    jobs = []
-    for i in range(multiprocessing.cpu_count()):
-        job = DataBuilder(molecule.inchi, tasks_queue, results_queue,
-                          atoms_weight, bonds_weight, timeout)
-        jobs.append(job)
-        job.start()
-
-    for inchi_key, distance in six.iteritems(neighbors):
-        tasks_queue.put((inchi_key, distance))
-
-    progress.start()
-    while len(results) < len(neighbors):
-        try:
-            res = results_queue.get(block=True, timeout=10)
-        except Empty:
-            continue
-        else:
-            results.append(res)
-            if res is not None:
-                dataframe.loc[res[0]] = res[1:]
-            progress.update(len(results))
-
-    progress.finish()
-
-    for job in jobs:
-        job.terminate()
+    hits = list(iter_closest_compounds(molecule, nn_model=nn_model, fp_cut=fp_cut, fpformat=fpformat,
+                                       atoms_diff=atoms_diff, bonds_diff=bonds_diff, rings_diff=rings_diff,
+                                       session=session, atoms_weight=atoms_weight, bonds_weight=bonds_weight,
+                                       timeout=timeout, mode=mode, pool=pool, similarity_cut=similarity_cut,
+                                       max_hits=max_hits, deadline=deadline, prefilter=prefilter))
+
+    dataframe = DataFrame([[properties[column] for column in COLUMNS] for _, properties in hits],
+                          index=[inchi_key for inchi_key, _ in hits], columns=COLUMNS)
+    dataframe = dataframe.sort_values('structural_score', ascending=False, na_position='last')
+    if max_hits is not None:
+        dataframe = dataframe.head(max_hits)
 
     return dataframe
@@ -0,0 +1,50 @@
+# Copyright 2016 Chr. Hansen A/S and The Novo Nordisk Foundation Center for Biosustainability, DTU.
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+# http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import numpy as np
+from scipy.sparse import csr_matrix
+
+__all__ = ['butina_clustering']
+
+
+def butina_clustering(graph):
+    """
+    Taylor-Butina clustering of a radius neighbors graph (see
+    `DistributedNearestNeighbors.radius_neighbors_graph`).
+
+    Entries are taken as centroids by decreasing number of neighbors. Each centroid forms a cluster with its neighbors
+    that are not in a cluster yet (Butina, 1999).
+
+    Parameters
+    ----------
+    graph : scipy.sparse.spmatrix
+        A symmetric matrix where the stored elements are the neighbors of each entry.
+
+    Returns
+    -------
+    tuple
+        Two numpy.array: the cluster of each entry and the centroid of each cluster.
+    """
+    graph = csr_matrix(graph)
+    n_neighbors = np.diff(graph.indptr)
+    labels = np.full(graph.shape[0], -1, dtype=np.int64)
+    centroids = []
+    for entry in np.argsort(-n_neighbors, kind='mergesort'):
+        if labels[entry] >= 0:
+            continue
+        neighbors = graph.indices[graph.indptr[entry]:graph.indptr[entry + 1]]
+        labels[neighbors[labels[neighbors] < 0]] = len(centroids)
+        labels[entry] = len(centroids)
+        centroids.append(entry)
+
+    return labels, np.array(centroids, dtype=np.int64)
@@ -0,0 +1,494 @@
+# Copyright 2017 Chr. Hansen A/S and The Novo Nordisk Foundation Center for Biosustainability, DTU.
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+# http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Binary fingerprint index files.
+
+An index file holds a packed fingerprint matrix (see `marsi.nearest_neighbors.model_ext.pack_fingerprints`) with its
+InChI Keys, fingerprint lengths and popcounts. All columns are stored little-endian at 64 byte aligned offsets so they
+can be memory-mapped without copying:
+
+    header | InChI Keys (a27) | lengths (int32) | packed fingerprints (uint64) | popcounts (int32)
+
+The header is `MAGIC`, the format version, the number of words per fingerprint, the number of entries and the offset
+of each column.
+
+The properties of the entries used to filter searches (see `PROPERTIES`) are stored next to the index file as a .npy
+table (see `write_properties`).
+"""
+import json
+import logging
+import os
+import struct
+import threading
+from collections import namedtuple
+
+import numpy as np
+
+from marsi.utils import INCHI_KEY_TYPE
+
+__all__ = ['write_index', 'read_index', 'write_properties', 'read_properties', 'properties_file', 'IndexFile',
+           'SegmentedIndex']
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b"MARSINNI"
+
+FORMAT_VERSION = 1
+
+ALIGNMENT = 64
+
+HEADER = struct.Struct("<8sIIQ5Q")
+
+COLUMNS = (
+    ("index", INCHI_KEY_TYPE),
+    ("features_lengths", np.dtype("<i4")),
+    ("features", np.dtype("<u8")),
+    ("popcounts", np.dtype("<i4"))
+)
+
+IndexFile = namedtuple("IndexFile", ["index", "features", "features_lengths", "popcounts"])
+
+# Properties of the entries (solubility is NaN when it cannot be computed, and models loaded from the database have
+# no solubility column).
+PROPERTIES = np.dtype([
+    ("num_atoms", "<i4"),
+    ("num_bonds", "<i4"),
+    ("num_rings", "<i4"),
+    ("solubility", "<f4"),
+    ("analog", "?")
+])
+
+
+def _align(offset):
+    return (offset + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+def _column_shapes(n_entries, n_words):
+    return {
+        "index": (n_entries, 1),
+        "features_lengths": (n_entries,),
+        "features": (n_entries, n_words),
+        "popcounts": (n_entries,)
+    }
+
+
+def write_index(file_path, index, features, features_lengths, popcounts):
+    """
+    Writes an index file.
+
+    Parameters
+    ----------
+    file_path : str
+        The destination file.
+    index : ndarray
+        The InChI Keys (n x 1 array of INCHI_KEY_TYPE).
+    features : ndarray
+        The packed fingerprints (n x n_words array of uint64).
+    features_lengths : ndarray
+        The length of each fingerprint.
+    popcounts : ndarray
+        The number of bits set in each fingerprint.
+    """
+    n_entries, n_words = features.shape
+    columns = {
+        "index": np.asarray(index, dtype=INCHI_KEY_TYPE).reshape(n_entries, 1),
+        "features_lengths": np.asarray(features_lengths, dtype=COLUMNS[1][1]),
+        "features": np.asarray(features, dtype=COLUMNS[2][1]),
+        "popcounts": np.asarray(popcounts, dtype=COLUMNS[3][1])
+    }
+
+    offsets = []
+    offset = _align(HEADER.size)
+    for name, dtype in COLUMNS:
+        offsets.append(offset)
+        offset = _align(offset + columns[name].nbytes)
+
+    with open(file_path, 'wb') as index_file:
+        index_file.write(HEADER.pack(MAGIC, FORMAT_VERSION, n_words, n_entries, *(offsets + [offset])))
+        for (name, dtype), column_offset in zip(COLUMNS, offsets):
+            index_file.seek(column_offset)
+            np.ascontiguousarray(columns[name]).tofile(index_file)
+        index_file.truncate(offset)
+
+    logger.debug("Wrote index %s (%i entries, %i bytes)" % (file_path, n_entries, offset))
+
+
+def read_index(file_path, mmap_mode='r'):
+    """
+    Reads an index file.
+
+    Parameters
+    ----------
+    file_path : str
+        The index file.
+    mmap_mode : str, None
+        The mode used to memory-map the columns (see numpy.memmap). If None, the columns are read into memory.
+
+    Returns
+    -------
+    IndexFile
+        The InChI Keys, packed fingerprints, fingerprint lengths and popcounts.
+    """
+    with open(file_path, 'rb') as index_file:
+        header = index_file.read(HEADER.size)
+
+    if len(header) < HEADER.size or header[:len(MAGIC)] != MAGIC:
+        raise ValueError("%s is not a fingerprint index file" % file_path)
+
+    header = HEADER.unpack(header)
+    version, n_words, n_entries = header[1:4]
+    offsets = header[4:]
+    if version != FORMAT_VERSION:
+        raise ValueError("%s has index format version %i, only version %i is supported" %
+                         (file_path, version, FORMAT_VERSION))
+    if os.path.getsize(file_path) < offsets[-1]:
+        raise ValueError("%s is truncated" % file_path)
+
+    shapes = _column_shapes(n_entries, n_words)
+    columns = {}
+    for (name, dtype), offset in zip(COLUMNS, offsets):
+        if n_entries == 0 or mmap_mode is None:
+            with open(file_path, 'rb') as index_file:
+                index_file.seek(offset)
+                column = np.fromfile(index_file, dtype=dtype, count=int(np.prod(shapes[name])))
+            columns[name] = column.reshape(shapes[name])
+        else:
+            columns[name] = np.memmap(file_path, dtype=dtype, mode=mmap_mode, offset=offset, shape=shapes[name])
+
+    return IndexFile(**columns)
+
+
+def properties_file(file_path):
+    """
+    The properties file of an index file.
+    """
+    return file_path + ".properties.npy"
+
+
+def write_properties(file_path, properties):
+    """
+    Writes the properties of the entries of an index.
+
+    Parameters
+    ----------
+    file_path : str
+        The destination file (.npy).
+    properties : dict
+        One array per property in `PROPERTIES` (properties that are not known can be left out).
+    """
+    names = [name for name in PROPERTIES.names if name in properties]
+    table = np.zeros(len(properties[names[0]]), dtype=[(name, PROPERTIES[name]) for name in names])
+    for name in names:
+        table[name] = properties[name]
+    np.save(file_path, table)
+
+
+def read_properties(file_path, mmap_mode='r'):
+    """
+    Reads the properties written with `write_properties`.
+
+    Parameters
+    ----------
+    file_path : str
+        The properties file.
+    mmap_mode : str, None
+        The mode used to memory-map the table (see numpy.load).
+
+    Returns
+    -------
+    dict
+        One array per property written.
+    """
+    table = np.load(file_path, mmap_mode=mmap_mode)
+    return {name: table[name] for name in table.dtype.names}
+
+
+class SegmentedIndex(object):
+    """
+    An index that grows by appending segments.
+
+    The index is a directory with one index file (and optionally one properties file) per segment and a manifest. Each
+    segment records the rows that were deleted (or replaced by a newer version in a later segment) since it was
+    written, and the manifest records the highest `Metabolite.id` and `MetaboliteFingerprint.id` already indexed so
+    that updates only fetch newer rows.
+
+    Segments are merged into one by `compact`.
+
+    Attributes
+    ----------
+    path : str
+        The index directory.
+    segments : list
+        The segment file names, oldest first.
+    max_metabolite_id : int
+        The highest metabolite id indexed.
+    max_fingerprint_id : int
+        The highest fingerprint id indexed.
+    """
+
+    MANIFEST = "manifest.json"
+
+    def __init__(self, path):
+        self.path = path
+        self.segments = []
+        self.max_metabolite_id = 0
+        self.max_fingerprint_id = 0
+        self._lock = threading.RLock()
+        if os.path.exists(self._file(self.MANIFEST)):
+            self._read_manifest()
+
+    def __len__(self):
+        return len(self.segments)
+
+    def _file(self, name):
+        return os.path.join(self.path, name)
+
+    @staticmethod
+    def _deleted_file(segment):
+        return segment + ".deleted.npy"
+
+    @staticmethod
+    def _properties_file(segment):
+        return properties_file(segment)
+
+    def _read_manifest(self):
+        with open(self._file(self.MANIFEST)) as manifest_file:
+            manifest = json.load(manifest_file)
+        if manifest['version'] != FORMAT_VERSION:
+            raise ValueError("%s has index format version %i, only version %i is supported" %
+                             (self.path, manifest['version'], FORMAT_VERSION))
+        self.segments = manifest['segments']
+        self.max_metabolite_id = manifest['max_metabolite_id']
+        self.max_fingerprint_id = manifest['max_fingerprint_id']
+
+    def _write_manifest(self):
+        manifest = {
+            'version': FORMAT_VERSION,
+            'segments': self.segments,
+            'max_metabolite_id': self.max_metabolite_id,
+            'max_fingerprint_id': self.max_fingerprint_id
+        }
+        # Readers never see a partially written manifest.
+        temporary_file = self._file(self.MANIFEST + ".tmp")
+        with open(temporary_file, 'w') as manifest_file:
+            json.dump(manifest, manifest_file)
+        os.replace(temporary_file, self._file(self.MANIFEST))
+
+    def _new_segment(self):
+        number = max([int(segment[8:14]) for segment in self.segments] + [-1]) + 1
+        return "segment-%06i.index" % number
+
+    def deleted_rows(self, segment):
+        """
+        Rows of a segment that are no longer valid.
+
+        Parameters
+        ----------
+        segment : str
+            A segment file name.
+
+        Returns
+        -------
+        ndarray
+            The sorted row numbers.
+        """
+        deleted_file = self._file(self._deleted_file(segment))
+        if os.path.exists(deleted_file):
+            return np.load(deleted_file)
+        return np.zeros(0, dtype=np.int64)
+
+    def read(self, mmap_mode='r'):
+        """
+        Reads the valid rows of every segment.
+
+        Segments without deleted rows are memory-mapped without copying.
+
+        Parameters
+        ----------
+        mmap_mode : str, None
+            See `read_index`.
+
+        Returns
+        -------
+        list
+            One IndexFile per segment.
+        """
+        with self._lock:
+            columns = []
+            for segment in self.segments:
+                segment_columns = read_index(self._file(segment), mmap_mode=mmap_mode)
+                deleted = self.deleted_rows(segment)
+                if len(deleted) > 0:
+                    rows = np.setdiff1d(np.arange(len(segment_columns.index)), deleted)
+                    segment_columns = IndexFile(*[column[rows] for column in segment_columns])
+                columns.append(segment_columns)
+            return columns
+
+    def read_properties(self, mmap_mode='r'):
+        """
+        Reads the properties of the valid rows of every segment.
+
+        Parameters
+        ----------
+        mmap_mode : str, None
+            See `read_properties`.
+
+        Returns
+        -------
+        list
+            One dict per segment (see `read_properties`), or None for segments written without properties.
+        """
+        with self._lock:
+            properties = []
+            for segment in self.segments:
+                properties_file = self._file(self._properties_file(segment))
+                if not os.path.exists(properties_file):
+                    properties.append(None)
+                    continue
+                segment_properties = read_properties(properties_file, mmap_mode=mmap_mode)
+                deleted = self.deleted_rows(segment)
+                if len(deleted) > 0:
+                    rows = np.setdiff1d(np.arange(len(segment_properties[PROPERTIES.names[0]])), deleted)
+                    segment_properties = {name: column[rows] for name, column in segment_properties.items()}
+                properties.append(segment_properties)
+            return properties
+
+    def keys(self):
+        """
+        The InChI Keys of the valid rows.
+
+        Returns
+        -------
+        ndarray
+            An n x 1 array of INCHI_KEY_TYPE.
+        """
+        columns = self.read()
+        if len(columns) == 0:
+            return np.ndarray((0, 1), dtype=INCHI_KEY_TYPE)
+        return np.concatenate([segment_columns.index for segment_columns in columns])
+
+    def append(self, index, features, features_lengths, popcounts, properties=None):
+        """
+        Appends a segment.
+
+        Parameters
+        ----------
+        index : ndarray
+            The InChI Keys.
+        features : ndarray
+            The packed fingerprints, sorted by popcount.
+        features_lengths : ndarray
+            The length of each fingerprint.
+        popcounts : ndarray
+            The number of bits set in each fingerprint.
+        properties : dict
+            The properties of each entry (see `PROPERTIES`).
+        """
+        with self._lock:
+            if not os.path.exists(self.path):
+                os.makedirs(self.path)
+            segment = self._new_segment()
+            write_index(self._file(segment), index, features, features_lengths, popcounts)
+            if properties is not None:
+                write_properties(self._file(self._properties_file(segment)), properties)
+            self.segments.append(segment)
+            self._write_manifest()
+
+    def checkpoint(self, max_metabolite_id, max_fingerprint_id):
+        """
+        Records the highest ids indexed so far.
+
+        Parameters
+        ----------
+        max_metabolite_id : int
+            The highest metabolite id indexed.
+        max_fingerprint_id : int
+            The highest fingerprint id indexed.
+        """
+        with self._lock:
+            if not os.path.exists(self.path):
+                os.makedirs(self.path)
+            self.max_metabolite_id = max_metabolite_id
+            self.max_fingerprint_id = max_fingerprint_id
+            self._write_manifest()
+
+    def delete(self, inchi_keys):
+        """
+        Marks the rows with the given InChI Keys as deleted (tombstones).
+
+        Parameters
+        ----------
+        inchi_keys : list
+            The InChI Keys to delete.
+
+        Returns
+        -------
+        int
+            The number of rows deleted.
+        """
+        inchi_keys = np.array([key.encode() if isinstance(key, str) else key for key in inchi_keys],
+                              dtype=INCHI_KEY_TYPE)
+        deleted_count = 0
+        with self._lock:
+            for segment in self.segments:
+                segment_index = read_index(self._file(segment)).index[:, 0]
+                deleted = self.deleted_rows(segment)
+                rows = np.setdiff1d(np.flatnonzero(np.isin(segment_index, inchi_keys)), deleted)
+                if len(rows) > 0:
+                    np.save(self._file(self._deleted_file(segment)), np.union1d(deleted, rows).astype(np.int64))
+                    deleted_count += len(rows)
+        return deleted_count
+
+    def compact(self):
+        """
+        Merges all segments into one without the deleted rows.
+        """
+        with self._lock:
+            if len(self.segments) < 2 and not any(len(self.deleted_rows(s)) > 0 for s in self.segments):
+                return
+
+            columns = self.read(mmap_mode=None)
+            merged = IndexFile(*[np.concatenate(column) for column in zip(*columns)])
+            order = np.argsort(merged.popcounts, kind='mergesort')
+
+            old_segments = self.segments
+            segment = self._new_segment()
+            write_index(self._file(segment), *[column[order] for column in merged])
+            properties = self.read_properties(mmap_mode=None)
+            if all(segment_properties is not None for segment_properties in properties):
+                write_properties(self._file(self._properties_file(segment)),
+                                 {name: np.concatenate([p[name] for p in properties])[order]
+                                  for name in properties[0] if all(name in p for p in properties)})
+            self.segments = [segment]
+            self._write_manifest()
+
+            for old_segment in old_segments:
+                for name in (old_segment, self._deleted_file(old_segment), self._properties_file(old_segment)):
+                    if os.path.exists(self._file(name)):
+                        os.remove(self._file(name))
+
+        logger.debug("Compacted %i segments of %s" % (len(old_segments), self.path))
+
+    def compact_in_background(self):
+        """
+        Runs `compact` in a thread.
+
+        Returns
+        -------
+        threading.Thread
+            The running thread.
+        """
+        thread = threading.Thread(target=self.compact, name="compact-%s" % os.path.basename(self.path))
+        thread.start()
+        return thread
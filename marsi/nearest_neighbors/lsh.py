@@ -0,0 +1,101 @@
+# Copyright 2016 Chr. Hansen A/S and The Novo Nordisk Foundation Center for Biosustainability, DTU.
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+# http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+MinHash/LSH tables to find candidate neighbors of a fingerprint without scanning the whole model.
+
+The MinHash signature of a fingerprint is, for each of `bands * rows` random permutations of the bits, the first
+permuted position that is set. Two fingerprints have the same value at a position of the signature with a probability
+equal to their Tanimoto coefficient. Signatures are split in `bands` of `rows` values, and fingerprints that share all
+the values of at least one band are candidates, so a pair with Tanimoto coefficient `s` is found with probability
+1 - (1 - s ** rows) ** bands.
+"""
+import numpy as np
+
+__all__ = ['MinHashLSH']
+
+# Multiplier used to hash the values of a band.
+HASH_PRIME = np.uint64(1099511628211)
+
+
+def _unpack(features):
+    return np.unpackbits(np.ascontiguousarray(features).view(np.uint8), axis=1, bitorder='little').astype(bool)
+
+
+class MinHashLSH(object):
+    """
+    LSH tables of the MinHash signatures of a packed fingerprint matrix (see `model_ext.pack_fingerprints`).
+
+    Parameters
+    ----------
+    features : ndarray
+        The packed fingerprints.
+    bands : int
+        The number of bands. More bands find more neighbors (better recall) but return more candidates.
+    rows : int
+        The number of signature values per band. More rows return fewer (and closer) candidates.
+    seed : int
+        The seed of the random permutations.
+    block_size : int
+        The number of fingerprints hashed at a time.
+    """
+
+    def __init__(self, features, bands=32, rows=4, seed=0, block_size=4096):
+        self.bands = bands
+        self.rows = rows
+        n_bits = 64 * features.shape[1]
+        random = np.random.RandomState(seed)
+        self._permutations = np.array([random.permutation(n_bits) for _ in range(bands * rows)], dtype=np.int64)
+
+        hashes = np.zeros((features.shape[0], bands), dtype=np.uint64)
+        for start in range(0, features.shape[0], block_size):
+            hashes[start:start + block_size] = self._band_hashes(features[start:start + block_size])
+
+        # For each band, the hashes sorted and the rows they belong to.
+        self._rows = [np.argsort(hashes[:, band], kind='mergesort').astype(np.int64) for band in range(bands)]
+        self._hashes = [np.ascontiguousarray(hashes[rows, band]) for band, rows in enumerate(self._rows)]
+
+    def _band_hashes(self, features):
+        bits = _unpack(features)
+        n_bits = bits.shape[1]
+        signatures = np.empty((bits.shape[0], len(self._permutations)), dtype=np.int64)
+        for i, permutation in enumerate(self._permutations):
+            signatures[:, i] = np.where(bits, permutation, n_bits).min(axis=1) if n_bits > 0 else 0
+
+        hashes = np.zeros((bits.shape[0], self.bands), dtype=np.uint64)
+        for band in range(self.bands):
+            for row in range(self.rows):
+                hashes[:, band] = hashes[:, band] * HASH_PRIME + signatures[:, band * self.rows + row].astype(np.uint64)
+        return hashes
+
+    def candidates(self, fingerprint):
+        """
+        Rows that share at least one band with a packed fingerprint.
+
+        Parameters
+        ----------
+        fingerprint : ndarray
+            The packed fingerprint (with as many words as the indexed fingerprints).
+
+        Returns
+        -------
+        ndarray
+            The sorted rows.
+        """
+        hashes = self._band_hashes(np.asarray(fingerprint, dtype=np.uint64).reshape(1, -1))[0]
+        rows = []
+        for band, value in enumerate(hashes):
+            start = np.searchsorted(self._hashes[band], value, side='left')
+            end = np.searchsorted(self._hashes[band], value, side='right')
+            rows.append(self._rows[band][start:end])
+        return np.unique(np.concatenate(rows)) if rows else np.zeros(0, dtype=np.int64)
@@ -11,13 +11,19 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+import heapq
+import itertools
 import logging
+import os
+from collections import OrderedDict
+
+import six
 from sklearn import neighbors
 
 from cameo.parallel import SequentialView
-from sqlalchemy.orm import load_only
+from sqlalchemy import LargeBinary, type_coerce
 
-from marsi.io.db import Metabolite
+from marsi.io.db import Metabolite, MetaboliteFingerprint
 
 try:  # pragma: no cover
     import pyopencl as cl
@@ -34,12 +40,21 @@ except ImportError:
 
 import numpy as np
 from pandas import DataFrame
+from scipy.sparse import csr_matrix
 
-from marsi.utils import timing
+from marsi.chemistry.common import SOLUBILITY
+from marsi.chemistry.fingerprint import PackedFingerprint
+from marsi.utils import timing, INCHI_KEY_TYPE
 from marsi.nearest_neighbors import model_ext
+from marsi.nearest_neighbors.index import read_index, write_index, read_properties, write_properties, properties_file, \
+    PROPERTIES
+from marsi.nearest_neighbors.lsh import MinHashLSH
 
 logger = logging.getLogger(__name__)
 
+# Scale of distances stored as uint16 (distances are between 0 and 2).
+DISTANCE_SCALE = 65535 / 2.0
+
 # Tanimoto coefficient calculation is implemented based on to OpenBabel's implementation
 # https://github.com/openbabel/openbabel/blob/master/include/openbabel/fingerprint.h#L86
 nn_source = """
@@ -71,6 +86,59 @@ __kernel void nn(__global float *distances, __global int *fingerprint, __constan
 """
 
 
+class PropertyFilter(object):
+    """
+    Selects the entries of a model by their properties (see `marsi.nearest_neighbors.index.PROPERTIES`).
+
+    Attributes
+    ----------
+    num_atoms : tuple
+        The minimum and maximum number of atoms (or None for any).
+    num_bonds : tuple
+        The minimum and maximum number of bonds (or None for any).
+    num_rings : tuple
+        The minimum and maximum number of rings (or None for any).
+    solubility : str
+        One of high, medium, low or all.
+    analog : bool
+        Only analogs (True), only non analogs (False) or both (None).
+    """
+    def __init__(self, num_atoms=None, num_bonds=None, num_rings=None, solubility='all', analog=None):
+        if solubility not in SOLUBILITY:
+            raise ValueError('%s not one of %s' % (solubility, ", ".join(SOLUBILITY.keys())))
+        self.num_atoms = num_atoms
+        self.num_bonds = num_bonds
+        self.num_rings = num_rings
+        self.solubility = solubility
+        self.analog = analog
+
+    def __call__(self, properties):
+        """
+        Parameters
+        ----------
+        properties : dict
+            One array per property.
+
+        Returns
+        -------
+        numpy.array
+            A boolean mask of the selected entries.
+        """
+        mask = np.ones(len(properties['num_atoms']), dtype=bool)
+        for name in ('num_atoms', 'num_bonds', 'num_rings'):
+            bounds = getattr(self, name)
+            if bounds is not None:
+                mask &= (properties[name] >= bounds[0]) & (properties[name] <= bounds[1])
+        if self.solubility != 'all':
+            if 'solubility' not in properties:
+                raise ValueError("The solubility of the entries is not known (e.g. models loaded from the database), "
+                                 "use solubility='all'")
+            mask &= SOLUBILITY[self.solubility](properties['solubility'])
+        if self.analog is not None:
+            mask &= properties['analog'] == self.analog
+        return mask
+
+
 class KNN(object):
     """
     K-Nearest Neighbors runner object.
@@ -79,27 +147,30 @@ class KNN(object):
 
     Attributes
     ----------
-    fp : numpy.array
-        A numpy.array with the fingerprint values.
+    fp : PackedFingerprint
+        The query fingerprint.
     k : int
         The maximum number of neighbors to retrieve.
     mode : str
-        'native' to run python implementation or 'cl' to run OpenCL implementation if available.
+        'native' to run python implementation, 'cl' to run OpenCL implementation if available or 'lsh' to
+        search the MinHash/LSH candidates only (approximate, see `NearestNeighbors.build_lsh`).
+    max_distance : float
+        Neighbors further than this distance are not needed (e.g. the k-th best distance found so far).
+    property_filter : PropertyFilter
+        Only search the entries selected by this filter.
     """
-    def __init__(self, fingerprint, k, mode):
-        self.fp = np.array(list(fingerprint), dtype=np.int32)
+    def __init__(self, fingerprint, k, mode, max_distance=None, property_filter=None):
+        self.fp = model_ext.as_packed(fingerprint)
         self.k = k
         self.mode = mode
+        self.max_distance = max_distance
+        self.property_filter = property_filter
 
     def __call__(self, nn):
-        return nn.knn(self.fp, k=self.k)
-
-    def __getstate__(self):
-        return dict(fp=self.fp.tolist(), k=self.k, mode=self.mode)
-
-    def __setstate__(self, d):
-        d['fp'] = np.array(d['fp'], dtype=np.int32)
-        self.__dict__.update(d)
+        if self.property_filter is not None:
+            return nn.knn(self.fp, k=self.k, mode=self.mode, max_distance=self.max_distance,
+                          property_filter=self.property_filter)
+        return nn.knn(self.fp, k=self.k, mode=self.mode, max_distance=self.max_distance)
 
 
 class RNN(object):
@@ -110,29 +181,28 @@ class RNN(object):
 
     Attributes
     ----------
-    fp : numpy.array
-        A numpy.array with the fingerprint values.
+    fp : PackedFingerprint
+        The query fingerprint.
     radius : float
         A distance radius ]0, 1].
     mode : str
-        'native' to run python implementation or 'cl' to run OpenCL implementation if available.
+        'native' to run python implementation, 'cl' to run OpenCL implementation if available or 'lsh' to
+        search the MinHash/LSH candidates only (approximate, see `NearestNeighbors.build_lsh`).
+    property_filter : PropertyFilter
+        Only search the entries selected by this filter.
     """
-    def __init__(self, fingerprint, radius, mode):
-        self.fp = np.array(list(fingerprint), dtype=np.int32)
+    def __init__(self, fingerprint, radius, mode, property_filter=None):
+        self.fp = model_ext.as_packed(fingerprint)
         assert 0 < radius <= 1
         self.radius = radius
         self.mode = mode
+        self.property_filter = property_filter
 
     def __call__(self, nn):
+        if self.property_filter is not None:
+            return nn.rnn(self.fp, radius=self.radius, mode=self.mode, property_filter=self.property_filter)
         return nn.rnn(self.fp, radius=self.radius, mode=self.mode)
 
-    def __getstate__(self):
-        return dict(fp=self.fp.tolist(), radius=self.radius, mode=self.mode)
-
-    def __setstate__(self, d):
-        d['fp'] = np.array(d['fp'], dtype=np.int32)
-        self.__dict__.update(d)
-
 
 class Distance(object):
     """
@@ -142,24 +212,114 @@ class Distance(object):
 
     Attributes
     ----------
-    fp : numpy.array
-        A numpy.array with the fingerprint values.
+    fp : PackedFingerprint
+        The query fingerprint.
     mode : str
         'native' to run python implementation or 'cl' to run OpenCL implementation if available.
     """
     def __init__(self, fingerprint, mode):
-        self.fp = np.array(list(fingerprint), dtype=np.int32)
+        self.fp = model_ext.as_packed(fingerprint)
         self.mode = mode
 
     def __call__(self, nn):
         return nn.distances(self.fp, mode=self.mode)
 
-    def __getstate__(self):
-        return dict(fp=self.fp, mode=self.mode)
 
-    def __setstate__(self, d):
-        d['fp'] = np.array(d['fp'], dtype=np.int32)
-        self.__dict__.update(d)
+class KNNBatch(object):
+    """
+    K-Nearest Neighbors runner object for a block of queries.
+
+    It is assigned to a model and runs the `knn_batch` function.
+
+    Attributes
+    ----------
+    fps : list
+        The PackedFingerprint of each query.
+    k : int
+        The maximum number of neighbors to retrieve for each query.
+    """
+    def __init__(self, fingerprints, k):
+        self.fps = [model_ext.as_packed(fingerprint) for fingerprint in fingerprints]
+        self.k = k
+
+    def __call__(self, nn):
+        return nn.knn_batch(self.fps, k=self.k)
+
+
+class RNNBatch(object):
+    """
+    R-Nearest Neighbors runner object for a block of queries.
+
+    It is assigned to a model and runs the `rnn_batch` function.
+
+    Attributes
+    ----------
+    fps : list
+        The PackedFingerprint of each query.
+    radius : float
+        A distance radius ]0, 1].
+    """
+    def __init__(self, fingerprints, radius):
+        self.fps = [model_ext.as_packed(fingerprint) for fingerprint in fingerprints]
+        assert 0 < radius <= 1
+        self.radius = radius
+
+    def __call__(self, nn):
+        return nn.rnn_batch(self.fps, radius=self.radius)
+
+
+def _distance_key(neighbor):
+    # NaN (two empty fingerprints) is ranked last, as np.argsort does.
+    distance = neighbor[1]
+    return np.inf if distance != distance else distance
+
+
+def _empty_hits():
+    return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32)
+
+
+def _sort_hits(query_idx, db_idx, distances):
+    """
+    Sorts search hits by query and then by distance.
+    """
+    order = np.lexsort((distances, query_idx))
+    return query_idx[order], db_idx[order], distances[order]
+
+
+def _concatenate_hits(hits):
+    if len(hits) == 0:
+        return _empty_hits()
+    query_idx, db_idx, distances = zip(*hits)
+    return (np.concatenate(query_idx).astype(np.int64), np.concatenate(db_idx).astype(np.int64),
+            np.concatenate(distances).astype(np.float32))
+
+
+def _unpack_rows(features, features_lengths):
+    """
+    Unpacks the rows of a packed fingerprint matrix (see `model_ext.pack_fingerprints`).
+    """
+    bits = np.unpackbits(np.ascontiguousarray(features).view(np.uint8), axis=1, bitorder='little')
+    return [bits[i, :length] for i, length in enumerate(features_lengths)]
+
+
+def _quantize_distances(distances):
+    distances = np.where(np.isnan(distances), 2, distances)
+    return np.round(np.clip(distances, 0, 2) * DISTANCE_SCALE).astype(np.uint16)
+
+
+def _top_k_hits(query_idx, db_idx, distances, k):
+    """
+    Keeps the k closest hits of each query.
+    """
+    query_idx, db_idx, distances = _sort_hits(query_idx, db_idx, distances)
+    if len(query_idx) == 0:
+        return query_idx, db_idx, distances
+
+    starts = np.flatnonzero(np.concatenate([[True], query_idx[1:] != query_idx[:-1]]))
+    sizes = np.diff(np.concatenate([starts, [len(query_idx)]]))
+    rank = np.arange(len(query_idx)) - np.repeat(starts, sizes)
+    keep = rank < k
+    return query_idx[keep], db_idx[keep], distances[keep]
 
 
 class DistributedNearestNeighbors(object):
@@ -174,7 +334,7 @@ class DistributedNearestNeighbors(object):
     def __init__(self, nns):
         self._nns = nns
 
-    def k_nearest_neighbors(self, fingerprint, k=5, mode="native", view=SequentialView()):
+    def k_nearest_neighbors(self, fingerprint, k=5, mode="native", view=SequentialView(), property_filter=None):
         """
         Retrieves the K nearest neighbors to a fingerprint.
 
@@ -185,21 +345,52 @@ class DistributedNearestNeighbors(object):
         k : int
             The number of neighbors to retrieve.
         mode : str
-            'native' to run python implementation or 'cl' to run OpenCL implementation if available.
+            'native' to run python implementation, 'cl' to run OpenCL implementation if available or 'lsh' to
+            search the MinHash/LSH candidates only (approximate, see `NearestNeighbors.build_lsh`).
         view : cameo.parallel.ParallelView, cameo.parallel.SequentialView
             A parallel mode runner.
+        property_filter : PropertyFilter
+            Only search the entries selected by this filter.
         Returns
         -------
         dict
             A dictionary with the InChI Key as key and the distance as value.
         """
-        func = KNN(fingerprint, k, mode)
+        func = KNN(fingerprint, k, mode, property_filter=property_filter)
+        if isinstance(view, SequentialView):
+            return self._k_nearest_neighbors_sequential(func)
+
         results = view.map(func, self._nns)
-        neighbors = {}
-        [neighbors.update(res) for res in results]
-        return dict(sorted(neighbors.items(), key=lambda x: x[1])[:k])
+        merged = heapq.merge(*[six.iteritems(res) for res in results], key=_distance_key)
+        return dict(itertools.islice(merged, k))
 
-    def radius_nearest_neighbors(self, fingerprint, radius=0.25, mode="native", view=SequentialView()):
+    def _k_nearest_neighbors_sequential(self, func):
+        """
+        Searches the models one at a time keeping the k best neighbors in a bounded heap. Once k neighbors are known,
+        the k-th best distance is passed to the next models so they can skip entries that cannot improve it.
+        """
+        k = func.k
+        if k <= 0:
+            return {}
+
+        # Max-heap (by negated distance) with the k best neighbors found so far.
+        heap = []
+        for i, nn in enumerate(self._nns):
+            func.max_distance = -heap[0][0] if len(heap) == k else None
+            for inchi_key, distance in six.iteritems(func(nn)):
+                item = (-_distance_key((inchi_key, distance)), i, inchi_key, distance)
+                if len(heap) < k:
+                    heapq.heappush(heap, item)
+                elif item[0] > heap[0][0]:
+                    heapq.heapreplace(heap, item)
+                else:
+                    break
+
+        heap.sort(key=lambda item: (-item[0], item[1]))
+        return dict((inchi_key, distance) for _, _, inchi_key, distance in heap)
+
+    def radius_nearest_neighbors(self, fingerprint, radius=0.25, mode="native", view=SequentialView(),
+                                 property_filter=None):
         """
         Retrieves the nearest neighbors to a fingerprint within a distance radius.
 
@@ -210,20 +401,76 @@ class DistributedNearestNeighbors(object):
         radius : float
             A distance radius ]0, 1].
         mode : str
-            'native' to run python implementation or 'cl' to run OpenCL implementation if available.
+            'native' to run python implementation, 'cl' to run OpenCL implementation if available or 'lsh' to
+            search the MinHash/LSH candidates only (approximate, see `NearestNeighbors.build_lsh`).
         view : cameo.parallel.ParallelView, cameo.parallel.SequentialView
             A parallel mode runner.
+        property_filter : PropertyFilter
+            Only search the entries selected by this filter.
         Returns
         -------
         dict
             A dictionary with the InChI Key as key and the distance as value.
         """
-        func = RNN(fingerprint, radius, mode)
+        func = RNN(fingerprint, radius, mode, property_filter=property_filter)
         results = view.map(func, self._nns)
         neighbors = {}
         [neighbors.update(res) for res in results]
         return neighbors
 
+    def k_nearest_neighbors_batch(self, fingerprints, k=5, view=SequentialView()):
+        """
+        Retrieves the K nearest neighbors of a block of fingerprints. Each model is scanned once for all queries.
+
+        Parameters
+        ----------
+        fingerprints : list
+            The fingerprints to use as queries.
+        k : int
+            The number of neighbors to retrieve for each query.
+        view : cameo.parallel.ParallelView, cameo.parallel.SequentialView
+            A parallel mode runner.
+
+        Returns
+        -------
+        tuple
+            Three numpy.array (query index, entry index, distance) sorted by query and distance. The entry index is
+            a position in `index`.
+        """
+        func = KNNBatch(fingerprints, k)
+        results = view.map(func, self._nns)
+        return _top_k_hits(*self._merge_hits(results), k=k)
+
+    def radius_nearest_neighbors_batch(self, fingerprints, radius=0.25, view=SequentialView()):
+        """
+        Retrieves the nearest neighbors of a block of fingerprints within a distance radius. Each model is scanned once
+        for all queries.
+
+        Parameters
+        ----------
+        fingerprints : list
+            The fingerprints to use as queries.
+        radius : float
+            A distance radius ]0, 1].
+        view : cameo.parallel.ParallelView, cameo.parallel.SequentialView
+            A parallel mode runner.
+
+        Returns
+        -------
+        tuple
+            Three numpy.array (query index, entry index, distance) sorted by query and distance. The entry index is
+            a position in `index`.
+        """
+        func = RNNBatch(fingerprints, radius)
+        results = view.map(func, self._nns)
+        return _sort_hits(*self._merge_hits(results))
+
+    def _merge_hits(self, results):
+        offsets = np.cumsum([0] + [len(nn) for nn in self._nns])
+        hits = [(query_idx, db_idx + offset, distances)
+                for (query_idx, db_idx, distances), offset in zip(results, offsets)]
+        return _concatenate_hits(hits)
+
     def distances(self, fingerprint, mode="native", view=SequentialView()):
         """
         Retrieves the distance a fingerprint and all elements in the model.
@@ -247,6 +494,22 @@ class DistributedNearestNeighbors(object):
         [distances.update(res) for res in results]
         return distances
 
+    def build_lsh(self, bands=32, rows=4, seed=0):
+        """
+        Builds the MinHash/LSH tables of every model (see `NearestNeighbors.build_lsh`).
+
+        Parameters
+        ----------
+        bands : int
+            The number of bands.
+        rows : int
+            The number of signature values per band.
+        seed : int
+            The seed of the MinHash permutations.
+        """
+        for nn in self._nns:
+            nn.build_lsh(bands=bands, rows=rows, seed=seed)
+
     def __repr__(self):
         return " | ".join(repr(nn) for nn in self._nns)
 
@@ -257,28 +520,146 @@ class DistributedNearestNeighbors(object):
     def index(self):
         return np.concatenate([nn.index for nn in self._nns])
 
-    def distance_matrix(self, mode="native"):
+    @property
+    def properties(self):
+        """
+        The properties of each entry (in the order of `index`), or None if a model has no properties.
+        """
+        properties = [getattr(nn, 'properties', None) for nn in self._nns]
+        if len(properties) == 0 or any(p is None for p in properties):
+            return None
+        return {name: np.concatenate([p[name] for p in properties]) for name in properties[0]
+                if all(name in p for p in properties)}
+
+    def distance_matrix(self, mode="native", file_path=None, dtype=np.float32, max_distance=None, block_size=1024):
         """
-        Generates a distance matrix between all elements in the models.
+        Generates a distance matrix between all elements in the models (in the order of `index`).
+
+        The matrix is computed in blocks of `block_size` rows. Each block is only compared with itself and the entries
+        after it, and the lower triangle is filled in by symmetry. Each block runs on the multi-threaded kernel.
 
         Parameters
         ----------
         mode : str
-            'native' to run python implementation or 'cl' to run OpenCL implementation if available.
+            Only 'native' is supported.
+        file_path : str
+            Write the matrix to a memory-mapped .npy file instead of keeping it in memory.
+        dtype : numpy.dtype
+            numpy.float32 or numpy.uint16. Distances are stored in uint16 as round(distance * DISTANCE_SCALE) and pairs
+            of empty fingerprints are at distance 2.
+        max_distance : float
+            If given, returns a sparse matrix with the distances up to `max_distance` instead. The diagonal is not
+            stored.
+        block_size : int
+            The number of rows computed at a time.
 
         Returns
         -------
-        numpy.array
+        numpy.ndarray, numpy.memmap, scipy.sparse.csr_matrix
             The distance matrix.
         """
-        index = self.index
-        size = len(index)
-        matrix = np.zeros((size, size), dtype=np.float)
-        for i in range(size):
-            matrix[i] = self.distances(self.feature(i), mode=mode)
-
+        if mode != "native":
+            raise ValueError("distance_matrix only supports 'native' mode")
+        dtype = np.dtype(dtype)
+        if dtype not in (np.dtype(np.float32), np.dtype(np.uint16)):
+            raise ValueError("%s is not one of float32, uint16" % dtype)
+        if not all(isinstance(nn, NearestNeighbors) for nn in self._nns):
+            raise TypeError("distance_matrix requires models of NearestNeighbors")
+
+        if max_distance is not None:
+            graph = self.radius_neighbors_graph(max_distance, block_size=block_size)
+            if dtype == np.uint16:
+                graph.data = _quantize_distances(graph.data)
+            return graph
+
+        size = len(self)
+        if file_path is not None:
+            matrix = np.lib.format.open_memmap(file_path, mode='w+', dtype=dtype, shape=(size, size))
+        else:
+            matrix = np.zeros((size, size), dtype=dtype)
+
+        for rows, queries, targets in self._upper_triangle_blocks(block_size):
+            for column, target in targets:
+                distances = target.distances_batch(queries)
+                distances = _quantize_distances(distances) if dtype == np.uint16 else distances
+                columns = slice(column, column + len(target))
+                matrix[rows, columns] = distances
+                matrix[columns, rows] = distances.T
+
+        if file_path is not None:
+            matrix.flush()
         return matrix
 
+    def iter_radius_neighbors(self, radius, block_size=1024):
+        """
+        Streams the pairs of entries within a distance radius, one block of rows at a time. Each pair is generated
+        once (with the first entry before the second in `index`), and the popcount bound skips the entries that cannot
+        be within the radius.
+
+        Parameters
+        ----------
+        radius : float
+            A distance radius ]0, 1].
+        block_size : int
+            The number of rows searched at a time.
+
+        Returns
+        -------
+        generator
+            Three numpy.array (first entry, second entry, distance) per block. Entries are positions in `index`.
+        """
+        if not all(isinstance(nn, NearestNeighbors) for nn in self._nns):
+            raise TypeError("Models must be NearestNeighbors")
+
+        for rows, queries, targets in self._upper_triangle_blocks(block_size):
+            hits = []
+            for column, target in targets:
+                distances = target.distances_batch(queries, max_distance=radius)
+                query_idx, db_idx = np.nonzero(distances <= radius)
+                upper = db_idx + column > query_idx + rows.start
+                hits.append((query_idx[upper] + rows.start, db_idx[upper] + column,
+                             distances[query_idx[upper], db_idx[upper]]))
+            yield _concatenate_hits(hits)
+
+    def radius_neighbors_graph(self, radius, block_size=1024):
+        """
+        Builds the graph of entries within a distance radius of each other (see `iter_radius_neighbors`).
+
+        Parameters
+        ----------
+        radius : float
+            A distance radius ]0, 1].
+        block_size : int
+            The number of rows searched at a time.
+
+        Returns
+        -------
+        scipy.sparse.csr_matrix
+            A symmetric float32 matrix with the distances between neighbors (in the order of `index`). The diagonal
+            is not stored.
+        """
+        size = len(self)
+        # Only the edges are kept in memory, with 32-bit positions when possible.
+        index_type = np.int32 if size < 2 ** 31 else np.int64
+        blocks = [(first.astype(index_type), second.astype(index_type), distances)
+                  for first, second, distances in self.iter_radius_neighbors(radius, block_size)]
+        first, second, distances = [np.concatenate(column) for column in zip(*blocks)] if blocks else _empty_hits()
+        return csr_matrix((np.concatenate([distances, distances]),
+                           (np.concatenate([first, second]), np.concatenate([second, first]))), shape=(size, size))
+
+    def _upper_triangle_blocks(self, block_size):
+        # Blocks of rows, as unpacked queries, with the models of the entries from the block onwards and their
+        # positions in `index`.
+        offsets = np.cumsum([0] + [len(nn) for nn in self._nns])
+        for i, nn in enumerate(self._nns):
+            for start in range(0, len(nn), block_size):
+                end = min(start + block_size, len(nn))
+                queries = _unpack_rows(nn.features[start:end], nn.features_lengths[start:end])
+                targets = [(offsets[i] + start, NearestNeighbors.from_packed(
+                    nn.index[start:], nn.features[start:], nn.features_lengths[start:], nn.popcounts[start:]))]
+                targets += [(offsets[j], self._nns[j]) for j in range(i + 1, len(self._nns)) if len(self._nns[j]) > 0]
+                yield slice(offsets[i] + start, offsets[i] + end), queries, targets
+
     def feature(self, index):
         """
         Retrieves the fingerprint at a given index. The index is global for the ensemble of models.
@@ -292,29 +673,30 @@ class DistributedNearestNeighbors(object):
         ------
         IndexError
         """
-        total = len(self)
-        if index >= total:
+        if not 0 <= index < len(self):
             raise IndexError(index)
 
-        group = 0
-        off = 0
-        for nn in self._nns:
-            if index + 1 > len(nn):
-                group += 1
-                off += len(nn)
-
-        return self._nns[group][index - off]
+        offsets = np.cumsum([len(nn) for nn in self._nns])
+        group = int(np.searchsorted(offsets, index, side='right'))
+        return self._nns[group][index - (offsets[group - 1] if group > 0 else 0)]
 
     def __len__(self):
         return sum(len(nn) for nn in self._nns)
 
 
 class NearestNeighbors(model_ext.CNearestNeighbors):
-    def __init__(self, index, features, features_lengths, use_cl=False, opencl_context=None):
-        features = np.concatenate(features).astype(np.int32)
+    def __init__(self, index, features, features_lengths, use_cl=False, opencl_context=None, properties=None):
+        features, lengths, _ = model_ext.stack_fingerprints(features)
         features_lengths = np.array(features_lengths, dtype=np.int32)
+        if not np.array_equal(lengths, features_lengths):
+            raise ValueError("Features lengths do not match the fingerprints")
         super(NearestNeighbors, self).__init__(features, features_lengths)
-        self._index = index
+        # Entries are stored sorted by popcount.
+        self._index = index[self.order]
+        self._properties = None
+        if properties is not None:
+            self._properties = {name: np.asarray(properties[name], dtype=PROPERTIES[name])[self.order]
+                                for name in PROPERTIES.names if name in properties}
         self._use_cl = use_cl
         if cl_available and self._use_cl:
             if opencl_context is None:
@@ -323,6 +705,91 @@ class NearestNeighbors(model_ext.CNearestNeighbors):
                 self._ctx = opencl_context
             self._program = cl.Program(self._ctx, nn_source).build()
 
+    @classmethod
+    def from_packed(cls, index, features, features_lengths, popcounts, use_cl=False, properties=None):
+        """
+        Creates a model from fingerprints that are already packed, without copying them if they are sorted by
+        popcount (e.g. memory-mapped from an index file).
+
+        Parameters
+        ----------
+        index : ndarray
+            The InChI Keys.
+        features : ndarray
+            The packed fingerprints (see `model_ext.pack_fingerprints`).
+        features_lengths : ndarray
+            The length of each fingerprint.
+        popcounts : ndarray
+            The number of bits set in each fingerprint.
+        use_cl : bool
+            Use OpenCL to compute distances.
+        properties : dict
+            The properties of each entry (see `marsi.nearest_neighbors.index.PROPERTIES`).
+
+        Returns
+        -------
+        NearestNeighbors
+        """
+        order = np.arange(len(index))
+        if np.any(np.diff(popcounts) < 0):
+            order = np.argsort(popcounts, kind='mergesort')
+            index, features, features_lengths, popcounts = [np.ascontiguousarray(array[order]) for array in
+                                                             (index, features, features_lengths, popcounts)]
+            if properties is not None:
+                properties = {name: column[order] for name, column in properties.items()}
+
+        model = cls.__new__(cls)
+        model.__setstate__({
+            '_index': index,
+            '_features': features,
+            '_features_lengths': features_lengths,
+            '_popcounts': popcounts,
+            '_popcount_offsets': model_ext.popcount_offsets(popcounts, features.shape[1]),
+            '_order': order,
+            '_use_cl': use_cl,
+            '_properties': properties
+        })
+        return model
+
+    @classmethod
+    def load(cls, file_path, use_cl=False):
+        """
+        Memory-maps a model from an index file (see `marsi.nearest_neighbors.index`), with its properties if they were
+        saved.
+
+        Parameters
+        ----------
+        file_path : str
+            The index file.
+        use_cl : bool
+            Use OpenCL to compute distances.
+
+        Returns
+        -------
+        NearestNeighbors
+        """
+        columns = read_index(file_path)
+        properties = None
+        if os.path.exists(properties_file(file_path)):
+            properties = read_properties(properties_file(file_path))
+        return cls.from_packed(columns.index, columns.features, columns.features_lengths, columns.popcounts,
+                               use_cl=use_cl, properties=properties)
+
+    def save(self, file_path):
+        """
+        Writes the model to an index file (see `marsi.nearest_neighbors.index`) and its properties next to it.
+
+        Parameters
+        ----------
+        file_path : str
+            The destination file.
+        """
+        write_index(file_path, self._index, self.features, self.features_lengths, self.popcounts)
+        if self._properties is not None:
+            write_properties(properties_file(file_path), self._properties)
+        elif os.path.exists(properties_file(file_path)):
+            os.remove(properties_file(file_path))
+
     @property
     def cl_context(self):
         if not self._use_cl:
@@ -347,23 +814,82 @@ class NearestNeighbors(model_ext.CNearestNeighbors):
 
     def __getstate__(self):
         state = super(NearestNeighbors, self).__getstate__()
-        state.update({"_index": self._index, "_use_cl": self._use_cl})
+        state.update({"_index": self._index, "_use_cl": self._use_cl, "_properties": self._properties})
         return state
 
     def __getitem__(self, index):
-        start = self.start_positions[index]
-        length = self.start_positions[index]
-        end = start + length
-        return self._features[start:end]
+        # A view of the packed row.
+        return PackedFingerprint(self.features[index], self.features_lengths[index])
 
     def __setstate__(self, state):
         super(NearestNeighbors, self).__setstate__(state)
         self._index = state['_index']
         self._use_cl = state['_use_cl']
+        self._properties = state.get('_properties')
         if cl_available and self._use_cl:
             self.cl_context = cl.create_some_context()
 
-    def knn(self, fingerprint, k, mode="native"):
+    def build_lsh(self, bands=32, rows=4, seed=0):
+        """
+        Builds the MinHash/LSH tables used by the 'lsh' mode. A pair of fingerprints with Tanimoto coefficient `s` is
+        found with probability 1 - (1 - s ** rows) ** bands: more bands or fewer rows improve the recall and return
+        more candidates to re-rank.
+
+        Parameters
+        ----------
+        bands : int
+            The number of bands.
+        rows : int
+            The number of signature values per band.
+        seed : int
+            The seed of the MinHash permutations.
+
+        Returns
+        -------
+        marsi.nearest_neighbors.lsh.MinHashLSH
+        """
+        self._lsh = MinHashLSH(self.features, bands=bands, rows=rows, seed=seed)
+        return self._lsh
+
+    @property
+    def lsh(self):
+        if getattr(self, '_lsh', None) is None:
+            self.build_lsh()
+        return self._lsh
+
+    @property
+    def properties(self):
+        """
+        The properties of each entry (see `marsi.nearest_neighbors.index.PROPERTIES`), or None.
+        """
+        return self._properties
+
+    def _candidate_distances(self, fingerprint, max_distance=None, mode="native", property_filter=None):
+        # Exact distances to the entries that are LSH candidates (in 'lsh' mode), within the popcount bound of
+        # `max_distance` and selected by `property_filter`.
+        fingerprint = model_ext.as_packed(fingerprint)
+        n_words = self.features.shape[1]
+        if mode == "lsh":
+            if len(fingerprint) > 64 * n_words:
+                return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32)
+            rows = self.lsh.candidates(model_ext.pack_fingerprint(fingerprint, n_words))
+        else:
+            rows = np.arange(len(self), dtype=np.int64)
+
+        if max_distance is not None:
+            start, end = self.rows_within(fingerprint.popcount, max_distance)
+            rows = rows[(rows >= start) & (rows < end)]
+
+        if property_filter is not None:
+            if self._properties is None:
+                raise ValueError("%r has no properties to filter" % self)
+            rows = rows[property_filter({name: column[rows] for name, column in self._properties.items()})]
+
+        candidates = NearestNeighbors.from_packed(self._index[rows], self.features[rows], self.features_lengths[rows],
+                                                  self.popcounts[rows])
+        return rows, candidates.distances_py(fingerprint)
+
+    def knn(self, fingerprint, k, mode="native", max_distance=None, property_filter=None):
         """
         K-Nearest Neighbors
 
@@ -375,7 +901,13 @@ class NearestNeighbors(model_ext.CNearestNeighbors):
         k : int
             The number of neighbors to return.
         mode : str
-            'native' to run python implementation or 'cl' to run OpenCL implementation if available.
+            'native' to run python implementation, 'cl' to run OpenCL implementation if available or 'lsh' to
+            search the MinHash/LSH candidates only (approximate, see `NearestNeighbors.build_lsh`).
+        max_distance : float
+            If given, neighbors further than `max_distance` are not returned and entries that cannot be that close
+            are skipped.
+        property_filter : PropertyFilter
+            Only search the entries selected by this filter (before computing any distance).
 
         Returns
         -------
@@ -383,11 +915,35 @@ class NearestNeighbors(model_ext.CNearestNeighbors):
             (Index --> Distance)
 
         """
+        if mode == "lsh" or property_filter is not None:
+            rows, distances = self._candidate_distances(fingerprint, max_distance, mode, property_filter)
+            indices = np.argsort(distances, kind='mergesort')[:k]
+            if max_distance is not None:
+                indices = indices[distances[indices] <= max_distance]
+            return {i.decode('utf-8'): d for i, d in zip(self._index[rows[indices], 0], distances[indices])}
+
+        if max_distance is not None and mode == "native":
+            rows, distances = self.neighbors_within(fingerprint, max_distance)
+            indices = np.argsort(distances, kind='mergesort')[:k]
+            return {i.decode('utf-8'): d for i, d in zip(self._index[rows[indices], 0], distances[indices])}
+
         distances = self.distances(fingerprint, mode)
-        indices = np.argsort(distances)
-        return {i.decode('utf-8'): d for i, d in zip(self._index[indices, 0][:k], distances[indices][:k])}
+        k = min(k, len(distances))
+        if k <= 0:
+            return {}
 
-    def rnn(self, fingerprint, radius, mode="native"):
+        if k < len(distances):
+            indices = np.argpartition(distances, k - 1)[:k]
+        else:
+            indices = np.arange(len(distances))
+        indices = indices[np.argsort(distances[indices])]
+
+        if max_distance is not None:
+            indices = indices[distances[indices] <= max_distance]
+
+        return {i.decode('utf-8'): d for i, d in zip(self._index[indices, 0], distances[indices])}
+
+    def rnn(self, fingerprint, radius, mode="native", property_filter=None):
         """
         Radius-Nearest Neighbors
 
@@ -398,7 +954,10 @@ class NearestNeighbors(model_ext.CNearestNeighbors):
         radius : float
             The maximum distance of neighbors to return.
         mode : str
-            'native' to run python implementation or 'cl' to run OpenCL implementation if available.
+            'native' to run python implementation, 'cl' to run OpenCL implementation if available or 'lsh' to
+            search the MinHash/LSH candidates only (approximate, see `NearestNeighbors.build_lsh`).
+        property_filter : PropertyFilter
+            Only search the entries selected by this filter (before computing any distance).
 
         Returns
         -------
@@ -406,11 +965,84 @@ class NearestNeighbors(model_ext.CNearestNeighbors):
             (Index --> Distance)
 
         """
+        if mode == "lsh" or property_filter is not None:
+            rows, distances = self._candidate_distances(fingerprint, radius, mode, property_filter)
+            indices = np.argsort(distances)
+            indices = indices[distances[indices] <= radius]
+            return {i.decode('utf-8'): d for i, d in zip(self._index[rows[indices], 0], distances[indices])}
+
+        if mode == "native":
+            rows, distances = self.neighbors_within(fingerprint, radius)
+            indices = np.argsort(distances)
+            return {i.decode('utf-8'): d for i, d in zip(self._index[rows[indices], 0], distances[indices])}
+
         distances = self.distances(fingerprint, mode)
         indices = np.argsort(distances)
         indices = indices[distances[indices] <= radius]
         return {i.decode('utf-8'): d for i, d in zip(self._index[indices, 0], distances[indices])}
 
+    def knn_batch(self, fingerprints, k, batch_size=64):
+        """
+        K-Nearest Neighbors for a block of queries.
+
+        Parameters
+        ----------
+        fingerprints : list
+            The fingerprints to search for.
+        k : int
+            The number of neighbors to return for each query.
+        batch_size : int
+            The number of queries compared against the model in one pass.
+
+        Returns
+        -------
+        tuple
+            Three numpy.array (query index, entry index, distance) sorted by query and distance.
+
+        """
+        k = min(k, len(self))
+        if k <= 0:
+            return _empty_hits()
+
+        hits = []
+        for start in range(0, len(fingerprints), batch_size):
+            block = self.distances_batch(fingerprints[start:start + batch_size])
+            rows = np.arange(block.shape[0])[:, np.newaxis]
+            if k < block.shape[1]:
+                nearest = np.argpartition(block, k - 1, axis=1)[:, :k]
+            else:
+                nearest = np.tile(np.arange(block.shape[1]), (block.shape[0], 1))
+            hits.append((np.repeat(rows[:, 0] + start, k), nearest.ravel(), block[rows, nearest].ravel()))
+
+        return _sort_hits(*_concatenate_hits(hits))
+
+    def rnn_batch(self, fingerprints, radius, batch_size=64):
+        """
+        Radius-Nearest Neighbors for a block of queries.
+
+        Parameters
+        ----------
+        fingerprints : list
+            The fingerprints to search for.
+        radius : float
+            The maximum distance of neighbors to return.
+        batch_size : int
+            The number of queries compared against the model in one pass.
+
+        Returns
+        -------
+        tuple
+            Three numpy.array (query index, entry index, distance) sorted by query and distance.
+
+        """
+        hits = []
+        for start in range(0, len(fingerprints), batch_size):
+            block = self.distances_batch(fingerprints[start:start + batch_size], max_distance=radius)
+            rows, columns = np.nonzero(block <= radius)
+            hits.append((rows + start, columns, block[rows, columns]))
+
+        return _sort_hits(*_concatenate_hits(hits))
+
     def distances(self, fingerprint, mode="native"):
         if mode == "native":
             return self.distances_py(fingerprint)
@@ -424,15 +1056,22 @@ class NearestNeighbors(model_ext.CNearestNeighbors):
 
     @timing(debug=True)
     def distances_cl(self, fingerprint):
-        database_buffer = self.input_buffer(self.features)
+        # The kernel works on 32-bit words: each packed row is read as twice as many int32 words and rows with a
+        # different fingerprint length are flagged with a length that never matches the query.
+        features = self.features.view(np.int32)
+        row_length = features.shape[1]
+        database_buffer = self.input_buffer(features)
 
-        start_positions_buffer = self.input_buffer(self.start_positions)
+        start_positions = np.arange(len(self._index), dtype=np.int32) * row_length
+        start_positions_buffer = self.input_buffer(start_positions)
 
-        features_lengths_buffers = self.input_buffer(self.features_lengths)
+        features_lengths = np.where(self.features_lengths == len(fingerprint), row_length, -1).astype(np.int32)
+        features_lengths_buffers = self.input_buffer(features_lengths)
 
-        fingerprint_buffer = self.input_buffer(fingerprint)
+        packed_fingerprint = model_ext.pack_fingerprint(fingerprint, self.features.shape[1]).view(np.int32)
+        fingerprint_buffer = self.input_buffer(packed_fingerprint)
 
-        fingerprint_length = np.array([len(fingerprint)])
+        fingerprint_length = np.array([row_length], dtype=np.int32)
         fingerprint_length_buffer = self.input_buffer(fingerprint_length)
 
         distances = np.zeros(len(self._index), dtype=np.float32)
@@ -507,7 +1146,7 @@ class DBNearestNeighbors(object):
         metabolite = self._session.query(Metabolite).filter(Metabolite.inchi_key == key).one()
         return metabolite.fingerprings[self.fingerprint_format]
 
-    def knn(self, fingerprint, k, mode="native"):
+    def knn(self, fingerprint, k, mode="native", max_distance=None):
         """
         K-Nearest Neighbors
 
@@ -520,6 +1159,8 @@ class DBNearestNeighbors(object):
             The number of neighbors to return.
         mode : str
             'native' to run python implementation or 'cl' to run OpenCL implementation if available.
+        max_distance : float
+            If given, neighbors further than `max_distance` are not returned.
 
         Returns
         -------
@@ -528,10 +1169,13 @@ class DBNearestNeighbors(object):
 
         """
         logger.info("db-nn: searching for k-nearest-neighbors (%i)" % k)
-        fingerprint = fingerprint.reshape(1, -1)
+        fingerprint = np.asarray(fingerprint).reshape(1, -1)
         logger.debug("Reshaped fingerprint %s" % fingerprint)
         distances, indices = self.neighbors.kneighbors(fingerprint, k, True)
         distances, indices = distances[0], indices[0]
+        if max_distance is not None:
+            indices = indices[distances <= max_distance]
+            distances = distances[distances <= max_distance]
         return {self.index[i]: d for i, d in zip(indices, distances)}
 
     def rnn(self, fingerprint, radius, mode="native"):
@@ -554,15 +1198,64 @@ class DBNearestNeighbors(object):
 
         """
         logger.info("db-nn: searching for radius-nearest-neighbors (%.4f)" % radius)
-        fingerprint = fingerprint.reshape(1, -1)
+        fingerprint = np.asarray(fingerprint).reshape(1, -1)
         logger.debug("Reshaped fingerprint %s" % fingerprint)
         distances, indices = self.neighbors.radius_neighbors(fingerprint, radius, True)
         distances, indices = distances[0], indices[0]
         return {self.index[i]: d for i, d in zip(indices, distances)}
 
+    def knn_batch(self, fingerprints, k):
+        """
+        K-Nearest Neighbors for a block of queries.
+
+        Parameters
+        ----------
+        fingerprints : list
+            The fingerprints to search for.
+        k : int
+            The number of neighbors to return for each query.
+
+        Returns
+        -------
+        tuple
+            Three numpy.array (query index, entry index, distance) sorted by query and distance.
+
+        """
+        logger.info("db-nn: searching for k-nearest-neighbors of %i queries (%i)" % (len(fingerprints), k))
+        k = min(k, len(self))
+        if k <= 0 or len(fingerprints) == 0:
+            return _empty_hits()
+        distances, indices = self.neighbors.kneighbors(np.array(fingerprints), k, True)
+        query_idx = np.repeat(np.arange(len(fingerprints)), k)
+        return _sort_hits(*_concatenate_hits([(query_idx, indices.ravel(), distances.ravel())]))
+
+    def rnn_batch(self, fingerprints, radius):
+        """
+        Radius-Nearest Neighbors for a block of queries.
+
+        Parameters
+        ----------
+        fingerprints : list
+            The fingerprints to search for.
+        radius : float
+            The maximum distance of neighbors to return.
+
+        Returns
+        -------
+        tuple
+            Three numpy.array (query index, entry index, distance) sorted by query and distance.
+
+        """
+        logger.info("db-nn: searching for radius-nearest-neighbors of %i queries (%.4f)" % (len(fingerprints), radius))
+        if len(fingerprints) == 0:
+            return _empty_hits()
+        distances, indices = self.neighbors.radius_neighbors(np.array(fingerprints), radius, True)
+        hits = [(np.repeat(q, len(i)), i, d) for q, (i, d) in enumerate(zip(indices, distances))]
+        return _sort_hits(*_concatenate_hits(hits))
+
     def distances(self, fingerprint, mode="native"):
         logger.info("db-nn: calculating all distances")
-        fingerprint = fingerprint.reshape(1, -1)
+        fingerprint = np.asarray(fingerprint).reshape(1, -1)
         distances, indices = self.neighbors.radius_neighbors(fingerprint, 0, True)
         distances, indices = distances[0], indices[0]
         return {self.index[i]: d for i, d in zip(indices, distances)}
@@ -573,21 +1266,18 @@ class DBNearestNeighbors(object):
 
     @property
     def features(self):
-        features = [None for _ in self.index]
-        query = self._session.query(Metabolite).filter(
-            Metabolite.inchi_key.in_(self.index)
-        ).options(load_only('id', 'inchi_key'))
-
-        indices = {inchi_key: i for i, inchi_key in enumerate(self.index)}
-
-        for metabolite in query.yield_per(1000):
-            fp = metabolite.fingerprints[self.fingerprint_format]
-            i = indices[metabolite.inchi_key]
-            features[i] = fp
-
-        assert all(f is not None for f in features)
-
-        return features
+        model = load_fingerprints(self._session, self.fingerprint_format)
+        keys = model.index[:, 0]
+        if len(keys) == 0:
+            raise KeyError("There are no %s fingerprints" % self.fingerprint_format)
+        order = np.argsort(keys)
+        positions = np.searchsorted(keys, self._index[:, 0], sorter=order)
+        rows = order[np.minimum(positions, len(keys) - 1)]
+        assert np.all(keys[rows] == self._index[:, 0])
+
+        features = np.ascontiguousarray(model.features[rows])
+        bits = np.unpackbits(features.view(np.uint8), axis=1, bitorder='little')
+        return bits[:, :int(model.features_lengths.max())].astype(bool)
 
     @property
     def data_frame(self):
@@ -608,3 +1298,116 @@ class DBNearestNeighbors(object):
 
     def __len__(self):
         return len(self._index)
+
+
+# Fingerprint models loaded from the database, by database, fingerprint format and filter (least recently used first).
+FINGERPRINTS_CACHE_SIZE = 8
+_fingerprints_cache = OrderedDict()
+
+
+def _stack_fingerprint_bytes(values):
+    """
+    Stacks fingerprints stored as bytes (see `marsi.io.db.Fingerprint`) into a matrix of 64-bit words (see
+    `model_ext.pack_fingerprints`). The lengths and the number of bits set are read from the headers.
+
+    Returns
+    -------
+    tuple
+        The matrix of words, the length of the fingerprints and the number of bits set in each.
+    """
+    size = len(values[0])
+    if any(len(value) != size for value in values):
+        raise ValueError("Fingerprints have different lengths")
+
+    words = np.frombuffer(b"".join(values), dtype='<u8').reshape(len(values), size // 8)
+    lengths = words[:, 0] & np.uint64(0xFFFFFFFF)
+    if np.any(lengths != lengths[0]):
+        raise ValueError("Fingerprints have different lengths")
+    popcounts = (words[:, 0] >> np.uint64(32)).astype(np.int32)
+    return words[:, 1:].astype(np.uint64), int(lengths[0]), popcounts
+
+
+def load_fingerprints(session, fingerprint_format, custom_query=None, chunk_size=10000):
+    """
+    Loads all the fingerprints of one format from the database.
+
+    The `metabolite_fingerprints` rows are fetched in a single streamed join and stacked as they arrive, together with
+    the properties of the metabolites (see `marsi.nearest_neighbors.index.PROPERTIES`). The model is
+    cached for the process (by database, fingerprint format and filter, up to `FINGERPRINTS_CACHE_SIZE` models) so
+    repeated searches do not query the database again. Use `clear_fingerprints_cache` after the database changes.
+
+    Parameters
+    ----------
+    session : Session
+        SQLAlchemy session.
+    fingerprint_format : str
+        The format of the fingerprint (see pybel.fps)
+    custom_query : ClauseElement
+        A query to filter elements from the database.
+    chunk_size : int
+        The number of rows fetched and stacked at a time.
+
+    Returns
+    -------
+    NearestNeighbors
+        A model with all the fingerprints.
+    """
+    query_key = None
+    if custom_query is not None:
+        query_key = str(custom_query.compile(compile_kwargs={"literal_binds": True}))
+    key = (str(session.get_bind().url), fingerprint_format, query_key)
+
+    if key not in _fingerprints_cache:
+        logger.info("db-nn: loading %s fingerprints" % fingerprint_format)
+        query = session.query(Metabolite.inchi_key, type_coerce(MetaboliteFingerprint.fingerprint, LargeBinary),
+                              Metabolite.num_atoms, Metabolite.num_bonds, Metabolite.num_rings,
+                              Metabolite.analog).join(
+            MetaboliteFingerprint, MetaboliteFingerprint.metabolite_id == Metabolite.id
+        ).filter(MetaboliteFingerprint.fingerprint_type == fingerprint_format)
+        if custom_query is not None:
+            query = query.filter(custom_query)
+
+        keys = []
+        chunks = []
+        popcounts = []
+        properties = {name: [] for name in ('num_atoms', 'num_bonds', 'num_rings', 'analog')}
+        length = 0
+        rows = iter(query.yield_per(chunk_size))
+        chunk = list(itertools.islice(rows, chunk_size))
+        while len(chunk) > 0:
+            chunk_keys, values, num_atoms, num_bonds, num_rings, analog = zip(*chunk)
+            features, chunk_length, chunk_popcounts = _stack_fingerprint_bytes(values)
+            if len(chunks) > 0 and chunk_length != length:
+                raise ValueError("%s fingerprints have different lengths" % fingerprint_format)
+            keys.extend(chunk_keys)
+            chunks.append(features)
+            popcounts.append(chunk_popcounts)
+            for name, values in zip(('num_atoms', 'num_bonds', 'num_rings', 'analog'),
+                                    (num_atoms, num_bonds, num_rings, analog)):
+                properties[name].append(np.array([bool(v) if name == 'analog' else v for v in values],
+                                                 dtype=PROPERTIES[name]))
+            length = chunk_length
+            chunk = list(itertools.islice(rows, chunk_size))
+
+        index = np.array(keys, dtype=INCHI_KEY_TYPE).reshape(-1, 1)
+        features = np.concatenate(chunks) if len(chunks) > 0 else np.zeros((0, 0), dtype=np.uint64)
+        popcounts = np.concatenate(popcounts) if len(popcounts) > 0 else np.zeros(0, dtype=np.int32)
+        properties = {name: np.concatenate(columns) if len(columns) > 0 else np.zeros(0, dtype=PROPERTIES[name])
+                      for name, columns in properties.items()}
+        # Solubility is not stored in the database, the model has no solubility column (see PropertyFilter).
+        _fingerprints_cache[key] = NearestNeighbors.from_packed(index, features,
+                                                                np.full(len(keys), length, dtype=np.int32),
+                                                                popcounts, properties=properties)
+        while len(_fingerprints_cache) > FINGERPRINTS_CACHE_SIZE:
+            _fingerprints_cache.popitem(last=False)
+
+    model = _fingerprints_cache.pop(key)
+    _fingerprints_cache[key] = model
+    return model
+
+
+def clear_fingerprints_cache():
+    """
+    Forgets the fingerprints loaded by `load_fingerprints`.
+    """
+    _fingerprints_cache.clear()
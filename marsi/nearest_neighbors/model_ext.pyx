@@ -14,41 +14,341 @@
 
 import cython
 cimport cython
+from cython.parallel cimport prange
 
 import numpy as np
 cimport numpy as np
 
-from marsi.chemistry.common_ext cimport _tanimoto_distance
+from libc.math cimport INFINITY, ceil, floor
+
+from marsi.chemistry.fingerprint import PackedFingerprint
 
 ctypedef np.int32_t INT32_t
+ctypedef np.int64_t INT64_t
+ctypedef np.uint64_t UINT64_t
 ctypedef np.float32_t FLOAT32_t
 
 
-cdef extern int __builtin_popcount(unsigned int) nogil
+IF UNAME_SYSNAME == "Windows":
+    cdef extern from "intrin.h":
+        unsigned long long __popcnt64(unsigned long long) nogil
+
+    cdef inline int popcount64(UINT64_t var) nogil:
+        return <int>__popcnt64(var)
+
+ELSE:
+    cdef extern int __builtin_popcountll(unsigned long long) nogil
+
+    cdef inline int popcount64(UINT64_t var) nogil:
+        return __builtin_popcountll(var)
+
+
+cdef inline Py_ssize_t n_words_for(Py_ssize_t n_bits) nogil:
+    return (n_bits + 63) // 64
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef void _pack_bits(const INT32_t[::1] bits, Py_ssize_t start, Py_ssize_t length, UINT64_t[::1] words) nogil:
+    cdef Py_ssize_t i
+    for i in range(length):
+        if bits[start + i] != 0:
+            words[i >> 6] |= (<UINT64_t>1) << (i & 63)
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef int _popcount(const UINT64_t[::1] words) nogil:
+    cdef Py_ssize_t w
+    cdef int count = 0
+    for w in range(words.shape[0]):
+        count += popcount64(words[w])
+    return count
+
+
+def as_packed(fingerprint):
+    """
+    The fingerprint as a `PackedFingerprint`. Packed fingerprints are returned as they are, other fingerprints (arrays,
+    lists or bitarrays of bits) are packed.
+
+    Parameters
+    ----------
+    fingerprint : PackedFingerprint, ndarray, list, bitarray
+        The fingerprint.
+
+    Returns
+    -------
+    PackedFingerprint
+    """
+    if isinstance(fingerprint, PackedFingerprint):
+        return fingerprint
+    return PackedFingerprint.from_bits(fingerprint)
+
+
+def pack_fingerprint(fingerprint, n_words=None):
+    """
+    Packs a binary fingerprint (one value per bit) into 64-bit words.
+
+    Bit *i* of the fingerprint is stored in word *i // 64* at position *i % 64*. Any non-zero value is a set bit.
+
+    Parameters
+    ----------
+    fingerprint : PackedFingerprint, ndarray, list, bitarray
+        The fingerprint bits.
+    n_words : int
+        The number of words of the output (default: the minimum number of words to hold the fingerprint).
+
+    Returns
+    -------
+    ndarray
+        A uint64 array with the packed fingerprint.
+    """
+    packed = as_packed(fingerprint)
+    words = packed.words
+    if n_words is None or n_words == words.shape[0]:
+        return words
+    elif words.shape[0] > n_words:
+        raise ValueError("%i bits do not fit in %i words" % (len(packed), n_words))
+    padded = np.zeros(n_words, dtype=np.uint64)
+    padded[:words.shape[0]] = words
+    return padded
+
+
+def stack_fingerprints(fingerprints):
+    """
+    Stacks fingerprints into a 2-D matrix of 64-bit words (one row per fingerprint, see `pack_fingerprints`).
+
+    Parameters
+    ----------
+    fingerprints : list
+        The fingerprints (see `as_packed`).
+
+    Returns
+    -------
+    tuple
+        The C-contiguous uint64 matrix, the length and the number of bits set of each fingerprint.
+    """
+    fingerprints = [as_packed(fingerprint) for fingerprint in fingerprints]
+    n_words = max([fingerprint.words.shape[0] for fingerprint in fingerprints] or [0])
+    matrix = np.zeros((len(fingerprints), n_words), dtype=np.uint64)
+    for i, fingerprint in enumerate(fingerprints):
+        matrix[i, :fingerprint.words.shape[0]] = fingerprint.words
+    lengths = np.array([len(fingerprint) for fingerprint in fingerprints], dtype=np.int32)
+    counts = np.array([fingerprint.popcount for fingerprint in fingerprints], dtype=np.int32)
+    return matrix, lengths, counts
+
+
+def pack_fingerprints(features, features_lengths):
+    """
+    Packs concatenated binary fingerprints into a 2-D matrix of 64-bit words (one row per fingerprint).
+
+    Parameters
+    ----------
+    features : ndarray
+        The concatenated fingerprint bits.
+    features_lengths : ndarray
+        The length (in bits) of each fingerprint.
+
+    Returns
+    -------
+    ndarray
+        A C-contiguous uint64 matrix. Rows shorter than the longest fingerprint are padded with zeros.
+    """
+    cdef np.ndarray[INT32_t, ndim=1] bits = np.ascontiguousarray(features, dtype=np.int32)
+    cdef np.ndarray[INT32_t, ndim=1] lengths = np.ascontiguousarray(features_lengths, dtype=np.int32)
+    cdef Py_ssize_t n = lengths.shape[0]
+    cdef Py_ssize_t n_words = n_words_for(lengths.max()) if n > 0 else 0
+
+    if lengths.sum() != bits.shape[0]:
+        raise ValueError("Features lengths do not match the size of the features (%i != %i)" %
+                         (lengths.sum(), bits.shape[0]))
+
+    cdef np.ndarray[UINT64_t, ndim=2] matrix = np.zeros((n, n_words), dtype=np.uint64)
+    cdef UINT64_t[:, ::1] matrix_view = matrix
+    cdef const INT32_t[::1] bits_view = bits
+    cdef Py_ssize_t i, start = 0
+    for i in range(n):
+        _pack_bits(bits_view, start, lengths[i], matrix_view[i])
+        start += lengths[i]
+
+    return matrix
+
+
+def unpack_fingerprint(words, int length):
+    """
+    Unpacks a fingerprint packed with `pack_fingerprint`.
+
+    Parameters
+    ----------
+    words : ndarray
+        The packed fingerprint.
+    length : int
+        The number of bits of the fingerprint.
+
+    Returns
+    -------
+    ndarray
+        An int32 array of 0's and 1's.
+    """
+    cdef const UINT64_t[::1] _words = np.ascontiguousarray(words, dtype=np.uint64)
+    cdef np.ndarray[INT32_t, ndim=1] bits = np.zeros(length, dtype=np.int32)
+    cdef Py_ssize_t i
+    for i in range(length):
+        bits[i] = (_words[i >> 6] >> (i & 63)) & 1
+    return bits
+
+
+def popcounts(features):
+    """
+    Number of bits set in each row of a packed fingerprint matrix.
+
+    Parameters
+    ----------
+    features : ndarray
+        A uint64 matrix (see `pack_fingerprints`).
+
+    Returns
+    -------
+    ndarray
+        An int32 array with one value per row.
+    """
+    cdef const UINT64_t[:, ::1] _features = np.ascontiguousarray(features, dtype=np.uint64)
+    cdef np.ndarray[INT32_t, ndim=1] counts = np.zeros(_features.shape[0], dtype=np.int32)
+    cdef Py_ssize_t i
+    for i in range(_features.shape[0]):
+        counts[i] = _popcount(_features[i])
+    return counts
+
+
+# Number of database rows compared against a whole block of queries before moving on (keeps the rows in cache).
+cdef enum:
+    TILE_SIZE = 256
+
+# Tolerance on the Tanimoto bound, so that the pruning stays conservative with respect to the float32 distances.
+cdef double BOUND_TOLERANCE = 1e-6
+
+
+@cython.cdivision(True)
+cdef inline float _tanimoto_distance_packed(const UINT64_t *fp1, int length1, int count1, const UINT64_t *fp2,
+                                            int length2, int count2, Py_ssize_t n_words) nogil:
+    """
+    Tanimoto distance between two packed fingerprints.
+
+    Follows the same arithmetic as `marsi.chemistry.common_ext.tanimoto_distance`: fingerprints with a different length
+    are at distance 2 (coefficient -1) and the coefficient is computed in double precision and stored as float.
+    """
+    cdef Py_ssize_t w
+    cdef int and_bits = 0
+    cdef float coefficient
+
+    if length1 != length2:
+        coefficient = -1.0
+    else:
+        for w in range(n_words):
+            and_bits += popcount64(fp1[w] & fp2[w])
+        coefficient = <double>and_bits / <double>(count1 + count2 - and_bits)
+    return 1 - coefficient
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef void _tanimoto_distances(const UINT64_t[:, ::1] features, const INT32_t[::1] lengths,
+                              const INT32_t[::1] counts, const UINT64_t[::1] query, int query_length,
+                              int query_count, FLOAT32_t[::1] distances) nogil:
+    """
+    Tanimoto distance between a packed query and every row of a packed matrix. Rows are split across threads.
+    """
+    cdef Py_ssize_t i
+    cdef Py_ssize_t n = features.shape[0]
+    cdef Py_ssize_t n_words = min(query.shape[0], features.shape[1])
+
+    for i in prange(n, schedule='static'):
+        distances[i] = _tanimoto_distance_packed(&features[i, 0], lengths[i], counts[i], &query[0],
+                                                 query_length, query_count, n_words)
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef void _tanimoto_distances_block(const UINT64_t[:, ::1] features, const INT32_t[::1] lengths,
+                                    const INT32_t[::1] counts, const UINT64_t[:, ::1] queries,
+                                    const INT32_t[::1] query_lengths, const INT32_t[::1] query_counts,
+                                    const INT64_t[::1] query_starts, const INT64_t[::1] query_ends,
+                                    FLOAT32_t[:, ::1] distances) nogil:
+    """
+    Tanimoto distances between a block of packed queries and the rows of a packed matrix. Each query is only
+    compared with the rows between its start and end.
+
+    The matrix is walked in tiles of `TILE_SIZE` rows and every query is compared against a tile while it is still in
+    cache. Tiles are split across threads.
+    """
+    cdef Py_ssize_t tile, start, end, q, i
+    cdef Py_ssize_t n = features.shape[0]
+    cdef Py_ssize_t n_queries = queries.shape[0]
+    cdef Py_ssize_t n_words = min(queries.shape[1], features.shape[1])
+    cdef Py_ssize_t n_tiles = (n + TILE_SIZE - 1) // TILE_SIZE
+
+    for tile in prange(n_tiles, schedule='static'):
+        start = tile * TILE_SIZE
+        end = min(start + TILE_SIZE, n)
+        for q in range(n_queries):
+            for i in range(max(start, query_starts[q]), min(end, query_ends[q])):
+                distances[q, i] = _tanimoto_distance_packed(&features[i, 0], lengths[i], counts[i], &queries[q, 0],
+                                                            query_lengths[q], query_counts[q], n_words)
+
 
 @cython.nonecheck(False)
 @cython.cdivision(True)
 cdef class CNearestNeighbors:
+    """
+    Tanimoto distance engine over a packed fingerprint matrix.
+
+    Fingerprints are binary vectors packed in 64-bit words (one row per entry, see `pack_fingerprints`) with their
+    original lengths and the number of bits set in each row. It is built from the concatenated fingerprint bits or from
+    an already packed matrix (see `stack_fingerprints`). Queries can be `PackedFingerprint`s, whose words are used
+    without unpacking, or any sequence of bits.
+
+    Rows are stored sorted by the number of bits set (popcount) and `popcount_offsets[c]` is the first row with at
+    least `c` bits set. Since the Tanimoto coefficient between fingerprints with `a` and `b` bits set is at most
+    min(a, b) / max(a, b) (Swamidass & Baldi, 2007), the rows within a distance radius of a query are all in one
+    contiguous range, and searches bounded by a distance only scan that range.
+
+    `order` holds, for each stored row, the position of the fingerprint in the input.
+    """
     cdef np.ndarray _features
     cdef np.ndarray _features_lengths
-    cdef np.ndarray _start_positions
+    cdef np.ndarray _popcounts
+    cdef np.ndarray _popcount_offsets
+    cdef np.ndarray _order
 
     def __init__(self, features, features_lengths):
-        self._features = features
-        self._features_lengths = features_lengths
-        self._start_positions = None
+        features_lengths = np.ascontiguousarray(features_lengths, dtype=np.int32)
+        if np.ndim(features) == 1:
+            features = pack_fingerprints(features, features_lengths)
+        else:
+            features = np.ascontiguousarray(features, dtype=np.uint64)
+        counts = popcounts(features)
+
+        self._order = np.argsort(counts, kind='mergesort')
+        self._features = np.ascontiguousarray(features[self._order])
+        self._features_lengths = features_lengths[self._order]
+        self._popcounts = counts[self._order]
+        self._popcount_offsets = popcount_offsets(self._popcounts, self._features.shape[1])
 
     def __getstate__(self):
         return {
             '_features': self._features,
             '_features_lengths': self._features_lengths,
-            '_start_positions': self._start_positions
+            '_popcounts': self._popcounts,
+            '_popcount_offsets': self._popcount_offsets,
+            '_order': self._order
         }
 
     def __setstate__(self, state):
         self._features = state['_features']
         self._features_lengths = state['_features_lengths']
-        self._start_positions = state['_start_positions']
+        self._popcounts = state['_popcounts']
+        self._popcount_offsets = state['_popcount_offsets']
+        self._order = state['_order']
 
     @property
     def features(self):
@@ -59,35 +359,175 @@ cdef class CNearestNeighbors:
         return self._features_lengths
 
     @property
-    def start_positions(self):
-        if self._start_positions is None:
-            self._start_positions = self._calc_start_positions()
-        return self._start_positions
+    def popcounts(self):
+        return self._popcounts
+
+    @property
+    def popcount_offsets(self):
+        return self._popcount_offsets
+
+    @property
+    def order(self):
+        return self._order
+
+    def rows_within(self, fingerprint_popcount, max_distance):
+        """
+        The range of rows that can be within `max_distance` of a fingerprint with `fingerprint_popcount` bits set.
+
+        Parameters
+        ----------
+        fingerprint_popcount : int
+            The number of bits set in the query.
+        max_distance : float
+            The largest distance of interest.
+
+        Returns
+        -------
+        tuple
+            (start, end) of the rows to scan.
+        """
+        cdef Py_ssize_t n = self._features_lengths.shape[0]
+        cdef Py_ssize_t max_count = self._popcount_offsets.shape[0] - 2
+        cdef double similarity = 1.0 - max_distance - BOUND_TOLERANCE
+        cdef Py_ssize_t low, high
+
+        if not similarity > 0:
+            return 0, n
+
+        low = <Py_ssize_t>ceil(fingerprint_popcount * similarity)
+        high = <Py_ssize_t>floor(fingerprint_popcount / similarity)
+        low = min(max(low, 0), max_count + 1)
+        high = min(max(high, -1), max_count)
+        return int(self._popcount_offsets[low]), int(self._popcount_offsets[high + 1])
 
     def distances_py(self, fingerprint):
-        return self._distances(fingerprint)
+        return self._distances(as_packed(fingerprint), INFINITY)
+
+    def distances_bounded(self, fingerprint, max_distance):
+        """
+        Distances between a fingerprint and all entries, skipping the entries that cannot be within `max_distance`.
+
+        Parameters
+        ----------
+        fingerprint : PackedFingerprint, ndarray
+            The query fingerprint.
+        max_distance : float
+            The largest distance of interest.
+
+        Returns
+        -------
+        ndarray
+            A float32 array with one distance per entry. Entries that were skipped have an infinite distance.
+        """
+        return self._distances(as_packed(fingerprint), max_distance)
+
+    def neighbors_within(self, fingerprint, max_distance):
+        """
+        Entries within `max_distance` of a fingerprint. Only the rows allowed by the popcount bound are scanned.
+
+        Parameters
+        ----------
+        fingerprint : ndarray
+            The query fingerprint.
+        max_distance : float
+            The maximum distance.
+
+        Returns
+        -------
+        tuple
+            (rows, distances) of the entries within `max_distance`.
+        """
+        query = as_packed(fingerprint)
+        start, end = self.rows_within(query.popcount, max_distance)
+        distances = self._distances_range(query, start, end)
+        rows = np.flatnonzero(distances <= max_distance)
+        return rows + start, distances[rows]
+
+    def distances_batch(self, fingerprints, max_distance=INFINITY):
+        """
+        Distances between a block of fingerprints and all entries.
+
+        Parameters
+        ----------
+        fingerprints : list, ndarray
+            The query fingerprints (one per row).
+        max_distance : float
+            The largest distance of interest. Entries that cannot be within this distance of a query are skipped.
+
+        Returns
+        -------
+        ndarray
+            A float32 matrix with one row per query and one column per entry. Entries that were skipped have an
+            infinite distance.
+        """
+        cdef Py_ssize_t n = self._features_lengths.shape[0]
+        cdef Py_ssize_t n_queries = len(fingerprints)
+        cdef np.ndarray[FLOAT32_t, ndim=2] distances = np.full((n_queries, n), INFINITY, dtype=np.float32)
+        if n == 0 or n_queries == 0:
+            return distances
+
+        packed_queries, query_lengths, query_counts = stack_fingerprints(fingerprints)
+        query_ranges = np.array([self.rows_within(count, max_distance) for count in query_counts], dtype=np.int64)
+
+        cdef const UINT64_t[:, ::1] features = self._features
+        cdef const INT32_t[::1] lengths = self._features_lengths
+        cdef const INT32_t[::1] counts = self._popcounts
+        cdef const UINT64_t[:, ::1] queries = packed_queries
+        cdef const INT32_t[::1] queries_lengths = query_lengths
+        cdef const INT32_t[::1] queries_counts = query_counts
+        cdef const INT64_t[::1] queries_starts = np.ascontiguousarray(query_ranges[:, 0])
+        cdef const INT64_t[::1] queries_ends = np.ascontiguousarray(query_ranges[:, 1])
+        cdef FLOAT32_t[:, ::1] out = distances
+
+        with nogil:
+            _tanimoto_distances_block(features, lengths, counts, queries, queries_lengths, queries_counts,
+                                      queries_starts, queries_ends, out)
+
+        return distances
+
+    cdef _distances(self, fingerprint, double max_distance):
+        cdef Py_ssize_t n = self._features_lengths.shape[0]
+        cdef np.ndarray[FLOAT32_t, ndim=1] distances = np.full(n, INFINITY, dtype=np.float32)
+        if n == 0:
+            return distances
+
+        start, end = self.rows_within(fingerprint.popcount, max_distance)
+        distances[start:end] = self._distances_range(fingerprint, start, end)
+        return distances
 
-    cdef np.ndarray[INT32_t, ndim=1] _calc_start_positions(self):
-        cdef unsigned int i = 0
-        cdef unsigned int n = len(self._features_lengths)
+    cdef _distances_range(self, fingerprint, Py_ssize_t start, Py_ssize_t end):
+        cdef np.ndarray[FLOAT32_t, ndim=1] distances = np.zeros(end - start, dtype=np.float32)
+        if end <= start:
+            return distances
 
-        cdef np.ndarray[INT32_t, ndim=1] res = np.empty(n, dtype=np.int32)
+        cdef const UINT64_t[:, ::1] features = self._features[start:end]
+        cdef const INT32_t[::1] lengths = self._features_lengths[start:end]
+        cdef const INT32_t[::1] counts = self._popcounts[start:end]
+        cdef const UINT64_t[::1] query = fingerprint.words
+        cdef FLOAT32_t[::1] out = distances
+        cdef int query_length = fingerprint.length
+        cdef int query_count = fingerprint.popcount
 
-        res[0] = i
-        for pos in range(n-1):
-            i += self._features_lengths[pos]
-            res[pos+1] = i
+        with nogil:
+            _tanimoto_distances(features, lengths, counts, query, query_length, query_count, out)
 
-        return res
+        return distances
 
-    cdef np.ndarray[FLOAT32_t, ndim=1] _distances(self, np.ndarray[INT32_t, ndim=1] fingerprint):
-        cdef unsigned int n = len(self._features_lengths)
-        cdef np.ndarray[FLOAT32_t, ndim=1] _distances = np.zeros(n, dtype=np.float32)
 
-        for i in range(n):
-            start = self.start_positions[i]
-            size = self._features_lengths[i]
-            _distances[i] = _tanimoto_distance(fingerprint, self._features[start:start+size])
+def popcount_offsets(counts, n_words):
+    """
+    Offsets table of a packed matrix sorted by popcount.
 
-        return _distances
+    Parameters
+    ----------
+    counts : ndarray
+        The (sorted) number of bits set in each row.
+    n_words : int
+        The number of words of each row.
 
+    Returns
+    -------
+    ndarray
+        An int64 array where position `c` is the first row with at least `c` bits set (for c in 0..64 * n_words + 1).
+    """
+    return np.searchsorted(counts, np.arange(64 * n_words + 2)).astype(np.int64)
@@ -0,0 +1,165 @@
+# Copyright 2016 Chr. Hansen A/S and The Novo Nordisk Foundation Center for Biosustainability, DTU.
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+# http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Process-parallel execution of nearest neighbors searches.
+
+A multiprocessing view pickles the models of a `DistributedNearestNeighbors` with every query. `SharedMemoryView`
+copies the models' columns to shared memory once and keeps a pool of workers attached to them, so each query only sends
+the runner (e.g. `KNN`) to the workers and the hits back.
+"""
+import logging
+import multiprocessing
+
+import numpy as np
+
+try:
+    from multiprocessing import shared_memory
+except ImportError:  # pragma: no cover
+    shared_memory = None
+
+from marsi.nearest_neighbors.model import NearestNeighbors
+
+__all__ = ['SharedMemoryView']
+
+logger = logging.getLogger(__name__)
+
+COLUMNS = ('index', 'features', 'features_lengths', 'popcounts')
+
+# Models of the worker process (one per shard), built by `_attach`.
+_shards = []
+_blocks = []
+
+
+def _share(array):
+    array = np.ascontiguousarray(array)
+    block = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+    np.ndarray(array.shape, dtype=array.dtype, buffer=block.buf)[...] = array
+    return block, (block.name, array.dtype.str, array.shape)
+
+
+def _attach_array(descriptor):
+    name, dtype, shape = descriptor
+    block = shared_memory.SharedMemory(name=name)
+    _blocks.append(block)
+    return np.ndarray(shape, dtype=np.dtype(dtype), buffer=block.buf)
+
+
+def _attach(descriptors):
+    del _shards[:], _blocks[:]
+    for use_cl, columns, properties in descriptors:
+        arrays = [_attach_array(descriptor) for descriptor in columns]
+        if properties is not None:
+            properties = {name: _attach_array(descriptor) for name, descriptor in properties.items()}
+        _shards.append(NearestNeighbors.from_packed(*arrays, use_cl=use_cl, properties=properties))
+
+
+def _run(task):
+    func, shard = task
+    return func(_shards[shard])
+
+
+class SharedMemoryView(object):
+    """
+    A view that runs the searches of a `DistributedNearestNeighbors` on persistent worker processes.
+
+    The models are copied to shared memory when the view is created. Use it as the `view` of the searches on that
+    model and shut it down when done (or use it as a context manager):
+
+    >>> with SharedMemoryView(model, processes=4) as view:
+    ...     model.k_nearest_neighbors(fingerprint, k=10, view=view)
+
+    Parameters
+    ----------
+    model : DistributedNearestNeighbors
+        A model made of NearestNeighbors.
+    processes : int
+        The number of worker processes (defaults to the number of CPUs).
+    """
+
+    def __init__(self, model, processes=None):
+        if shared_memory is None:
+            raise RuntimeError("SharedMemoryView requires multiprocessing.shared_memory (python >= 3.8)")
+
+        self._nns = list(model)
+        self._shard_ids = {}
+        self._blocks = []
+        descriptors = []
+        try:
+            for i, nn in enumerate(self._nns):
+                if not isinstance(nn, NearestNeighbors):
+                    raise TypeError("%s cannot be shared, only NearestNeighbors can" % type(nn).__name__)
+                columns = [self._share(getattr(nn, column)) for column in COLUMNS]
+                properties = None
+                if nn.properties is not None:
+                    properties = {name: self._share(column) for name, column in nn.properties.items()}
+                descriptors.append((nn._use_cl, columns, properties))
+                self._shard_ids[id(nn)] = i
+
+            self.processes = processes or multiprocessing.cpu_count()
+            self._pool = multiprocessing.Pool(self.processes, initializer=_attach, initargs=(descriptors,))
+        except Exception:
+            self._pool = None
+            self.shutdown()
+            raise
+
+        logger.debug("Shared %i models with %i processes" % (len(self._nns), self.processes))
+
+    def _share(self, array):
+        block, descriptor = _share(array)
+        self._blocks.append(block)
+        return descriptor
+
+    def map(self, func, nns):
+        """
+        Runs `func` on each model.
+
+        Parameters
+        ----------
+        func : callable
+            A runner (e.g. KNN) that takes a model.
+        nns : list
+            Models of the model this view was created with.
+
+        Returns
+        -------
+        list
+            The result of each model.
+        """
+        try:
+            tasks = [(func, self._shard_ids[id(nn)]) for nn in nns]
+        except KeyError:
+            raise ValueError("SharedMemoryView can only run the models it was created with")
+        return self._pool.map(_run, tasks, chunksize=1)
+
+    def shutdown(self):
+        """
+        Stops the workers and releases the shared memory.
+        """
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+        for block in self._blocks:
+            block.close()
+            block.unlink()
+        self._blocks = []
+
+    def __len__(self):
+        return self.processes
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.shutdown()
@@ -0,0 +1,239 @@
+# Copyright 2017 Chr. Hansen A/S and The Novo Nordisk Foundation Center for Biosustainability, DTU.
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+# http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Local analog search server.
+
+`SearchServer` keeps the search models in memory and answers requests on a Unix socket (`marsi serve`). Clients
+authenticate with a key the server writes next to the socket, readable only by the user who started it. Use `connect`
+to get a `SearchClient` when a server is running.
+"""
+import logging
+import multiprocessing
+import os
+import threading
+from multiprocessing.connection import Listener, Client, AuthenticationError
+
+from sqlalchemy.orm import scoped_session, sessionmaker
+
+from marsi.chemistry.molecule import Molecule
+from marsi.config import default_session
+from marsi.nearest_neighbors import load_nearest_neighbors_model_from_db, search_closest_compounds, similarity_pool, \
+    model_ext
+from marsi.utils import data_dir
+
+__all__ = ['SearchServer', 'SearchClient', 'connect', 'SOCKET_FILE']
+
+logger = logging.getLogger(__name__)
+
+SOCKET_FILE = os.path.join(data_dir, "search.sock")
+
+METHODS = ('ping', 'knn', 'rnn', 'search_closest_compounds')
+
+
+def _authkey_file(address):
+    return address + ".key"
+
+
+class SearchServer(object):
+    """
+    Answers nearest neighbors and analog searches with models loaded once.
+
+    Parameters
+    ----------
+    fpformats : list
+        The fingerprint formats to load when the server starts (others are loaded on the first request).
+    address : str
+        The Unix socket.
+    models : dict
+        Preloaded models by fingerprint format (default: loaded from the database).
+    session : Session
+        SQLAlchemy session. Only its engine is used, each connection runs in a session of its own.
+    processes : int
+        The number of MCS worker processes (defaults to the number of CPUs).
+    """
+
+    def __init__(self, fpformats=("maccs",), address=SOCKET_FILE, models=None, session=default_session,
+                 processes=None):
+        self.address = address
+        self._sessions = None
+        if session is not None:
+            self._sessions = scoped_session(sessionmaker(bind=session.get_bind()))
+        self._models = dict(models or {})
+        self._lock = threading.Lock()
+        self._authkey = None
+        self._running = False
+        for fpformat in fpformats:
+            self._model(fpformat)
+
+        # Starts the MCS workers now (before the connection threads) rather than on the first search.
+        pool = similarity_pool(processes)
+        for future in [pool.submit(os.getpid) for _ in range(processes or multiprocessing.cpu_count())]:
+            future.result()
+
+    @property
+    def session(self):
+        """
+        The session of the current thread.
+        """
+        return self._sessions() if self._sessions is not None else None
+
+    def _model(self, fpformat):
+        with self._lock:
+            if fpformat not in self._models:
+                logger.info("Loading %s search model" % fpformat)
+                self._models[fpformat] = load_nearest_neighbors_model_from_db(fpformat=fpformat, session=self.session)
+            return self._models[fpformat]
+
+    def ping(self):
+        return sorted(self._models.keys())
+
+    def knn(self, fingerprint, k=5, fpformat="maccs", mode="native", property_filter=None):
+        return self._model(fpformat).k_nearest_neighbors(fingerprint, k=k, mode=mode, property_filter=property_filter)
+
+    def rnn(self, fingerprint, radius=0.25, fpformat="maccs", mode="native", property_filter=None):
+        return self._model(fpformat).radius_nearest_neighbors(fingerprint, radius=radius, mode=mode,
+                                                              property_filter=property_filter)
+
+    def search_closest_compounds(self, inchi, fpformat="maccs", prefilter=True, **kwargs):
+        # The models are loaded from the database, so they are filtered as in `search_closest_compounds` without one.
+        return search_closest_compounds(Molecule.from_inchi(inchi), nn_model=self._model(fpformat), fpformat=fpformat,
+                                        session=self.session, prefilter=prefilter, **kwargs)
+
+    def serve_forever(self):
+        """
+        Listens on `address` until `shutdown` is called.
+        """
+        if os.path.exists(self.address):
+            os.remove(self.address)
+
+        self._authkey = os.urandom(32)
+        authkey_file = _authkey_file(self.address)
+        with os.fdopen(os.open(authkey_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'wb') as key_file:
+            key_file.write(self._authkey)
+
+        listener = Listener(self.address, family='AF_UNIX', authkey=self._authkey)
+        self._running = True
+        logger.info("Listening on %s" % self.address)
+        try:
+            while self._running:
+                try:
+                    connection = listener.accept()
+                except AuthenticationError:
+                    continue
+                if not self._running:
+                    connection.close()
+                    break
+                thread = threading.Thread(target=self._handle, args=(connection,))
+                thread.daemon = True
+                thread.start()
+        finally:
+            self._running = False
+            listener.close()
+            if os.path.exists(authkey_file):
+                os.remove(authkey_file)
+
+    def shutdown(self):
+        """
+        Stops listening.
+        """
+        if self._running:
+            self._running = False
+            # Wakes up the listener.
+            Client(self.address, family='AF_UNIX', authkey=self._authkey).close()
+
+    def _handle(self, connection):
+        try:
+            with connection:
+                while True:
+                    try:
+                        method, kwargs = connection.recv()
+                    except (EOFError, OSError):
+                        return
+                    try:
+                        if method not in METHODS:
+                            raise ValueError("Unknown method %s" % method)
+                        response = (True, getattr(self, method)(**kwargs))
+                    except Exception as e:
+                        logger.exception("Error running %s" % method)
+                        response = (False, e)
+                    connection.send(response)
+        finally:
+            if self._sessions is not None:
+                self._sessions.remove()
+
+
+class SearchClient(object):
+    """
+    Client of a `SearchServer`. The methods take the same arguments as the server methods.
+
+    Parameters
+    ----------
+    address : str
+        The Unix socket.
+    """
+
+    def __init__(self, address=SOCKET_FILE):
+        with open(_authkey_file(address), 'rb') as key_file:
+            authkey = key_file.read()
+        self._connection = Client(address, family='AF_UNIX', authkey=authkey)
+
+    def _call(self, method, **kwargs):
+        self._connection.send((method, kwargs))
+        success, result = self._connection.recv()
+        if not success:
+            raise result
+        return result
+
+    def ping(self):
+        return self._call('ping')
+
+    def knn(self, fingerprint, **kwargs):
+        return self._call('knn', fingerprint=model_ext.as_packed(fingerprint), **kwargs)
+
+    def rnn(self, fingerprint, **kwargs):
+        return self._call('rnn', fingerprint=model_ext.as_packed(fingerprint), **kwargs)
+
+    def search_closest_compounds(self, molecule, **kwargs):
+        return self._call('search_closest_compounds', inchi=molecule.inchi, **kwargs)
+
+    def close(self):
+        self._connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def connect(address=SOCKET_FILE):
+    """
+    Connects to a running search server.
+
+    Parameters
+    ----------
+    address : str
+        The Unix socket.
+
+    Returns
+    -------
+    SearchClient
+        A client, or None if there is no server running.
+    """
+    if not os.path.exists(address) or not os.path.exists(_authkey_file(address)):
+        return None
+    try:
+        return SearchClient(address)
+    except (OSError, EOFError, AuthenticationError):
+        return None
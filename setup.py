@@ -12,6 +12,8 @@
 # limitations under the License.
 from __future__ import absolute_import, print_function
 
+import sys
+
 import numpy
 from Cython.Build import cythonize
 from setuptools import setup, find_packages, Extension
@@ -19,7 +21,7 @@ from setuptools import setup, find_packages, Extension
 import versioneer
 
 requirements = ['pandas>=0.18.1',
-                'numpy>=1.11.1',
+                'numpy>=1.17',
                 'bioservices>=1.4.14',
                 'requests>=2.11.1',
                 'bokeh==0.12',
@@ -28,7 +30,7 @@ requirements = ['pandas>=0.18.1',
                 'scikit-learn>=0.18.1',
                 'psycopg2>=2.7.1',
                 'bitarray>=0.8.1',
-                'Cython>=0.24',
+                'Cython>=0.28',
                 'cement>2.10',
                 'pubchempy>=1.0.3 ',
                 'cachetools>=2.0.0',
@@ -46,12 +48,24 @@ extra_requirements = {
 extra_requirements['all'] = sum([list(values) for values in extra_requirements.values()], [])
 
 
+# OpenMP is used to split the fingerprint scans across threads. Apple's clang does not ship it, so on macOS the
+# scans run on a single thread.
+if sys.platform.startswith('win'):
+    openmp_compile_args, openmp_link_args = ['/openmp'], []
+elif sys.platform == 'darwin':
+    openmp_compile_args, openmp_link_args = [], []
+else:
+    openmp_compile_args, openmp_link_args = ['-fopenmp'], ['-fopenmp']
+
+
 ext_modules = cythonize([Extension("marsi.chemistry.common_ext", 
                                    sources=["marsi/chemistry/common_ext.pyx"],
                                    include_dirs=[numpy.get_include()]), 
                          Extension("marsi.nearest_neighbors.model_ext",
                                    sources=["marsi/nearest_neighbors/model_ext.pyx"],
-                                   include_dirs=[numpy.get_include()])
+                                   include_dirs=[numpy.get_include()],
+                                   extra_compile_args=openmp_compile_args,
+                                   extra_link_args=openmp_link_args)
                         ])
 
 include_dirs = [numpy.get_include()]
@@ -66,6 +80,7 @@ setup(
                             'chemistry/common_ext.pxd', 'chemistry/common_ext.pyx',
                             'nearest_neighbors/model_ext.pyx']},
     install_requires=requirements,
+    python_requires='>=3.8',
     extras_require=extra_requirements,
     ext_modules=ext_modules,
     # scripts=['bin/marsi'],
@@ -79,8 +94,8 @@ setup(
     long_description="marsi is an open-source software to created to identify non-GMO strain design targets",
     classifiers=[
         'Development Status :: 3 - Alpha',
-        'Programming Language :: Python :: 3.5',
-        'Programming Language :: Python :: 2.7',
+        'Programming Language :: Python :: 3',
+        'Programming Language :: Python :: 3.8',
         'License :: OSI Approved :: Apache Software License',
         'Topic :: Scientific/Engineering :: Bio-Informatics',
 
@@ -18,8 +18,10 @@ import numpy as np
 import pytest
 
 from marsi.chemistry import openbabel, rdkit
-from marsi.chemistry.common import SOLUBILITY, tanimoto_coefficient, tanimoto_distance
-from marsi.chemistry.molecule import Molecule
+from marsi.chemistry.common import SOLUBILITY, tanimoto_coefficient, tanimoto_distance, monte_carlo_volume, \
+    monte_carlo_volumes, quasi_monte_carlo_volume
+from marsi.chemistry.fingerprint import PackedFingerprint
+from marsi.chemistry.molecule import Molecule, read_molecules
 
 TEST_DIR = os.path.dirname(__file__)
 
@@ -220,6 +222,92 @@ def test_structural_similarity_to_glucose(inchi, benchmark):
     assert similarity < 1
 
 
+def test_structural_similarity_bound(inchi):
+    mol = rdkit.inchi_to_molecule(inchi)
+    glucose = rdkit.inchi_to_molecule("InChI=1S/C6H12O6/c7-1-2-3(8)4(9)5(10)6(11)12-2/h2-11H,1H2/t2-,3-,4+,5-,6-/m1/s1")
+    assert rdkit.structural_similarity_bound(mol, mol) == 1
+    bound = rdkit.structural_similarity_bound(glucose, mol, atoms_weight=0.3, bonds_weight=0.7)
+    assert rdkit.structural_similarity(glucose, mol, atoms_weight=0.3, bonds_weight=0.7) <= bound <= 1
+
+
+def test_maximum_common_substructure_cache(inchi):
+    mol = rdkit.inchi_to_molecule(inchi)
+    glucose = rdkit.inchi_to_molecule("InChI=1S/C6H12O6/c7-1-2-3(8)4(9)5(10)6(11)12-2/h2-11H,1H2/t2-,3-,4+,5-,6-/m1/s1")
+    cache = {}
+    result = rdkit.maximum_common_substructure(glucose, mol, match_fraction=0, cache=cache,
+                                               cache_key=("glucose", "other"))
+    assert result.completed
+    assert list(cache) == [rdkit.mcs_cache_key("other", "glucose")]
+    assert cache[rdkit.mcs_cache_key("glucose", "other")] == result
+
+    # The cached result is used for both orders.
+    assert rdkit.maximum_common_substructure(mol, glucose, match_fraction=0, cache=cache,
+                                             cache_key=("other", "glucose")) == result
+    assert len(cache) == 1
+
+
+def test_read_molecules(tmpdir):
+    smiles_file = tmpdir.join("queries.smi")
+    smiles_file.write("# pyruvate and alanine\nCC(=O)C(=O)O pyruvate\n\nC[C@@H](C(=O)O)N\nnot-a-smiles bad\n")
+    molecules = list(read_molecules(str(smiles_file), 'smiles'))
+    assert [name for name, _ in molecules] == ["pyruvate", "4"]
+    assert all(isinstance(molecule, Molecule) for _, molecule in molecules)
+
+    inchi_file = tmpdir.join("queries.txt")
+    inchi_file.write(INCHI + " tryptophan\n")
+    (name, molecule), = read_molecules(str(inchi_file), 'inchi')
+    assert name == "tryptophan"
+    assert molecule.inchi_key == INCHI_KEY
+
+    sdf_file = tmpdir.join("queries.sdf")
+    sdf = openbabel.molecule_to_sdf(openbabel.inchi_to_molecule(INCHI))
+    sdf_file.write("\n".join([sdf, sdf]))
+    assert [m.inchi_key for _, m in read_molecules(str(sdf_file), 'sdf')] == [INCHI_KEY, INCHI_KEY]
+
+    with pytest.raises(ValueError):
+        list(read_molecules(str(sdf_file), 'mol2'))
+
+
+def test_packed_fingerprint():
+    bits = np.random.RandomState(0).uniform(size=167) < 0.3
+    fingerprint = PackedFingerprint.from_bits(bits)
+    assert len(fingerprint) == 167
+    assert fingerprint.words.dtype == np.uint64 and len(fingerprint.words) == 3
+    assert fingerprint.popcount == bits.sum()
+    assert np.array_equal(fingerprint, bits)
+    assert PackedFingerprint.from01(fingerprint.to01()) == fingerprint
+    restored = PackedFingerprint.from_bytes(fingerprint.to_bytes())
+    assert restored == fingerprint and restored.popcount == fingerprint.popcount
+    assert [fingerprint[i] for i in range(167)] == bits.astype(int).tolist()
+
+    molecule = openbabel.inchi_to_molecule(INCHI)
+    fp = openbabel.fingerprint(molecule, 'maccs')
+    packed = openbabel.fingerprint_to_bits(fp, openbabel.fp_bits['maccs'])
+    assert isinstance(packed, PackedFingerprint)
+    assert sorted(np.flatnonzero(packed) + 1) == sorted(b for b in fp.bits if b <= 167)
+
+    fp = rdkit.fingerprint(rdkit.inchi_to_molecule(INCHI), 'morgan2')
+    packed = rdkit.fingerprint_to_bits(fp, fp.GetNumBits())
+    assert list(np.flatnonzero(packed)) == list(fp.GetOnBits())
+
+
+def test_molecule_lazy_backends():
+    molecule = Molecule.from_inchi(INCHI)
+    assert molecule._ob is None and molecule._rd is None
+    assert molecule.inchi_key == INCHI_KEY
+    assert molecule._rd is None
+
+    fingerprint = molecule.fingerprint('fp2')
+    assert molecule.fingerprint('fp2') is fingerprint
+    assert molecule._rd is None
+    molecule.fingerprint('morgan2')
+    assert molecule._rd is not None
+
+    assert not hasattr(molecule, '__dict__')
+    with pytest.raises(ValueError):
+        Molecule(ob_mol=molecule._ob_mol)
+
+
 def test_mol_to_inchi(chemlib, inchi, benchmark):
     mol = benchmark(chemlib[0].inchi_to_molecule, inchi)
     inchi_ = chemlib[0].mol_to_inchi(mol)
@@ -256,6 +344,39 @@ def test_volume(chemlib, mol3d, benchmark):
     assert mol3d.volume * .9 <= volume <= mol3d.volume * 1.1
 
 
+def test_monte_carlo_volume():
+    sphere = np.array([[0, 0, 0]], dtype=np.float32), np.array([1.5], dtype=np.float32)
+    volume = monte_carlo_volume(*sphere, 0.01, 100, 10000, 0, 0)
+    assert volume == pytest.approx(4 / 3 * np.pi * 1.5 ** 3, rel=0.02)
+    assert monte_carlo_volume(*sphere, 0.01, 100, 10000, 0, 0) == volume
+
+    # Two unit spheres 1 A apart overlap in a lens of pi * 5 / 12.
+    spheres = np.array([[0, 0, 0], [1, 0, 0]], dtype=np.float32), np.array([1, 1], dtype=np.float32)
+    assert monte_carlo_volume(*spheres, 0.01, 100, 10000, 0, 0) == pytest.approx(8 / 3 * np.pi - 5 / 12 * np.pi,
+                                                                                  rel=0.02)
+
+    volumes = monte_carlo_volumes([sphere[0], spheres[0]], [sphere[1], spheres[1]], tolerance=0.01, max_iterations=100,
+                                  step_size=10000, threads=2)
+    assert volumes[0] == volume
+    assert volumes[1] == monte_carlo_volume(*spheres, 0.01, 100, 10000, 0, 0)
+
+
+def test_quasi_monte_carlo_volume():
+    sphere = np.array([[0, 0, 0]], dtype=np.float32), np.array([1.5], dtype=np.float32)
+    volume, error = quasi_monte_carlo_volume(*sphere, 0.01)
+    assert error < 0.01
+    assert volume == pytest.approx(4 / 3 * np.pi * 1.5 ** 3, abs=5 * error)
+    assert quasi_monte_carlo_volume(*sphere, 0.01) == (volume, error)
+
+    # Conformers share the radii: the second one is the first moved 5 A away.
+    conformers = np.array([[[0, 0, 0], [1, 0, 0]], [[5, 5, 5], [6, 5, 5]]], dtype=np.float32)
+    volumes = monte_carlo_volumes(conformers, np.array([1, 1], dtype=np.float32), tolerance=0.01,
+                                  method="quasi_monte_carlo")
+    assert volumes.shape == (2,)
+    assert volumes[0] == pytest.approx(volumes[1], rel=0.01)
+    assert volumes[0] == pytest.approx(8 / 3 * np.pi - 5 / 12 * np.pi, rel=0.01)
+
+
 def test_atom_count(molecule):
     assert molecule.num_atoms == MOL_ATOMS[molecule.id]
 
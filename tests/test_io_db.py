@@ -18,8 +18,11 @@ import rdkit
 from sqlalchemy.exc import IntegrityError
 
 from marsi.chemistry import openbabel
+from marsi.chemistry.molecule import Molecule
+from marsi.chemistry.rdkit import MCSResult, mcs_cache_key
 
-from marsi.io.db import Metabolite, Reference, Database
+from marsi.io.build_database import build_fingerprints, _compute_fingerprints, _insert_fingerprints
+from marsi.io.db import Metabolite, MetaboliteMCS, Reference, Database, FingerprintFailure, molecule_cache
 from marsi.config import default_session
 
 
@@ -37,6 +40,26 @@ def test_get_metabolite_by_inchi(benchmark):
         Metabolite.get("bla-bla-bla")
 
 
+def test_molecule_cache():
+    met = Metabolite.get("MKUXAQIIEYXACX-UHFFFAOYSA-N", session=default_session)
+    molecule = met.molecule('openbabel', get3d=False)
+    assert (met.inchi_key, 'openbabel', False) in molecule_cache
+
+    # The cache returns copies, so changes to a molecule do not reach the next call.
+    num_atoms = molecule.OBMol.NumAtoms()
+    molecule.removeh()
+    assert met.molecule('openbabel', get3d=False).OBMol.NumAtoms() == num_atoms
+
+    conformer = met.molecule_3d()
+    assert conformer.dim == 3
+    assert met.conformer is not None
+    assert met.molecule_3d().OBMol.NumAtoms() == conformer.OBMol.NumAtoms()
+
+    # The conformer is only stored when the caller commits.
+    default_session.rollback()
+    assert met.conformer is None
+
+
 @pytest.fixture(params=range(5))
 def metabolite(request):
     return default_session.query(Metabolite).filter(Metabolite.id == int(request.param) + 1).one()
@@ -54,6 +77,43 @@ def test_fingerprint_method(metabolite, benchmark):
     assert (fp == ob_fp)
 
 
+def test_compute_fingerprints(metabolite):
+    fingerprints = _compute_fingerprints('morgan2', [(metabolite.id, metabolite.inchi), (0, "InChI=1S/bla-bla")])
+    assert fingerprints[0] == (metabolite.id, Molecule.from_inchi(metabolite.inchi).fingerprint('morgan2'))
+    assert fingerprints[1] == (0, None)
+
+    with pytest.raises(ValueError):
+        build_fingerprints('bla-bla')
+
+
+def test_fingerprint_failures(metabolite):
+    assert _insert_fingerprints('test', [(metabolite.id, None)], default_session) == (0, 1)
+    failures = default_session.query(FingerprintFailure).filter(FingerprintFailure.fingerprint_type == 'test')
+    assert [failure.metabolite_id for failure in failures] == [metabolite.id]
+    failures.delete()
+    default_session.commit()
+
+
+def test_mcs_results_add_many():
+    first = mcs_cache_key("TEST-MCS-A", "TEST-MCS-B")
+    second = mcs_cache_key("TEST-MCS-A", "TEST-MCS-C")
+    result = MCSResult(3, 2, "CCO", True)
+    default_session.add(Reference(database="test_mcs", accession="pending"))
+    try:
+        assert MetaboliteMCS.add_many({first: result}, session=default_session) == 1
+        # The pairs already stored are skipped.
+        assert MetaboliteMCS.add_many({first: result, second: result}, session=default_session) == 1
+        stored = MetaboliteMCS.get_many("TEST-MCS-A", ["TEST-MCS-B", "TEST-MCS-C"], session=default_session)
+        assert set(stored) == {first, second}
+    finally:
+        default_session.rollback()
+        default_session.query(MetaboliteMCS).filter(MetaboliteMCS.first_inchi_key == "TEST-MCS-A").delete()
+        default_session.commit()
+
+    # The pending changes of the session were not committed.
+    assert default_session.query(Reference).filter(Reference.database == "test_mcs").count() == 0
+
+
 def test_collection_wrapper():
     for i in range(10):
         assert Database.metabolites[i] == default_session.query(Metabolite).filter(Metabolite.id == i + 1).one()
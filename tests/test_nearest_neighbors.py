@@ -0,0 +1,466 @@
+# Copyright 2017 Chr. Hansen A/S and The Novo Nordisk Foundation Center for Biosustainability, DTU.
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+# http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import threading
+import time
+
+import numpy as np
+import pytest
+
+from marsi.chemistry import rdkit
+from marsi.chemistry.common import tanimoto_distance
+from marsi.chemistry.fingerprint import PackedFingerprint
+from marsi import nearest_neighbors
+from marsi.nearest_neighbors import _structural_similarities
+from marsi.nearest_neighbors.index import read_index, SegmentedIndex
+from marsi.nearest_neighbors import model_ext
+from marsi.nearest_neighbors.clustering import butina_clustering
+from marsi.nearest_neighbors.model import NearestNeighbors, DistributedNearestNeighbors, PropertyFilter, \
+    _stack_fingerprint_bytes
+from marsi.nearest_neighbors.parallel import SharedMemoryView, shared_memory
+from marsi.nearest_neighbors.server import SearchServer, connect
+from marsi.utils import INCHI_KEY_TYPE
+
+N_ENTRIES = 500
+
+
+def _index(n):
+    index = np.ndarray((n, 1), dtype=INCHI_KEY_TYPE)
+    for i in range(n):
+        index[i] = "ENTRY%09i-UHFFFAOYSA-N" % i
+    return index
+
+
+def _reference_distances(features, fingerprint):
+    # Per-row Tanimoto distance, as computed by the original CNearestNeighbors kernel.
+    return np.array([tanimoto_distance(fingerprint, feature) for feature in features], dtype=np.float32)
+
+
+@pytest.fixture(params=[167, 1024])
+def features(request):
+    random = np.random.RandomState(request.param)
+    density = random.uniform(0.05, 0.5, size=(N_ENTRIES, 1))
+    features = (random.uniform(size=(N_ENTRIES, request.param)) < density).astype(np.int32)
+    features[0] = 0
+    return [f for f in features]
+
+
+@pytest.fixture
+def model(features):
+    return NearestNeighbors(_index(len(features)), features, [len(f) for f in features])
+
+
+@pytest.fixture
+def distributed_model(features):
+    index = _index(len(features))
+    chunks = [(0, 150), (150, 300), (300, len(features))]
+    return DistributedNearestNeighbors([NearestNeighbors(index[start:end], features[start:end],
+                                                         [len(f) for f in features[start:end]])
+                                        for start, end in chunks])
+
+
+def test_distances_are_bit_exact(features, model, benchmark):
+    random = np.random.RandomState(0)
+    queries = [features[0], features[1], features[-1], (random.uniform(size=len(features[0])) < 0.3).astype(np.int32)]
+    for query in queries:
+        expected = _reference_distances(features, query)[model.order]
+        distances = model.distances_py(query)
+        assert distances.dtype == np.float32
+        assert distances.tobytes() == expected.tobytes()
+
+    benchmark(model.distances_py, features[1])
+
+
+def test_distances_with_different_lengths(features):
+    features = [f if i % 3 else f[:-1] for i, f in enumerate(features)]
+    model = NearestNeighbors(_index(len(features)), features, [len(f) for f in features])
+
+    for query in (features[1], features[3]):
+        expected = _reference_distances(features, query)[model.order]
+        assert model.distances_py(query).tobytes() == expected.tobytes()
+
+
+def test_knn_and_rnn(features, model):
+    query = features[1]
+    expected = _reference_distances(features, query)
+
+    neighbors = model.knn(query, k=10)
+    assert len(neighbors) == 10
+    assert max(neighbors.values()) == np.sort(expected)[9]
+    assert neighbors["ENTRY000000001-UHFFFAOYSA-N"] == 0
+
+    neighbors = model.rnn(query, radius=0.5)
+    assert len(neighbors) == (expected <= 0.5).sum()
+    assert all(d <= 0.5 for d in neighbors.values())
+
+
+def test_get_fingerprint(features, model):
+    for i in (0, 1, len(features) - 1):
+        assert np.array_equal(model[i], features[model.order[i]])
+
+
+def test_packed_queries(features, model):
+    packed = [PackedFingerprint.from_bits(feature) for feature in features]
+    for i in (0, 1, 7):
+        assert model.distances_py(packed[i]).tobytes() == model.distances_py(features[i]).tobytes()
+        assert model.knn(packed[i], k=5) == model.knn(features[i], k=5)
+    assert model.distances_batch(packed[:20]).tobytes() == model.distances_batch(features[:20]).tobytes()
+
+    packed_model = NearestNeighbors(_index(len(features)), packed, [len(f) for f in features])
+    assert np.array_equal(packed_model.features, model.features)
+    assert isinstance(packed_model[0], PackedFingerprint)
+    assert packed_model[0] == model[0]
+
+
+def test_distances_batch(features, model):
+    queries = features[:70]
+    distances = model.distances_batch(queries)
+    assert distances.shape == (len(queries), len(features))
+    for i, query in enumerate(queries):
+        assert distances[i].tobytes() == model.distances_py(query).tobytes()
+
+
+def test_k_nearest_neighbors_batch(features, distributed_model):
+    queries = features[1:80]
+    index = distributed_model.index
+    query_idx, db_idx, distances = distributed_model.k_nearest_neighbors_batch(queries, k=5)
+    assert len(query_idx) == len(db_idx) == len(distances) == 5 * len(queries)
+
+    for i, query in enumerate(queries):
+        expected = np.sort(_reference_distances(features, query))[:5]
+        assert np.array_equal(distances[query_idx == i], expected)
+        assert index[db_idx[query_idx == i][0], 0].decode() == "ENTRY%09i-UHFFFAOYSA-N" % (i + 1)
+
+
+def test_radius_nearest_neighbors_batch(features, distributed_model):
+    queries = features[1:80]
+    index = distributed_model.index
+    query_idx, db_idx, distances = distributed_model.radius_nearest_neighbors_batch(queries, radius=0.5)
+
+    for i, query in enumerate(queries):
+        neighbors = distributed_model.radius_nearest_neighbors(query, radius=0.5)
+        hits = {index[j, 0].decode(): d for j, d in zip(db_idx[query_idx == i], distances[query_idx == i])}
+        assert hits == neighbors
+
+
+def test_stack_fingerprint_bytes(features):
+    values = [PackedFingerprint.from_bits(feature).to_bytes() for feature in features]
+    packed, length, popcounts = _stack_fingerprint_bytes(values)
+    assert length == len(features[0])
+    assert np.array_equal(packed, model_ext.pack_fingerprints(np.concatenate(features), [length] * len(features)))
+    assert np.array_equal(popcounts, model_ext.popcounts(packed))
+
+    with pytest.raises(ValueError):
+        _stack_fingerprint_bytes([PackedFingerprint.from01(bits).to_bytes() for bits in ("0101", "01")])
+
+
+def test_knn_with_max_distance(features, model):
+    query = features[1]
+    expected = _reference_distances(features, query)
+    max_distance = np.sort(expected)[20]
+
+    neighbors = model.knn(query, k=50, max_distance=max_distance)
+    assert len(neighbors) == (expected <= max_distance).sum()
+    assert all(expected[int(key[5:14])] == d for key, d in neighbors.items())
+
+
+def test_k_nearest_neighbors(features, distributed_model):
+    for query in (features[1], features[200], features[-1]):
+        expected = np.sort(_reference_distances(features, query))[:10]
+        neighbors = distributed_model.k_nearest_neighbors(query, k=10)
+        assert list(neighbors.values()) == list(expected)
+
+
+@pytest.mark.skipif(shared_memory is None, reason="multiprocessing.shared_memory is not available")
+def test_shared_memory_view(features, distributed_model):
+    queries = features[1:20]
+    with SharedMemoryView(distributed_model, processes=2) as view:
+        for query in (features[1], features[200], features[-1]):
+            assert distributed_model.k_nearest_neighbors(query, k=10, view=view) == \
+                distributed_model.k_nearest_neighbors(query, k=10)
+            assert distributed_model.radius_nearest_neighbors(query, radius=0.5, view=view) == \
+                distributed_model.radius_nearest_neighbors(query, radius=0.5)
+
+        shared_hits = distributed_model.k_nearest_neighbors_batch(queries, k=5, view=view)
+        for shared, sequential in zip(shared_hits, distributed_model.k_nearest_neighbors_batch(queries, k=5)):
+            assert np.array_equal(shared, sequential)
+
+        with pytest.raises(ValueError):
+            view.map(len, [NearestNeighbors(_index(1), features[:1], [len(features[0])])])
+
+
+def test_search_server(features, distributed_model, tmpdir):
+    address = str(tmpdir.join("search.sock"))
+    assert connect(address) is None
+
+    server = SearchServer(fpformats=(), address=address, models={'maccs': distributed_model}, processes=2)
+    assert nearest_neighbors._similarity_pool is not None
+
+    # Each thread gets a session of its own.
+    sessions = []
+    other = threading.Thread(target=lambda: sessions.append(server.session))
+    other.start()
+    other.join()
+    assert sessions[0] is not server.session
+
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+    try:
+        client = None
+        for _ in range(100):
+            client = connect(address)
+            if client is not None:
+                break
+            time.sleep(0.05)
+
+        with client:
+            assert client.ping() == ['maccs']
+            for query in (features[1], features[200]):
+                assert client.knn(query, k=10) == distributed_model.k_nearest_neighbors(query, k=10)
+                assert client.rnn(query, radius=0.5) == distributed_model.radius_nearest_neighbors(query, radius=0.5)
+            with pytest.raises(ValueError):
+                client._call('shutdown')
+    finally:
+        server.shutdown()
+        thread.join()
+
+    assert connect(address) is None
+
+
+def test_structural_similarities():
+    tryptophan = "InChI=1S/C11H12N2O2/c12-9(11(14)15)5-7-6-13-10-4-2-1-3-8(7)10/h1-4,6,9,13H,5,12H2,(H,14,15)/t9-/m0/s1"
+    pyruvate = "InChI=1S/C3H4O3/c1-2(4)3(5)6/h1H3,(H,5,6)/p-1"
+    candidates = [("trp", tryptophan), ("pyr", pyruvate), ("invalid", "InChI=invalid")]
+    similarities, mcs_results = _structural_similarities(tryptophan, "trp", candidates, 0.5, 0.5, 10)
+    similarities = {inchi_key: (similarity, complete) for inchi_key, similarity, complete in similarities}
+    assert similarities["trp"] == (pytest.approx(1), True)
+    assert 0 <= similarities["pyr"][0] < 1
+    assert similarities["invalid"] == (None, False)
+    assert set(mcs_results) == {rdkit.mcs_cache_key("trp", "trp"), rdkit.mcs_cache_key("trp", "pyr")}
+
+    # Known results are not returned again.
+    assert _structural_similarities(tryptophan, "trp", candidates[:2], 0.5, 0.5, 10, mcs_results)[1] == {}
+
+    # Candidates that cannot reach the minimum similarity skip the MCS.
+    similarities, mcs_results = _structural_similarities(tryptophan, "trp", [("pyr2", pyruvate)], 0.5, 0.5, 10,
+                                                         min_similarity=0.99)
+    assert similarities == [("pyr2", None, True)] and mcs_results == {}
+
+    # Candidates left at the deadline are not scored.
+    similarities, mcs_results = _structural_similarities(tryptophan, "trp", [("pyr3", pyruvate)], 0.5, 0.5, 10,
+                                                         end_time=time.time() - 1)
+    assert len(similarities) == 1 and np.isnan(similarities[0][1]) and not similarities[0][2]
+    assert mcs_results == {}
+
+
+def test_distance_matrix(features, distributed_model, tmpdir):
+    index = distributed_model.index
+    order = [int(key[5:14]) for key in index[:, 0]]
+    expected = np.array([_reference_distances(features, features[i])[order] for i in order])
+
+    matrix = distributed_model.distance_matrix(block_size=64)
+    assert matrix.dtype == np.float32
+    assert np.array_equal(matrix, expected, equal_nan=True)
+    assert np.array_equal(distributed_model.feature(200), features[order[200]])
+
+    file_path = str(tmpdir.join("distances.npy"))
+    quantized = distributed_model.distance_matrix(file_path=file_path, dtype=np.uint16, block_size=64)
+    assert np.array_equal(np.load(file_path), quantized)
+    assert np.allclose(quantized / 32767.5, np.nan_to_num(expected, nan=2.0), atol=1e-4)
+
+    sparse = distributed_model.distance_matrix(max_distance=0.5, block_size=64)
+    within = (expected <= 0.5) & ~np.eye(len(expected), dtype=bool)
+    assert sparse.nnz == within.sum()
+    assert np.array_equal(sparse.toarray()[within], expected[within])
+
+
+def test_radius_neighbors_graph_and_butina_clustering(features, distributed_model):
+    expected = distributed_model.distance_matrix()
+    within = (expected <= 0.4) & ~np.eye(len(expected), dtype=bool)
+    graph = distributed_model.radius_neighbors_graph(0.4, block_size=64).tocoo()
+    edges = set(zip(graph.row, graph.col))
+    assert edges == set(zip(*np.nonzero(within)))
+
+    labels, centroids = butina_clustering(graph)
+    assert np.array_equal(labels[centroids], np.arange(len(centroids)))
+    assert all(entry == centroids[label] or (entry, centroids[label]) in edges for entry, label in enumerate(labels))
+    assert not any((a, b) in edges for a in centroids for b in centroids)
+
+
+@pytest.fixture
+def clustered_model():
+    # 50 groups of 20 fingerprints with 5% of the bits of a common base flipped.
+    random = np.random.RandomState(0)
+    bases = random.uniform(size=(50, 1024)) < 0.3
+    flips = random.uniform(size=(50, 20, 1024)) < 0.05
+    features = [f.astype(np.int32) for f in (bases[:, None, :] ^ flips).reshape(-1, 1024)]
+    return NearestNeighbors(_index(len(features)), features, [len(f) for f in features]), features
+
+
+def test_lsh_recall(clustered_model, benchmark):
+    model, features = clustered_model
+    model.build_lsh(bands=32, rows=4)
+    queries = features[::37]
+
+    found = expected = 0
+    for query in queries:
+        exact = model.rnn(query, 0.4)
+        approximate = model.rnn(query, 0.4, mode="lsh")
+        assert all(exact[key] == distance for key, distance in approximate.items())
+        found += len(approximate)
+        expected += len(exact)
+        assert list(model.knn(query, 5, mode="lsh").values()) == list(model.knn(query, 5).values())
+
+    assert found / expected > 0.95
+    benchmark(model.rnn, queries[0], 0.4, mode="lsh")
+
+
+def _properties(n):
+    random = np.random.RandomState(n)
+    return {"num_atoms": random.randint(1, 40, n), "num_bonds": random.randint(1, 40, n),
+            "num_rings": random.randint(0, 5, n), "solubility": random.uniform(0, 0.0001, n),
+            "analog": random.uniform(size=n) < 0.5}
+
+
+def test_property_filter(features, tmpdir):
+    properties = _properties(len(features))
+    model = NearestNeighbors(_index(len(features)), features, [len(f) for f in features], properties=properties)
+    property_filter = PropertyFilter(num_atoms=(10, 20), num_rings=(1, 3), solubility='high', analog=False)
+    selected = property_filter(properties)
+    assert 0 < selected.sum() < len(features)
+
+    query = features[1]
+    expected = _reference_distances(features, query)
+    neighbors_in_radius = neighbors = model.rnn(query, 0.7, property_filter=property_filter)
+    assert set(int(key[5:14]) for key in neighbors) == set(np.flatnonzero(selected & (expected <= 0.7)))
+    neighbors = model.knn(query, 5, property_filter=property_filter)
+    assert list(neighbors.values()) == list(np.sort(expected[selected])[:5])
+
+    distributed = DistributedNearestNeighbors([model])
+    assert distributed.radius_nearest_neighbors(query, 0.7, property_filter=property_filter) == \
+        model.rnn(query, 0.7, property_filter=property_filter)
+
+    # Filtering the hits of a batch search with the model properties selects the same entries.
+    query_idx, db_idx, distances = distributed.radius_nearest_neighbors_batch([query], 0.7)
+    mask = property_filter({name: column[db_idx] for name, column in distributed.properties.items()})
+    assert {key.decode('utf-8') for key in distributed.index[db_idx[mask], 0]} == set(neighbors_in_radius)
+    assert DistributedNearestNeighbors([model, NearestNeighbors(_index(1), features[:1], [len(features[0])])]) \
+        .properties is None
+
+    segments = SegmentedIndex(str(tmpdir.join("fingerprints")))
+    segments.append(model.index, model.features, model.features_lengths, model.popcounts, model.properties)
+    segments.delete([model.index[0, 0]])
+    stored, = segments.read_properties()
+    for name, column in stored.items():
+        assert np.array_equal(column, model.properties[name][1:])
+
+    file_path = str(tmpdir.join("model.nni"))
+    model.save(file_path)
+    loaded = NearestNeighbors.load(file_path)
+    assert loaded.rnn(query, 0.7, property_filter=property_filter) == neighbors_in_radius
+
+    # Models loaded from the database do not know the solubility of their entries.
+    del properties['solubility']
+    model = NearestNeighbors(_index(len(features)), features, [len(f) for f in features], properties=properties)
+    assert 'solubility' not in model.properties
+    assert PropertyFilter(num_atoms=(10, 20))(model.properties).sum() > 0
+    with pytest.raises(ValueError):
+        model.rnn(query, 0.7, property_filter=property_filter)
+    model.save(file_path)
+    assert set(NearestNeighbors.load(file_path).properties) == set(properties)
+
+
+def test_entries_are_sorted_by_popcount(features, model):
+    assert np.all(np.diff(model.popcounts) >= 0)
+    assert np.array_equal(model.popcounts, [features[i].sum() for i in model.order])
+    assert model.index[0, 0].decode() == "ENTRY000000000-UHFFFAOYSA-N"
+    for count in (0, 10, model.popcounts[-1]):
+        start, end = model.popcount_offsets[count], model.popcount_offsets[count + 1]
+        assert np.all(model.popcounts[start:end] == count)
+
+
+@pytest.mark.parametrize("radius", [0.1, 0.3, 0.6, 1.0])
+def test_rnn_is_pruned_by_popcount(features, model, radius, benchmark):
+    random = np.random.RandomState(1)
+    queries = [features[1], features[-1], (random.uniform(size=len(features[0])) < 0.1).astype(np.int32)]
+    for query in queries:
+        expected = _reference_distances(features, query)
+        start, end = model.rows_within(query.sum(), radius)
+        within = model.order[start:end]
+        assert set(np.flatnonzero(expected <= radius)) <= set(within)
+
+        neighbors = model.rnn(query, radius=radius)
+        assert neighbors == {"ENTRY%09i-UHFFFAOYSA-N" % i: expected[i] for i in np.flatnonzero(expected <= radius)}
+
+    benchmark(model.rnn, features[1], radius)
+
+
+def test_index_file(features, model, tmpdir, benchmark):
+    file_path = str(tmpdir.join("fingerprints.index"))
+    model.save(file_path)
+
+    loaded = benchmark(NearestNeighbors.load, file_path)
+    assert isinstance(loaded.features, np.memmap)
+    assert np.array_equal(loaded.index, model.index)
+    assert np.array_equal(loaded.popcount_offsets, model.popcount_offsets)
+    for query in (features[0], features[1], features[-1]):
+        assert loaded.distances_py(query).tobytes() == model.distances_py(query).tobytes()
+        assert loaded.rnn(query, radius=0.4) == model.rnn(query, radius=0.4)
+    assert np.array_equal(loaded[3], model[3])
+
+
+def test_index_file_sharded(features, model, tmpdir):
+    file_path = str(tmpdir.join("fingerprints.index"))
+    model.save(file_path)
+
+    columns = read_index(file_path)
+    shards = [NearestNeighbors.from_packed(columns.index[start:start + 128], columns.features[start:start + 128],
+                                           columns.features_lengths[start:start + 128],
+                                           columns.popcounts[start:start + 128])
+              for start in range(0, len(columns.index), 128)]
+    distributed = DistributedNearestNeighbors(shards)
+    assert distributed.radius_nearest_neighbors(features[1], radius=0.5) == model.rnn(features[1], radius=0.5)
+
+
+def test_index_file_is_validated(tmpdir):
+    file_path = tmpdir.join("fingerprints.index")
+    file_path.write_binary(b"not an index")
+    with pytest.raises(ValueError):
+        read_index(str(file_path))
+
+
+def test_segmented_index(features, tmpdir):
+    index = _index(len(features))
+    segments = SegmentedIndex(str(tmpdir.join("fingerprints")))
+    for start, end in ((0, 200), (200, 350), (350, len(features))):
+        model = NearestNeighbors(index[start:end], features[start:end], [len(f) for f in features[start:end]])
+        segments.append(model.index, model.features, model.features_lengths, model.popcounts)
+    segments.checkpoint(len(features), 10)
+
+    deleted_keys = ["ENTRY%09i-UHFFFAOYSA-N" % i for i in (1, 250, 499)]
+    assert segments.delete(deleted_keys) == 3
+    assert segments.delete(deleted_keys) == 0
+
+    reopened = SegmentedIndex(segments.path)
+    assert len(reopened) == 3
+    assert reopened.max_metabolite_id == len(features)
+    keys = set(key.decode() for key in reopened.keys()[:, 0])
+    assert len(keys) == len(features) - 3 and not keys & set(deleted_keys)
+
+    reopened.compact_in_background().join()
+    assert len(reopened) == 1
+    compacted = NearestNeighbors.load(str(tmpdir.join("fingerprints", reopened.segments[0])))
+    assert np.all(np.diff(compacted.popcounts) >= 0)
+    assert set(key.decode() for key in compacted.index[:, 0]) == keys
+    assert sorted(tmpdir.join("fingerprints").listdir()) == sorted(
+        [tmpdir.join("fingerprints", "manifest.json"), tmpdir.join("fingerprints", reopened.segments[0])])